@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+"""Compares the throughput of the WSGI and ASGI servers.
+
+The Flask app is served by ``main.py``, with a thread per request, and
+:mod:`oblong.asgi` by uvicorn, each in a single process. Both are sent
+the same mix of profile, search, keyword and publication requests by
+``--concurrency`` clients at once, and the requests completed per
+second and their latencies are reported. Searches are of known
+keywords, so neither server runs NLTK.
+
+    $ python benchmarks/asgi.py --profiles 2000 --concurrency 1000
+    20000 requests, 1000 at once
+    server       req/s    p50 ms    p99 ms    errors
+    WSGI            65   14873.6   21214.1         0
+    ASGI            52   13494.5   81417.9        22
+
+    $ python benchmarks/asgi.py --concurrency 20 --requests 5000
+    5000 requests, 20 at once
+    server       req/s    p50 ms    p99 ms    errors
+    WSGI            75     258.6     499.0         0
+    ASGI            96     149.5     609.5         0
+
+Those are from a single core, shared by the client, the server and
+Postgres, with SQLAlchemy 1.4 and Starlette 1.8. The searches take most
+of the time in both servers. At 20 clients the ASGI server completes
+more requests with lower median latency. At 1000 it completes fewer:
+it accepts every connection at once, so its requests contend for the
+one core and the connection pool, and the unluckiest of them outlive
+the client's 60 second timeout, which is what the errors are. The WSGI
+server only accepts as many as its listen backlog, and the rest wait
+their turn in the kernel.
+
+This needs the ``asgi`` extra, and ``httpx``.
+
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(__file__), '..')
+sys.path.insert(0, ROOT)
+
+import httpx
+import testing.postgresql
+
+from corpus import synthetic_profiles
+from oblong import database as db
+
+parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+parser.add_argument('--profiles', type=int, default=2000)
+parser.add_argument('--publications', type=int, default=4000)
+parser.add_argument('--concurrency', type=int, default=1000)
+parser.add_argument('--requests', type=int, default=20000)
+parser.add_argument('--page-size', type=int, default=25)
+args = parser.parse_args()
+
+def populate(vectors, rng):
+    db.session.execute(db.Profile.__table__.insert(), [
+        { 'title': 'Dr'
+        , 'firstname': 'First{}'.format(i)
+        , 'lastname': 'Last{}'.format(i)
+        , 'email': 'person{}@ic.ac.uk'.format(i)
+        , 'faculty': 'Faculty{}'.format(i % 5)
+        , 'department': 'Department{}'.format(i % 20)
+        } for i in range(len(vectors))])
+    uids = [uid for uid, in db.session.execute(
+            'SELECT id FROM profile ORDER BY id')]
+    ids = db.keyword_ids({k for v in vectors for k in v})
+    db.session.execute(db.ProfileKeywordAssociation.__table__.insert(), [
+        {'left_id': uid, 'right_id': ids[k], 'weight': w}
+        for uid, vector in zip(uids, vectors) for k, w in vector.items()])
+    db.session.execute(db.Publication.__table__.insert(), [
+        {'title': 'Paper {}'.format(i), 'date': '2016-01-01'}
+        for i in range(args.publications)])
+    pids = [pid for pid, in db.session.execute(
+            'SELECT id FROM publication ORDER BY id')]
+    db.session.execute(db.profile_publication_association.insert(), [
+        {'profile_id': uid, 'publication_id': pid}
+        for pid in pids for uid in rng.sample(uids, rng.randint(1, 4))])
+    db.session.commit()
+    return uids, sorted(ids), pids
+
+def wait_until_up(url, process):
+    for _ in range(600):
+        if process.poll() is not None:
+            raise RuntimeError('{} exited'.format(process.args))
+        try:
+            httpx.get(url + '/api/publications/0')
+            return
+        except httpx.TransportError:
+            time.sleep(.1)
+    raise RuntimeError('{} did not start'.format(process.args))
+
+async def load(url, paths):
+    """Requests every path, ``--concurrency`` at a time."""
+    latencies, errors = [], 0
+    queue = asyncio.Queue()
+    for path in paths:
+        queue.put_nowait(path)
+    limits = httpx.Limits(max_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=url, limits=limits,
+                                 timeout=60) as client:
+        async def worker():
+            nonlocal errors
+            while not queue.empty():
+                path = queue.get_nowait()
+                start = time.perf_counter()
+                try:
+                    response = await client.get(path)
+                    ok = response.status_code < 500
+                except httpx.HTTPError:
+                    ok = False
+                if ok:
+                    latencies.append(time.perf_counter() - start)
+                else:
+                    errors += 1
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+        elapsed = time.perf_counter() - start
+    latencies.sort()
+    return (len(latencies) / elapsed,
+            1000 * latencies[len(latencies) // 2],
+            1000 * latencies[int(.99 * len(latencies))],
+            errors)
+
+# each client's connection takes a file descriptor in the client and,
+# once accepted, another in the server, which inherits this limit
+_, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+rng = random.Random(0)
+with testing.postgresql.Postgresql() as postgresql:
+    db.init(postgresql.url())
+    uids, keywords, pids = populate(synthetic_profiles(args.profiles), rng)
+    db.session.remove()
+    db.engine.dispose()
+
+    kinds = [ lambda: '/api/people/{}'.format(rng.choice(uids))
+            , lambda: '/api/people?query={}&page_size={}'.format(
+                    rng.choice(keywords), args.page_size)
+            , lambda: '/api/keywords/{}?limit={}'.format(
+                    rng.choice(keywords), args.page_size)
+            , lambda: '/api/publications/{}'.format(rng.choice(pids))
+            ]
+    paths = [rng.choice(kinds)() for _ in range(args.requests)]
+
+    # the ASGI server has no admission control, so nor does the WSGI one
+    unlimited = {'concurrency': args.concurrency, 'queue': args.concurrency,
+                 'queue_timeout': 60, 'deadline': None}
+    env = dict(os.environ, DATABASE_URL=postgresql.url(),
+               ADMISSION_LIMITS=json.dumps({'search': unlimited}))
+    servers = [ ('WSGI', 5001, [sys.executable, 'main.py', '--port', '5001',
+                                '--log-level', 'error'])
+              , ('ASGI', 5002, [sys.executable, '-m', 'uvicorn',
+                                'oblong.asgi:app', '--port', '5002',
+                                '--log-level', 'error'])
+              ]
+    print('{} requests, {} at once'.format(args.requests, args.concurrency))
+    print('{:<8}{:>10}{:>10}{:>10}{:>10}'.format(
+            'server', 'req/s', 'p50 ms', 'p99 ms', 'errors'))
+    for name, port, command in servers:
+        process = subprocess.Popen(command, cwd=ROOT, env=env,
+                                   stdout=subprocess.DEVNULL,
+                                   stderr=subprocess.DEVNULL)
+        try:
+            url = 'http://localhost:{}'.format(port)
+            wait_until_up(url, process)
+            asyncio.run(load(url, paths[:200]))
+            print('{:<8}{:>10.0f}{:>10.1f}{:>10.1f}{:>10}'.format(
+                    name, *asyncio.run(load(url, paths))))
+        finally:
+            process.terminate()
+            process.wait()
@@ -0,0 +1,49 @@
+"""A synthetic corpus of profiles for benchmarking.
+
+Real profiles cluster around research topics: most of an author's
+keywords come from one or two fields, with a long tail of one-offs.
+The corpus mimics that by drawing each profile's keywords from a few
+topics, each of which is a Zipf-distributed vocabulary, plus some
+noise from the vocabulary at large.
+
+"""
+import random
+
+def synthetic_profiles(n, topics=50, topic_size=200, vocabulary=20000,
+                       keywords=(20, 120), seed=0):
+    """Generates keyword vectors for ``n`` profiles.
+
+    Args:
+        n (int): The number of profiles.
+        topics (int): The number of research topics.
+        topic_size (int): The number of keywords in each topic.
+        vocabulary (int): The total number of keywords.
+        keywords (Tuple[int, int]): Bounds on the number of keywords
+            per profile.
+        seed (int): Seeds the generator.
+
+    Returns:
+        (List[Dict[str, float]]): For each profile, a mapping from
+        keyword to weight, scaled between 0 and 100 as
+        :func:`oblong.profiling.update_authors_profiles` does.
+
+    """
+    rng = random.Random(seed)
+    words = ['keyword {}'.format(i) for i in range(vocabulary)]
+    topic_words = [rng.sample(words, topic_size) for _ in range(topics)]
+    zipf = [1 / (rank + 1) for rank in range(topic_size)]
+
+    profiles = []
+    for _ in range(n):
+        mine = rng.sample(topic_words, rng.choice((1, 1, 2, 3)))
+        size = rng.randint(*keywords)
+        vector = {}
+        for _ in range(size):
+            if rng.random() < .1:
+                word = rng.choice(words)
+            else:
+                word = rng.choices(rng.choice(mine), zipf)[0]
+            vector[word] = vector.get(word, 0) + rng.uniform(1, 10)
+        top = max(vector.values())
+        profiles.append({k: 100 * w / top for k, w in vector.items()})
+    return profiles
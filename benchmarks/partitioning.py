@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""Compares a plain and a hash partitioned keyword weights table.
+
+The same weights are loaded into ``profile_keyword_association``, and
+the timings below taken; the table is then partitioned with
+:func:`oblong.migrations.partition_keyword_weights` and they are taken
+again. Searches are for the most common keywords, which match the most
+weights and so need the largest aggregates. At the default size the
+table holds about 23 million weights.
+
+    $ python benchmarks/partitioning.py --profiles 500000 --partitions 16
+    23074857 weights of 500000 profiles
+    table                  MiB    vacuum s      p50 ms      p95 ms
+    plain                 2638         1.9      1420.2      2623.7
+    16 partitions         2363         3.6      1524.2      2358.6
+    partitioning took 52.9s
+
+Those are from a single core with 5 GB of memory, where Postgres has no
+parallel workers to aggregate partitions at once, so searches are no
+faster; partitioning only pays off with the cores to use it. The table
+is smaller because its indexes are built afresh when it is copied.
+
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import testing.postgresql
+
+from corpus import synthetic_profiles
+from oblong import database as db, migrations
+
+parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+parser.add_argument('--profiles', type=int, default=500000)
+parser.add_argument('--partitions', type=int, default=16)
+parser.add_argument('--searches', type=int, default=50)
+parser.add_argument('--page-size', type=int, default=25)
+parser.add_argument('--batch-size', type=int, default=100000)
+args = parser.parse_args()
+
+def populate(vectors):
+    profiles = db.Profile.__table__
+    for start in range(0, len(vectors), args.batch_size):
+        db.session.execute(profiles.insert(), [
+            {'firstname': 'First{}'.format(i), 'lastname': 'Last{}'.format(i)}
+            for i in range(start, min(start + args.batch_size,
+                                      len(vectors)))])
+    uids = [uid for uid, in db.session.execute(
+            'SELECT id FROM profile ORDER BY id')]
+    ids = db.keyword_ids({k for v in vectors for k in v})
+    rows = []
+    for uid, vector in zip(uids, vectors):
+        rows.extend({'left_id': uid, 'right_id': ids[k], 'weight': w}
+                    for k, w in vector.items())
+        if len(rows) >= args.batch_size:
+            db.session.execute(db.ProfileKeywordAssociation.__table__.insert(),
+                               rows)
+            rows = []
+    if rows:
+        db.session.execute(db.ProfileKeywordAssociation.__table__.insert(),
+                           rows)
+    db.session.commit()
+
+def timed(f, *args):
+    start = time.perf_counter()
+    f(*args)
+    return time.perf_counter() - start
+
+def vacuum():
+    connection = db.engine.connect().execution_options(
+            isolation_level='AUTOCOMMIT')
+    connection.execute('VACUUM ANALYZE profile_keyword_association')
+    connection.close()
+
+def search(keywords):
+    db.get_profiles_by_keywords(keywords, 0, args.page_size)
+    db.session.remove()
+
+def measure(label, queries):
+    # the first search of a connection plans with cold caches
+    search(queries[0])
+    vacuum_time = timed(vacuum)
+    times = sorted(timed(search, q) for q in queries)
+    size, = db.session.execute(
+            "SELECT sum(pg_total_relation_size(c.oid)) FROM pg_class c "
+            "WHERE c.oid = 'profile_keyword_association'::regclass "
+            "OR c.oid IN (SELECT inhrelid FROM pg_inherits WHERE inhparent "
+            "= 'profile_keyword_association'::regclass)").fetchone()
+    db.session.remove()
+    print('{:<14}{:>12.0f}{:>12.1f}{:>12.1f}{:>12.1f}'.format(
+            label, size / 2**20, vacuum_time,
+            1000 * times[len(times) // 2],
+            1000 * times[int(.95 * len(times))]))
+
+rng = random.Random(0)
+vectors = synthetic_profiles(args.profiles)
+counts = {}
+for vector in vectors:
+    for k in vector:
+        counts[k] = counts.get(k, 0) + 1
+common = sorted(counts, key=counts.get, reverse=True)[:200]
+queries = [rng.sample(common, rng.randint(1, 3))
+           for _ in range(args.searches)]
+
+with testing.postgresql.Postgresql() as postgresql:
+    db.init(postgresql.url())
+    populate(vectors)
+    rows, = db.session.execute(
+            'SELECT count(*) FROM profile_keyword_association').fetchone()
+    db.session.remove()
+    print('{} weights of {} profiles'.format(rows, args.profiles))
+    print('{:<14}{:>12}{:>12}{:>12}{:>12}'.format(
+            'table', 'MiB', 'vacuum s', 'p50 ms', 'p95 ms'))
+    measure('plain', queries)
+    partition_time = timed(migrations.partition_keyword_weights,
+                           db.engine, args.partitions)
+    measure('{} partitions'.format(args.partitions), queries)
+    print('partitioning took {:.1f}s'.format(partition_time))
+    db.session.remove()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""Measures the size and latency of large profile documents.
+
+A single profile with many keywords and publications, like those of
+senior staff, is fetched through ``GET /api/people/<uid>`` with and
+without compression, sparse fieldsets and limits. Latency is the
+median time to serve the request in process, including compression.
+
+    $ python benchmarks/profile_payload.py --keywords 8000
+
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import testing.postgresql
+
+from oblong import compression, database as db, server
+
+parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+parser.add_argument('--keywords', type=int, default=8000)
+parser.add_argument('--publications', type=int, default=800)
+parser.add_argument('--requests', type=int, default=50)
+args = parser.parse_args()
+
+def populate():
+    profile = db.Profile(title='Prof', firstname='Senior', lastname='Staff',
+                         email='senior.staff@ic.ac.uk', faculty='Engineering',
+                         department='Department of Computing')
+    db.session.add(profile)
+    db.session.commit()
+    names = ['concept {} of computing'.format(i) for i in range(args.keywords)]
+    ids = db.keyword_ids(names)
+    db.add_keyword_weights(profile.id, {ids[name]: 100 * (i + 1) / len(names)
+                                        for i, name in enumerate(names)})
+    db.session.execute(db.Publication.__table__.insert(), [
+        { 'title': 'A rather long paper title, number {}'.format(i)
+        , 'date': '2016-01-01'
+        , 'title_key': db.publication_title_key('paper {}'.format(i))
+        } for i in range(args.publications)])
+    db.session.execute('INSERT INTO profile_publication_association '
+                       'SELECT {}, id FROM publication'.format(profile.id))
+    db.session.commit()
+    return profile.id
+
+def measure(client, url, encoding):
+    headers = {'Accept-Encoding': encoding}
+    client.get(url, headers=headers)
+    times = []
+    for _ in range(args.requests):
+        start = time.perf_counter()
+        response = client.get(url, headers=headers)
+        times.append(time.perf_counter() - start)
+    return len(response.data), 1000 * statistics.median(times)
+
+with testing.postgresql.Postgresql() as postgresql:
+    db.init(postgresql.url())
+    uid = populate()
+    client = server.app.test_client()
+    url = '/api/people/{}'.format(uid)
+    cases = [ ('full', url, 'identity')
+            , ('full, gzip', url, 'gzip')
+            , ('full, br', url, 'br')
+            , ('limited', url + '?keywords_limit=50&publications_limit=20',
+               'identity')
+            , ('limited, gzip', url + '?keywords_limit=50'
+               '&publications_limit=20', 'gzip')
+            , ('summary fields', url + '?fields=name,email,faculty,department',
+               'identity')
+            ]
+    if compression.brotli is None:
+        cases = [c for c in cases if c[2] != 'br']
+
+    print('keywords: {}, publications: {}'.format(args.keywords,
+                                                 args.publications))
+    print('{:<16}{:>12}{:>12}'.format('request', 'bytes', 'ms'))
+    for name, url, encoding in cases:
+        size, latency = measure(client, url, encoding)
+        print('{:<16}{:>12}{:>12.2f}'.format(name, size, latency))
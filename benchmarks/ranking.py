@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""Times searches ranked by weight, TF-IDF and BM25.
+
+TF-IDF and BM25 read each keyword's document frequency, and the
+number of profiles, from ``keyword_statistics``; for comparison, they
+are also timed counting them from ``profile_keyword_association`` and
+``profile`` on every search, as they would without the statistics. Searches are for the most common keywords,
+whose counts cost the most. The price of keeping the statistics is
+paid by writers, so the keyword weights are also loaded with the
+statistics triggers enabled and disabled.
+
+    $ python benchmarks/ranking.py --profiles 50000
+
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from types import SimpleNamespace
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import testing.postgresql
+
+from corpus import synthetic_profiles
+from oblong import database as db
+
+parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+parser.add_argument('--profiles', type=int, default=50000)
+parser.add_argument('--searches', type=int, default=50)
+parser.add_argument('--page-size', type=int, default=25)
+parser.add_argument('--batch-size', type=int, default=100000)
+args = parser.parse_args()
+
+def timed(f, *args):
+    start = time.perf_counter()
+    f(*args)
+    return time.perf_counter() - start
+
+def load_weights(rows):
+    table = db.ProfileKeywordAssociation.__table__
+    for start in range(0, len(rows), args.batch_size):
+        db.session.execute(table.insert(),
+                           rows[start:start + args.batch_size])
+    db.session.commit()
+
+def populate(vectors):
+    db.session.execute(db.Profile.__table__.insert(), [
+        {'firstname': 'First{}'.format(i), 'lastname': 'Last{}'.format(i)}
+        for i in range(len(vectors))])
+    uids = [uid for uid, in db.session.execute(
+            'SELECT id FROM profile ORDER BY id')]
+    ids = db.keyword_ids({k for v in vectors for k in v})
+    db.session.commit()
+    rows = [{'left_id': uid, 'right_id': ids[k], 'weight': w}
+            for uid, vector in zip(uids, vectors) for k, w in vector.items()]
+
+    print('{:<24}{:>12}'.format('loading weights', 's'))
+    db.session.execute('ALTER TABLE profile_keyword_association '
+                       'DISABLE TRIGGER USER')
+    db.session.commit()
+    print('{:<24}{:>12.1f}'.format('without statistics',
+                                   timed(load_weights, rows)))
+    db.session.execute('TRUNCATE profile_keyword_association')
+    db.session.execute('ALTER TABLE profile_keyword_association '
+                       'ENABLE TRIGGER USER')
+    db.rebuild_keyword_statistics()
+    db.session.commit()
+    print('{:<24}{:>12.1f}'.format('with statistics',
+                                   timed(load_weights, rows)))
+    # a raw load marks no profiles as changed, so nothing folded yet
+    print('{:<24}{:>12.1f}'.format('folding statistics',
+                                   timed(fold_statistics)))
+    return len(rows)
+
+def fold_statistics():
+    db.fold_keyword_statistics()
+    db.session.commit()
+
+def search(keywords, ranking):
+    db.get_profiles_by_keywords(keywords, 0, args.page_size, ranking)
+    db.session.remove()
+
+def measure(label, ranking, queries):
+    search(queries[0], ranking)
+    times = sorted(timed(search, q, ranking) for q in queries)
+    print('{:<24}{:>12.1f}{:>12.1f}'.format(
+            label, 1000 * times[len(times) // 2],
+            1000 * times[int(.95 * len(times))]))
+
+def counted():
+    """Statistics counted from the weights and profiles, in the shape
+    of the table."""
+    assoc = db.ProfileKeywordAssociation.__table__
+    keywords = db.select(
+            [ assoc.c.right_id.label('keyword_id')
+            , db.func.count().label('profiles')
+            , db.func.sum(assoc.c.weight).label('total_weight')
+            ]).group_by(assoc.c.right_id)
+    corpus = db.select(
+            [ db.literal(db.CORPUS_STATISTICS).label('keyword_id')
+            , db.func.count().label('profiles')
+            , db.literal(0.).label('total_weight')
+            ]).select_from(db.Profile.__table__)
+    return SimpleNamespace(__table__=db.union_all(keywords, corpus)
+                                       .alias('counted'))
+
+rng = random.Random(0)
+vectors = synthetic_profiles(args.profiles)
+counts = {}
+for vector in vectors:
+    for k in vector:
+        counts[k] = counts.get(k, 0) + 1
+common = sorted(counts, key=counts.get, reverse=True)[:200]
+queries = [rng.sample(common, rng.randint(1, 3))
+           for _ in range(args.searches)]
+
+with testing.postgresql.Postgresql() as postgresql:
+    db.init(postgresql.url())
+    rows = populate(vectors)
+    db.session.execute('ANALYZE')
+    db.session.commit()
+    print('{} weights of {} profiles'.format(rows, args.profiles))
+    print('{:<24}{:>12}{:>12}'.format('ranking', 'p50 ms', 'p95 ms'))
+    for ranking in db.RANKINGS:
+        measure(ranking, ranking, queries)
+    with mock.patch.object(db, 'KeywordStatistics', counted()):
+        for ranking in ('tfidf', 'bm25'):
+            measure('{}, counted'.format(ranking), ranking, queries)
+    db.session.remove()
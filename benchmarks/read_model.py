@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+"""Compares the read model with the ORM for the read-only endpoints.
+
+Each endpoint is served both by its current view in
+:mod:`oblong.server`, which uses the read model in
+:mod:`oblong.database`, and by the ORM code it replaced. CPU time is
+measured in this process only, so excludes the work of the database
+server; allocations are the peak memory traced by ``tracemalloc``
+while serving each request. The garbage collector runs between
+requests rather than during them.
+
+    $ python benchmarks/read_model.py --profiles 2000
+
+"""
+import argparse
+import gc
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import testing.postgresql
+from flask import request, url_for
+
+from corpus import synthetic_profiles
+from oblong import database as db, profiling, server
+
+parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+parser.add_argument('--profiles', type=int, default=2000)
+parser.add_argument('--publications', type=int, default=4000)
+parser.add_argument('--requests', type=int, default=200)
+parser.add_argument('--page-size', type=int, default=25)
+args = parser.parse_args()
+
+def populate(vectors, publications, rng):
+    profiles = db.Profile.__table__
+    db.session.execute(profiles.insert(), [
+        { 'title': 'Dr'
+        , 'firstname': 'First{}'.format(i)
+        , 'lastname': 'Last{}'.format(i)
+        , 'email': 'person{}@ic.ac.uk'.format(i)
+        , 'faculty': 'Faculty{}'.format(i % 5)
+        , 'department': 'Department{}'.format(i % 20)
+        , 'identity_key': db.profile_identity_key('First{}'.format(i),
+                                                  'Last{}'.format(i), None)
+        } for i in range(len(vectors))])
+    uids = [uid for uid, in db.session.execute(
+            'SELECT id FROM profile ORDER BY id')]
+    ids = db.keyword_ids({k for v in vectors for k in v})
+    db.session.execute(db.ProfileKeywordAssociation.__table__.insert(), [
+        {'left_id': uid, 'right_id': ids[k], 'weight': w}
+        for uid, vector in zip(uids, vectors) for k, w in vector.items()])
+    db.session.execute(db.Publication.__table__.insert(), [
+        { 'title': 'Paper {}'.format(i)
+        , 'abstract': 'An abstract.'
+        , 'date': '2016-01-01'
+        , 'title_key': db.publication_title_key('Paper {}'.format(i))
+        } for i in range(publications)])
+    pids = [pid for pid, in db.session.execute(
+            'SELECT id FROM publication ORDER BY id')]
+    db.session.execute(db.profile_publication_association.insert(), [
+        {'profile_id': uid, 'publication_id': pid}
+        for pid in pids for uid in rng.sample(uids, rng.randint(1, 4))])
+    db.session.commit()
+    return uids, sorted(ids)
+
+# the views as they were before the read model, for comparison
+
+def page_args():
+    return int(request.args['page']), int(request.args['page_size'])
+
+def orm_top_keywords(profile):
+    keywords = sorted(tuple(profile.keywords.items()),
+                      key=lambda p: p[1], reverse=True)[:5]
+    return tuple(zip(*keywords))[0] if keywords else ()
+
+def orm_summary(profile):
+    return { 'name': profile.name
+           , 'email': profile.email
+           , 'faculty': profile.faculty
+           , 'department': profile.department
+           , 'keywords': orm_top_keywords(profile)
+           , 'link': url_for('profile', uid=profile.id)
+           }
+
+def orm_profile(uid):
+    profile = db.Profile.get(uid)
+    result = {}
+    for attribute in ['name', 'email', 'faculty', 'department', 'campus',
+            'building', 'room', 'website']:
+        result[attribute] = getattr(profile, attribute)
+    result['keywords'] = dict(profile.keywords)
+    result['publications'] = [{ 'title': pub.title
+                              , 'link': url_for('publication', uid=pub.id)
+                              } for pub in profile.publications]
+    return json.dumps(result)
+
+def orm_people():
+    page, size = page_args()
+    query = request.args.get('query')
+    if query:
+        count, profiles = profiling.fulfill_query(query, page, size)
+    else:
+        count, profiles = (db.Profile.count(),
+                           db.Profile.get_page(page, size))
+    return json.dumps({ 'count': count
+                      , 'this_page': [orm_summary(p) for p in profiles]
+                      })
+
+def orm_keyword(keyword):
+    assoc = db.ProfileKeywordAssociation
+    profiles = (db.session.query(db.Profile, assoc.weight)
+               .join(assoc)
+               .join(db.Keyword)
+               .filter(db.Keyword.name == keyword)
+               .order_by(db.desc(assoc.weight), db.Profile.id)
+               .limit(int(request.args['limit']))
+               .all())
+    return json.dumps({ 'name': keyword
+                      , 'profiles': [{ 'name': p.name
+                                     , 'email': p.email
+                                     , 'faculty': p.faculty
+                                     , 'department': p.department
+                                     , 'weight': w
+                                     , 'link': url_for('profile', uid=p.id)
+                                     } for p, w in profiles]
+                      })
+
+def orm_publications():
+    page, size = page_args()
+    pubs = db.Publication.get_page(page, size)
+    return json.dumps({ 'count': db.Publication.count()
+                      , 'this_page': [{ 'title': pub.title
+                                      , 'date': str(pub.date)
+                                      , 'authors': [url_for('profile', uid=a.id)
+                                                    for a in pub.authors]
+                                      , 'link': url_for('publication',
+                                                        uid=pub.id)
+                                      } for pub in pubs]
+                      })
+
+def measure(requests, view):
+    """Serves each request, returning mean CPU ms and peak KiB."""
+    cpu = peak = 0
+    for path, kwargs in requests:
+        with server.app.test_request_context(path):
+            before = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            start = time.process_time()
+            view(**kwargs)
+            cpu += time.process_time() - start
+            peak += tracemalloc.get_traced_memory()[1] - before
+        db.session.remove()
+        gc.collect()
+    return 1000 * cpu / len(requests), peak / 1024 / len(requests)
+
+gc.disable()
+rng = random.Random(0)
+size = args.page_size
+n = args.requests
+with testing.postgresql.Postgresql() as postgresql:
+    db.init(postgresql.url())
+    uids, keywords = populate(synthetic_profiles(args.profiles),
+                              args.publications, rng)
+
+    def pages(path, count):
+        return [('{}?page={}&page_size={}'.format(path, rng.randrange(count),
+                                                  size), {})
+                for _ in range(n)]
+
+    profile_requests = [('/api/people/{}'.format(uid), {'uid': uid})
+                        for uid in rng.choices(uids, k=n)]
+    search_requests = [('/api/people?query={}&page=0&page_size={}'
+                        .format(k, size), {})
+                       for k in rng.choices(keywords, k=n)]
+    keyword_requests = [('/api/keywords/{}?limit={}'.format(k, size),
+                         {'keyword': k})
+                        for k in rng.choices(keywords, k=n)]
+    endpoints = [ ('profile', profile_requests, orm_profile,
+                   server.get_profile)
+                , ('people', pages('/api/people', args.profiles // size),
+                   orm_people, server.profiles)
+                , ('search', search_requests, orm_people, server.profiles)
+                , ('keyword', keyword_requests, orm_keyword, server.keyword)
+                , ('publications',
+                   pages('/api/publications', args.publications // size),
+                   orm_publications, server.publications)
+                ]
+
+    tracemalloc.start()
+    print('{:<14}{:>10}{:>10}{:>12}{:>12}'.format(
+            'endpoint', 'ORM ms', 'rows ms', 'ORM KiB', 'rows KiB'))
+    for name, requests, orm, rows in endpoints:
+        measure(requests[:10], orm)
+        measure(requests[:10], rows)
+        orm_cpu, orm_mem = measure(requests, orm)
+        rows_cpu, rows_mem = measure(requests, rows)
+        print('{:<14}{:>10.2f}{:>10.2f}{:>12.1f}{:>12.1f}'.format(
+                name, orm_cpu, rows_cpu, orm_mem, rows_mem))
+    tracemalloc.stop()
+    db.session.remove()
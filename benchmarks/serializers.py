@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""Times the serialisation of a page of people.
+
+A page of ``--profiles`` summaries, as ``/api/people`` returns them, is
+serialised the way the views used to, routing every link through
+``url_for`` and encoding with ``json.dumps``, and then with
+:mod:`oblong.serializers`, with ``orjson`` if it is installed and
+without it. No database is needed.
+
+    $ python benchmarks/serializers.py --profiles 1000
+
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from flask import url_for
+
+from corpus import synthetic_profiles
+from oblong import database as db, serializers, server
+
+parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+parser.add_argument('--profiles', type=int, default=1000)
+parser.add_argument('--repeat', type=int, default=50)
+args = parser.parse_args()
+
+vectors = synthetic_profiles(args.profiles)
+profiles = [db.SummaryRow(uid, 'Dr', 'First{}'.format(uid),
+                          'Last{}'.format(uid), 'F L', None,
+                          'person{}@ic.ac.uk'.format(uid),
+                          'Faculty{}'.format(uid % 5),
+                          'Department{}'.format(uid % 20),
+                          sorted(v, key=v.get, reverse=True)
+                          [:db.SUMMARY_KEYWORDS])
+            for uid, v in enumerate(vectors, 1)]
+
+def url_for_page():
+    page = [{ 'name': profile.name
+            , 'email': profile.email
+            , 'faculty': profile.faculty
+            , 'department': profile.department
+            , 'keywords': profile.top_keywords
+            , 'link': url_for('profile', uid=profile.id)
+            } for profile in profiles]
+    return json.dumps({'count': len(page), 'this_page': page})
+
+def serializers_page():
+    page = serializers.summaries(profiles, server.links)
+    return serializers.dumps({'count': len(page), 'this_page': page})
+
+def measure(f):
+    f()
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        f()
+    return 1000 * (time.perf_counter() - start) / args.repeat
+
+with server.app.test_request_context('/api/people'):
+    results = [('url_for + json', measure(url_for_page))]
+    with mock.patch.object(serializers, 'orjson', None):
+        results.append(('templates + json', measure(serializers_page)))
+    if serializers.orjson is not None:
+        results.append(('templates + orjson', measure(serializers_page)))
+
+print('{} profiles per page'.format(args.profiles))
+for name, ms in results:
+    print('{:<20}{:>8.2f} ms'.format(name, ms))
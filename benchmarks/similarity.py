@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+"""Measures the recall and speed of :mod:`oblong.similarity`.
+
+Recall@k is the fraction of each profile's true k nearest neighbours,
+found by exhaustive cosine similarity, that the index also returns.
+
+    $ python benchmarks/similarity.py --profiles 5000
+
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from corpus import synthetic_profiles
+from oblong.similarity import SimilarityIndex
+
+parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+parser.add_argument('--profiles', type=int, default=5000)
+parser.add_argument('--queries', type=int, default=200)
+parser.add_argument('--bands', type=int, default=32)
+parser.add_argument('--rows', type=int, default=8)
+parser.add_argument('-k', type=int, default=10)
+args = parser.parse_args()
+
+vectors = synthetic_profiles(args.profiles)
+index = SimilarityIndex(bands=args.bands, rows=args.rows, exact_below=0)
+
+start = time.perf_counter()
+for uid, vector in enumerate(vectors):
+    index.update(uid, vector)
+build = time.perf_counter() - start
+
+queries = range(0, args.profiles, max(1, args.profiles // args.queries))
+found = total = candidates = 0
+query_time = exact_time = 0
+for uid in queries:
+    start = time.perf_counter()
+    approx = index.similar(uid, args.k)
+    query_time += time.perf_counter() - start
+    candidates += len(index.candidates(uid))
+
+    start = time.perf_counter()
+    exact = sorted(((index.cosine(uid, other), other)
+                    for other in range(args.profiles) if other != uid),
+                   reverse=True)[:args.k]
+    exact_time += time.perf_counter() - start
+
+    found += len({o for o, _ in approx} & {o for _, o in exact})
+    total += len(exact)
+
+n = len(queries)
+print('profiles:           {}'.format(args.profiles))
+print('bands x rows:       {} x {}'.format(args.bands, args.rows))
+print('build:              {:.2f} s'.format(build))
+print('recall@{}:          {:.3f}'.format(args.k, found / total))
+print('candidates/query:   {:.0f} ({:.1%})'.format(candidates / n,
+                                                  candidates / n / args.profiles))
+print('query (index):      {:.2f} ms'.format(1000 * query_time / n))
+print('query (exhaustive): {:.2f} ms'.format(1000 * exact_time / n))
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 """Handles command line argument parsing and environment variables."""
 import argparse
+import json
 import logging
 import os
 
@@ -8,8 +9,25 @@ import oblong
 
 HEROKU_PORT = int(os.getenv('PORT', 5000))
 DB_URL = os.getenv("DATABASE_URL")
+REPLICA_URLS = os.getenv("DATABASE_REPLICA_URLS", "").split()
+# buffer the keyword weights of new papers; see oblong.profiling.WriteBehind
+WRITE_BEHIND = os.getenv("WRITE_BEHIND", "").lower() in ("1", "true", "yes")
+WRITE_BEHIND_JOURNAL = os.getenv("WRITE_BEHIND_JOURNAL")
+# halve keyword weights every so many years; see oblong.profiling.TIME_DECAY
+TIME_DECAY_HALF_LIFE = os.getenv("TIME_DECAY_HALF_LIFE")
+# seconds between sweeps for keywords no profile has; see
+# oblong.profiling.KeywordSweeper
+KEYWORD_SWEEP_INTERVAL = os.getenv("KEYWORD_SWEEP_INTERVAL")
+# hash partition keyword weights by profile; see
+# oblong.migrations.partition_keyword_weights
+KEYWORD_PARTITIONS = int(os.getenv("KEYWORD_PARTITIONS", 0))
+# rank searches by weight, tfidf or bm25; see oblong.database.SEARCH_RANKING
+SEARCH_RANKING = os.getenv("SEARCH_RANKING")
+# per-route limits as JSON, e.g. {"search": {"concurrency": 4}}; see
+# oblong.admission
+ADMISSION_LIMITS = os.getenv("ADMISSION_LIMITS")
 print("Connecting to DB: ", DB_URL)
-oblong.init(DB_URL)
+oblong.init(DB_URL, REPLICA_URLS, keyword_partitions=KEYWORD_PARTITIONS)
 
 parser = argparse.ArgumentParser(description='Oblong eexpertise mining.')
 parser.add_argument('--host', metavar='IP', default='localhost',
@@ -28,5 +46,26 @@ if args.log_file:
     kwargs['filename'] = args.log_file
 logging.basicConfig(**kwargs)
 
+if ADMISSION_LIMITS:
+    oblong.app.config['ADMISSION_LIMITS'].update(json.loads(ADMISSION_LIMITS))
+
+if SEARCH_RANKING:
+    oblong.database.SEARCH_RANKING = SEARCH_RANKING
+
+if TIME_DECAY_HALF_LIFE:
+    oblong.profiling.TIME_DECAY = oblong.profiling.ExponentialDecay(
+            float(TIME_DECAY_HALF_LIFE))
+
+# keep the in-memory indexes up to date with other processes' writes,
+# such as other workers or an ingest; see oblong.database.ChangeListener
+oblong.database.enable_change_listener()
+
+if KEYWORD_SWEEP_INTERVAL:
+    oblong.profiling.enable_keyword_sweeper(
+            interval=float(KEYWORD_SWEEP_INTERVAL))
+
+if WRITE_BEHIND or WRITE_BEHIND_JOURNAL:
+    oblong.profiling.enable_write_behind(journal=WRITE_BEHIND_JOURNAL)
+
 if __name__ == '__main__':
     oblong.run(host=args.host, port=args.port)
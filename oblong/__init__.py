@@ -17,8 +17,9 @@ __status__ = 'Development'
 from .database import init as db_init
 from .server import app
 
-def init(database_url):
-    db_init(database_url)
+def init(database_url, replica_urls=None, keyword_partitions=None):
+    db_init(database_url, replica_urls,
+            keyword_partitions=keyword_partitions)
 
 def run(*args, **kwargs):
     app.run(*args, **kwargs)
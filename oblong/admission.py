@@ -0,0 +1,199 @@
+"""Admission control for expensive endpoints.
+
+Each expensive view is given a named :class:`Limiter`, which bounds
+how many requests it serves at once. Requests over the limit wait in a
+bounded queue; once the queue is full, or a request has waited too
+long, it is turned away at once with ``503 Service Unavailable`` and a
+``Retry-After`` header, so that a spike of searches can't take every
+worker and database connection from the cheap endpoints. An admitted
+request is also given a deadline, which
+:func:`oblong.database.set_deadline` enforces in Postgres; a request
+that misses it gets a 503 too.
+
+The limits are read from the ``ADMISSION_LIMITS`` config value, a
+mapping from limiter name to the arguments of :class:`Limiter`.
+Limiters without an entry use the defaults.
+
+Examples:
+    >>> from flask import Flask
+    >>> app = Flask(__name__)
+    >>> init_app(app)
+    >>> @app.route('/search')
+    ... @limited('search')
+    ... def search():
+    ...     return 'results'
+    >>> app.config['ADMISSION_LIMITS']['search'] = {'concurrency': 4}
+
+"""
+from functools import wraps
+import threading
+import time
+
+from flask import current_app
+
+from . import database as db
+from . import serializers
+
+SERVICE_UNAVAILABLE = 503
+
+class Limiter:
+    """Bounds the number of requests served at once.
+
+    Args:
+        concurrency (int): The most requests served at once.
+        queue (int): The most requests waiting to be served.
+        queue_timeout (float): The longest a request waits, in seconds.
+        deadline (Optional[float]): The longest a request may take,
+            including its wait, in seconds; ``None`` for no limit.
+        retry_after (int): The seconds rejected clients are asked to
+            wait before trying again.
+
+    Attributes:
+        admitted (int): The number of requests served.
+        rejected (int): The number turned away, because the queue was
+            full or they waited too long.
+        timed_out (int): The number of admitted requests that missed
+            their deadline.
+
+    """
+    def __init__(self, concurrency=8, queue=16, queue_timeout=1.,
+                 deadline=10., retry_after=1):
+        self.concurrency = concurrency
+        self.queue = queue
+        self.queue_timeout = queue_timeout
+        self.deadline = deadline
+        self.retry_after = retry_after
+        self.running = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self._ready = threading.Condition()
+
+    def acquire(self):
+        """Waits for a turn to serve a request.
+
+        Returns:
+            (bool): Whether the request was admitted. If so,
+            :meth:`release` must be called once it is served.
+
+        """
+        with self._ready:
+            if self.running >= self.concurrency:
+                if self.waiting >= self.queue:
+                    self.rejected += 1
+                    return False
+                self.waiting += 1
+                try:
+                    admitted = self._ready.wait_for(
+                            lambda: self.running < self.concurrency,
+                            self.queue_timeout)
+                finally:
+                    self.waiting -= 1
+                if not admitted:
+                    self.rejected += 1
+                    return False
+            self.running += 1
+            self.admitted += 1
+            return True
+
+    def release(self):
+        """Ends a turn started by :meth:`acquire`."""
+        with self._ready:
+            self.running -= 1
+            self._ready.notify()
+
+    def timeout(self):
+        """Counts a request that missed its deadline."""
+        with self._ready:
+            self.timed_out += 1
+
+    def stats(self):
+        """The limiter's counters, as a JSON-serialisable dict."""
+        with self._ready:
+            return { 'running': self.running
+                   , 'waiting': self.waiting
+                   , 'admitted': self.admitted
+                   , 'rejected': self.rejected
+                   , 'timed_out': self.timed_out
+                   }
+
+#: The limiters of each app, by name.
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+def limiter(name, app=None):
+    """Gets the named limiter of an app, creating it from its config.
+
+    Args:
+        name (str): The name of the limiter.
+        app (Optional[flask.Flask]): The app. Defaults to the current
+            app.
+
+    """
+    app = app or current_app._get_current_object()
+    with _limiters_lock:
+        key = (app, name)
+        if key not in _limiters:
+            config = app.config['ADMISSION_LIMITS'].get(name, {})
+            _limiters[key] = Limiter(**config)
+        return _limiters[key]
+
+def stats(app=None):
+    """The counters of every limiter of an app, by name."""
+    app = app or current_app._get_current_object()
+    with _limiters_lock:
+        limiters = [(name, l) for (a, name), l in _limiters.items()
+                    if a is app]
+    return {name: l.stats() for name, l in sorted(limiters)}
+
+def unavailable(message, retry_after):
+    """A 503 response asking the client to retry later."""
+    response = current_app.make_response((serializers.dumps(
+            { 'error_code': SERVICE_UNAVAILABLE
+            , 'message': message
+            }), SERVICE_UNAVAILABLE))
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
+def limited(name, when=None):
+    """Serves a view through the named :class:`Limiter`.
+
+    Args:
+        name (str): The limiter to use. Views may share one.
+        when (Optional[Callable[[], bool]]): Whether to limit this
+            request, for views that are only sometimes expensive.
+            Defaults to always.
+
+    """
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            if when is not None and not when():
+                return f(*args, **kwargs)
+            l = limiter(name)
+            arrived = time.monotonic()
+            if not l.acquire():
+                return unavailable('Too many requests; try again later.',
+                                   l.retry_after)
+            try:
+                if l.deadline is not None:
+                    db.set_deadline(arrived + l.deadline)
+                return f(*args, **kwargs)
+            except (db.DeadlineExceeded, db.DBAPIError) as e:
+                if not (isinstance(e, db.DeadlineExceeded)
+                        or db.is_timeout(e)):
+                    raise
+                db.session.rollback()
+                l.timeout()
+                return unavailable('The request took too long.',
+                                   l.retry_after)
+            finally:
+                db.set_deadline(None)
+                l.release()
+        return wrapper
+    return decorator
+
+def init_app(app):
+    """Sets the default config of :func:`limited` views."""
+    app.config.setdefault('ADMISSION_LIMITS', {})
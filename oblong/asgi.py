@@ -0,0 +1,387 @@
+"""An asynchronous ASGI server for the read-only endpoints.
+
+The Flask app in :mod:`oblong.server` ties up a worker thread for as
+long as each of its database queries runs. Here the same endpoints are
+served from an event loop, over SQLAlchemy's asyncio extension and
+``asyncpg``, so a single process can hold thousands of connections
+open while their queries run. The statements are those of the read
+model in :mod:`oblong.database`, run through
+:meth:`~sqlalchemy.ext.asyncio.AsyncConnection.run_sync`; the responses
+are those of :mod:`oblong.server`. Keyword extraction with NLTK, which
+is CPU-bound, runs in a pool of processes.
+
+Writes, and the endpoints not listed in :data:`routes`, are still
+served by :mod:`oblong.server`; a proxy in front of both should send
+the read endpoints here. This needs the ``asgi`` extra and Python 3.7
+or later, so it can't run on the Python 3.5 runtime of the Flask app
+(see ``runtime.txt``); deploy it separately::
+
+    $ pip install oblong[asgi]
+    $ DATABASE_URL=postgresql://... uvicorn oblong.asgi:app
+
+On older versions of Python the extra installs nothing.
+
+The number of NLTK processes is read from ``$NLTK_WORKERS``, and
+defaults to the CPU count. The in-memory indexes are kept up to date
+with the Flask app's writes by an
+:class:`oblong.database.ChangeListener`.
+
+"""
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import asynccontextmanager
+import os
+
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.ext.asyncio import create_async_engine
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.middleware.gzip import GZipMiddleware
+from starlette.responses import Response
+from starlette.routing import Route
+
+from . import database as db
+from . import postings
+from . import profiling
+from . import serializers
+from . import server
+from .vocabulary import vocabulary
+
+#: The asynchronous engine, set by :func:`init`.
+engine = None
+#: Runs :func:`oblong.profiling.get_keywords`, set by :func:`init`.
+nltk_pool = None
+
+#: The number of calls to :func:`search`.
+calls = 0
+#: The number of those that shared another call's search.
+coalesced = 0
+_searches = {}
+
+def async_url(url):
+    """The url of a database, with its driver replaced by ``asyncpg``."""
+    url = make_url(url)
+    return url.set(drivername=url.get_backend_name() + '+asyncpg')
+
+def init(database_url, nltk_workers=None):
+    """Connects to the database and starts the NLTK processes.
+
+    :func:`oblong.database.init` is called too, since the in-memory
+    indexes of :mod:`oblong.vocabulary` and :mod:`oblong.postings` are
+    loaded through its session.
+
+    Args:
+        database_url (str): The url of the database, as for
+            :func:`oblong.database.init`.
+        nltk_workers (Optional[int]): The number of processes to
+            extract keywords in. Defaults to the CPU count.
+
+    """
+    global engine, nltk_pool
+    db.init(database_url, migrate=False)
+    engine = create_async_engine(async_url(database_url), pool_size=20)
+    nltk_pool = ProcessPoolExecutor(nltk_workers)
+
+async def read(f, *args, **kwargs):
+    """Calls a function of the read model on a pooled connection.
+
+    Args:
+        f (Callable): A function taking a ``bind`` keyword argument,
+            such as :func:`oblong.database.read_profile`.
+        *args: Passed to ``f``.
+        **kwargs: Passed to ``f``.
+
+    """
+    async with engine.connect() as connection:
+        return await connection.run_sync(
+                lambda bind: f(*args, bind=bind, **kwargs))
+
+async def query_keywords(text):
+    """Like :func:`oblong.profiling.query_keywords`, off the event loop."""
+    return (vocabulary.find(text)
+            or await asyncio.get_running_loop().run_in_executor(
+                    nltk_pool, profiling.get_keywords, text))
+
+async def search(text, page_no, page_size):
+    """Like :func:`oblong.profiling.fulfill_query_ids`.
+
+    Identical searches made while one is running share its result, as
+    :data:`oblong.profiling.searches` does for threads; they are
+    counted by :data:`calls` and :data:`coalesced`.
+
+    Raises:
+        oblong.postings.QueryError: If a boolean query is malformed.
+
+    """
+    global calls, coalesced
+    key = (profiling.normalise_query(text), page_no, page_size)
+    calls += 1
+    if key in _searches:
+        coalesced += 1
+        n, uids = await asyncio.shield(_searches[key])
+        return n, list(uids)
+    future = _searches[key] = asyncio.ensure_future(_search(*key))
+    try:
+        n, uids = await asyncio.shield(future)
+    finally:
+        del _searches[key]
+    return n, list(uids)
+
+async def _search(text, page_no, page_size):
+    loop = asyncio.get_running_loop()
+    if postings.is_boolean(text):
+        # the bitmap index is in memory, but may need NLTK to resolve
+        # terms it doesn't know; both would block the loop
+        return await loop.run_in_executor(None, _boolean_search,
+                                          text, page_no, page_size)
+    keywords = await query_keywords(text)
+    if not keywords:
+        return 0, ()
+    n, results = await read(db.search_profiles, keywords, page_no, page_size)
+    return n, tuple(uid for uid, _ in results)
+
+def _boolean_search(text, page_no, page_size):
+    try:
+        n, results = postings.profiles.search(text, page_no, page_size,
+                resolve=profiling.query_keywords)
+        return n, tuple(uid for uid, _ in results)
+    finally:
+        db.session.remove()
+
+# ------------ RESPONSES -----------------
+
+_links = server.app.url_map.bind('')
+
+def url_for(endpoint, **values):
+    """Like :func:`flask.url_for`, for the endpoints of ``server.app``."""
+    return _links.build(endpoint, values)
+
+def respond(result, status=server.OKAY):
+    return Response(serializers.dumps(result), status,
+                    media_type='application/json')
+
+def error_message(code, message):
+    return respond({'error_code': code, 'message': message}, code)
+
+def not_found():
+    return error_message(server.NOT_FOUND, 'Not found.')
+
+def summaries(profiles):
+    """Like :func:`oblong.server.summaries`."""
+    return serializers.summaries(profiles, server.links)
+
+def page_args(request):
+    """Reads the ``page`` and ``page_size`` of a request.
+
+    Raises:
+        ValueError: If either is not an integer.
+
+    """
+    return (int(request.query_params.get('page', 0)),
+            int(request.query_params.get('page_size',
+                                         server.DEFAULT_PAGE_SIZE)))
+
+def _profile_page(page_no, page_size, bind):
+    count = db.read_count(db.Profile, bind=bind)
+    return count, db.read_summary_page(page_no, page_size, bind=bind)
+
+# ------------ ROUTES -----------------
+
+async def profiles(request):
+    """``GET /api/people``, see :func:`oblong.server.profiles`."""
+    try:
+        query = request.query_params.get('query', '')
+        page, size = page_args(request)
+    except ValueError:
+        return error_message(server.BAD_REQUEST,
+                             'page and page_size must be uint')
+
+    if query:
+        try:
+            count, uids = await search(query, page, size)
+        except postings.QueryError as e:
+            return error_message(server.BAD_REQUEST, str(e))
+        people = await read(db.read_summaries, uids)
+    else:
+        count, people = await read(_profile_page, page, size)
+
+    if not count:
+        return respond({'count': count})
+    result = {'count': count}
+    kwargs = {'page_size': size}
+    if query:
+        kwargs['query'] = query
+    if page > 0:
+        result['previous_page'] = url_for('profiles', page=page - 1, **kwargs)
+    if (page + 1) * size < count:
+        result['next_page'] = url_for('profiles', page=page + 1, **kwargs)
+    result['this_page'] = summaries(people)
+    return respond(result)
+
+async def queries(request):
+    """``POST /api/queries``, see :func:`oblong.server.queries`."""
+    try:
+        page, size = page_args(request)
+    except ValueError:
+        return error_message(server.BAD_REQUEST,
+                             'page and page_size must be uint')
+    text = (await request.body()).decode('utf-8')
+    try:
+        _, uids = await search(text, page, size)
+    except postings.QueryError as e:
+        return error_message(server.BAD_REQUEST, str(e))
+    people = await read(db.read_summaries, uids)
+    return respond(summaries(people))
+
+def _full_profile(uid, fields, keywords_limit, publications_limit, bind):
+    profile = db.read_profile(uid, bind=bind)
+    if profile is None:
+        return None
+    result = {}
+    for attribute in fields:
+        if attribute not in ('keywords', 'publications'):
+            result[attribute] = getattr(profile, attribute)
+    if 'keywords' in fields:
+        keywords = db.read_keywords([uid], keywords_limit, bind=bind)
+        result['keywords'] = dict(keywords.get(uid, ()))
+    if 'publications' in fields:
+        publications = db.read_publications_of(uid, publications_limit,
+                                               bind=bind)
+        result['publications'] = serializers.publication_links(
+                publications, server.links)
+    return result
+
+def optional_uint(request, name):
+    """Like :func:`oblong.server.optional_uint`."""
+    value = request.query_params.get(name)
+    if value is None:
+        return None
+    value = int(value)
+    if value < 0:
+        raise ValueError(name)
+    return value
+
+async def profile(request):
+    """``GET /api/people/<uid>``, see :func:`oblong.server.get_profile`."""
+    try:
+        fields = request.query_params.get('fields')
+        fields = fields.split(',') if fields else server.PROFILE_FIELDS
+        keywords_limit = optional_uint(request, 'keywords_limit')
+        publications_limit = optional_uint(request, 'publications_limit')
+    except ValueError:
+        return error_message(server.BAD_REQUEST,
+                'keywords_limit and publications_limit must be uint')
+    unknown = [f for f in fields if f not in server.PROFILE_FIELDS]
+    if unknown:
+        return error_message(server.BAD_REQUEST,
+                'unknown fields: {}'.format(', '.join(unknown)))
+
+    result = await read(_full_profile, request.path_params['uid'], fields,
+                        keywords_limit, publications_limit)
+    return respond(result) if result is not None else not_found()
+
+async def keyword(request):
+    """``GET /api/keywords/<keyword>``, see :func:`oblong.server.keyword`."""
+    name = request.path_params['keyword']
+    try:
+        limit = optional_uint(request, 'limit')
+        page = optional_uint(request, 'page') or 0
+        if limit == 0:
+            raise ValueError('limit')
+    except ValueError:
+        return error_message(server.BAD_REQUEST, 'page and limit must be uint')
+    if limit is None:
+        limit = db.KEYWORD_PAGE_SIZE
+
+    people = await read(db.read_profiles_by_keyword, name, page, limit)
+    if people is None:
+        return not_found()
+    return respond({ 'name': name
+                   , 'profiles': serializers.weighted_profiles(people,
+                                                               server.links)
+                   })
+
+def _publication_page(page_no, page_size, bind):
+    count = db.read_count(db.Publication, bind=bind)
+    pubs = db.read_publication_page(page_no, page_size, bind=bind)
+    return count, pubs, db.read_authors([p.id for p in pubs], bind=bind)
+
+async def publications(request):
+    """``GET /api/publications``, see :func:`oblong.server.publications`."""
+    try:
+        page, size = page_args(request)
+    except ValueError:
+        return error_message(server.BAD_REQUEST,
+                             'page and page_size must be uint')
+
+    count, pubs, authors = await read(_publication_page, page, size)
+    if not count:
+        return respond({'count': count})
+    result = {'count': count}
+    if page > 0:
+        result['previous_page'] = url_for('publications', page=page - 1,
+                                          page_size=size)
+    if (page + 1) * size < count:
+        result['next_page'] = url_for('publications', page=page + 1,
+                                      page_size=size)
+    result['this_page'] = serializers.publication_summaries(
+            pubs, authors, server.links)
+    return respond(result)
+
+def _publication(uid, bind):
+    pub = db.read_publication(uid, bind=bind)
+    if pub is None:
+        return None
+    authors = db.read_authors([uid], bind=bind).get(uid, [])
+    return pub, db.read_summaries(authors, bind=bind)
+
+async def publication(request):
+    """``GET /api/publications/<uid>``, see
+    :func:`oblong.server.publication`."""
+    found = await read(_publication, request.path_params['uid'])
+    if found is None:
+        return not_found()
+    pub, authors = found
+    return respond({ 'title': pub.title
+                   , 'abstract': pub.abstract
+                   , 'date': str(pub.date)
+                   , 'authors': summaries(authors)
+                   })
+
+#: The endpoints served here.
+routes = [ Route('/api/people', profiles)
+         , Route('/api/queries', queries, methods=['POST'])
+         , Route('/api/people/{uid:int}', profile)
+         , Route('/api/keywords/{keyword}', keyword)
+         , Route('/api/publications', publications)
+         , Route('/api/publications/{uid:int}', publication)
+         ]
+
+def _load_vocabulary():
+    try:
+        vocabulary.find('')
+    finally:
+        db.session.remove()
+
+@asynccontextmanager
+async def lifespan(app):
+    """Runs :func:`init` from the environment for the life of the app."""
+    workers = os.getenv('NLTK_WORKERS')
+    init(os.environ['DATABASE_URL'], int(workers) if workers else None)
+    # every write comes from another process
+    db.enable_change_listener()
+    # load the vocabulary before the first search needs it
+    await asyncio.get_running_loop().run_in_executor(None, _load_vocabulary)
+    try:
+        yield
+    finally:
+        db.disable_change_listener()
+        nltk_pool.shutdown()
+        await engine.dispose()
+
+app = Starlette(routes=routes,
+                middleware=[ Middleware(CORSMiddleware, allow_origins=['*'])
+                           , Middleware(GZipMiddleware, minimum_size=1024)
+                           ],
+                lifespan=lifespan)
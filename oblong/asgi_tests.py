@@ -0,0 +1,77 @@
+import json
+import os
+import unittest
+from unittest import mock
+
+from sqlalchemy.pool import NullPool
+from . import database as db
+from .server_tests import ServerTestCase
+
+try:
+    from sqlalchemy.ext.asyncio import create_async_engine
+    from starlette.testclient import TestClient
+    from . import asgi
+except ImportError:
+    asgi = None
+
+@unittest.skipIf(asgi is None, 'the asgi extra is not installed')
+class AsgiTestCase(ServerTestCase):
+    """Checks that the ASGI app answers as the Flask app does."""
+    def setUp(self):
+        super().setUp()
+        asgi.init(self.postgresql.url(), nltk_workers=1)
+        self.addCleanup(asgi.nltk_pool.shutdown)
+        # each request of the test client runs in its own event loop,
+        # which pooled connections can't outlive
+        asgi.engine = create_async_engine(
+                asgi.async_url(self.postgresql.url()), poolclass=NullPool)
+        self.client = TestClient(asgi.app)
+
+    def assertSame(self, path, method='get', **kwargs):
+        expected = getattr(self.app, method)(path, **kwargs)
+        actual = getattr(self.client, method)(path, **kwargs)
+        self.assertEqual(actual.status_code, expected.status_code, path)
+        if expected.status_code == 200:
+            self.assertEqual( json.loads(actual.content.decode('utf-8'))
+                            , json.loads(expected.data.decode('utf-8'))
+                            , path
+                            )
+        return actual
+
+    def testPeople(self):
+        self.assertSame('/api/people')
+        self.assertSame('/api/people?page=1&page_size=1')
+        self.assertSame('/api/people?page=x')
+
+    def testSearch(self):
+        self.assertSame('/api/people?query=argumentation')
+        self.assertSame('/api/people?query=bad%20keyword')
+        self.assertSame('/api/people?query=argumentation%20AND%20'
+                        'machine%20learning')
+        self.assertSame('/api/queries', method='post', data='argumentation')
+
+    def testProfile(self):
+        self.assertSame('/api/people/{}'.format(self.john.id))
+        self.assertSame('/api/people/{}?fields=email,keywords'
+                        '&keywords_limit=1'.format(self.john.id))
+        self.assertSame('/api/people/1000')
+        self.assertSame('/api/people/1?fields=password')
+
+    def testKeyword(self):
+        self.assertSame('/api/keywords/argumentation')
+        self.assertSame('/api/keywords/argumentation?limit=1&page=1')
+        self.assertSame('/api/keywords/unicorn')
+        self.assertSame('/api/keywords/argumentation?page=-1')
+        self.assertSame('/api/keywords/argumentation?limit=-5')
+
+    def testPublications(self):
+        self.assertSame('/api/publications?page_size=1')
+        self.assertSame('/api/publications/{}'.format(self.paper0.id))
+        self.assertSame('/api/publications/1000')
+
+    def testLifespanListens(self):
+        with mock.patch.dict(os.environ,
+                             DATABASE_URL=self.postgresql.url()):
+            with TestClient(asgi.app):
+                self.assertIsNotNone(db.change_listener)
+        self.assertIsNone(db.change_listener)
@@ -0,0 +1,277 @@
+"""Command line tools for maintaining an Oblong database.
+
+Examples:
+    Recompute every profile after changing the keyword extraction::
+
+        $ oblong rebuild-profiles --checkpoint rebuild.ckpt
+
+    See what a rebuild would change, without changing anything::
+
+        $ oblong rebuild-profiles --dry-run
+
+    Load papers from a file of newline-delimited JSON, resuming from
+    where a failed run stopped::
+
+        $ oblong ingest papers.ndjson --checkpoint ingest.ckpt
+
+    Bring keyword weights up to date as papers age, using a decay
+    curve that halves the weight of a paper every ten years::
+
+        $ oblong age-profiles --half-life 10
+
+    Remove garbage keywords from every profile, and then any keywords
+    no profile has any more::
+
+        $ oblong purge-keywords "et al" --pattern "%http%"
+        $ oblong sweep-keywords
+
+    Copy a database to another, whose schema is up to date::
+
+        $ oblong export dump --compress gzip
+        $ oblong --database-url $OTHER_URL import dump
+
+    Reload the ontology closure table after changing the ontology::
+
+        $ oblong load-ontology
+
+    Split the keyword weights of a large database into 16 partitions::
+
+        $ oblong partition-keywords 16
+
+    Check that every profile's summary matches its keywords, and
+    repair any that don't::
+
+        $ oblong check-summaries --repair
+
+    Recount the statistics that searches rank keywords by, should they
+    ever disagree with the keyword weights::
+
+        $ oblong rebuild-statistics
+
+    Bring the schema of a database up to date::
+
+        $ oblong migrate
+
+    Other commands do this too, before they start.
+
+The database to use is taken from ``--database-url``, or from the
+``DATABASE_URL`` environment variable.
+
+"""
+import argparse
+import logging
+import os
+import sys
+import time
+
+from . import database as db
+
+def rebuild_profiles(args):
+    from .rebuild import rebuild_profiles
+    report = rebuild_profiles(workers=args.workers,
+                              batch_size=args.batch_size,
+                              checkpoint=args.checkpoint,
+                              dry_run=args.dry_run)
+    print('{} publications by {} authors processed.'
+          .format(report.publications, report.profiles))
+    print('{} {} keyword weights added, {} removed and {} changed.'
+          .format('Would have' if args.dry_run else 'Done:',
+                  report.added, report.removed, report.changed))
+
+def ingest_papers(args):
+    from .ingest import ingest
+    report = ingest(args.file, workers=args.workers,
+                    batch_size=args.batch_size,
+                    checkpoint=args.checkpoint,
+                    queue_size=args.queue_size,
+                    out=sys.stderr)
+    print('{} papers stored, {} skipped.'.format(report.papers,
+                                                 report.skipped))
+
+def age_profiles(args):
+    from . import profiling
+    if args.half_life:
+        profiling.TIME_DECAY = profiling.ExponentialDecay(args.half_life)
+    updated = profiling.age_profiles()
+    print('Reweighed {} keyword weights.'.format(updated))
+
+def purge_keywords(args):
+    from .profiling import purge_keywords
+    report = purge_keywords(args.keywords, args.pattern)
+    print('Removed {} keywords and {} weights from {} profiles in {:.3f}s.'
+          .format(*report))
+
+def sweep_keywords(args):
+    from .profiling import sweep_keywords
+    report = sweep_keywords(args.batch_size)
+    print('Removed {} orphaned keywords in {:.3f}s.'
+          .format(report.keywords, report.seconds))
+
+def export_database(args):
+    from .dump import export_database
+    report = export_database(args.directory, fmt=args.format,
+                             compression=args.compress)
+    print('Exported {} rows of {} tables, {:.1f} MB in {:.1f}s.'
+          .format(report.rows, report.tables, report.bytes / 1e6,
+                  report.seconds))
+
+def import_database(args):
+    from .dump import import_database
+    report = import_database(args.directory)
+    print('Imported {} rows of {} tables, {:.1f} MB in {:.1f}s.'
+          .format(report.rows, report.tables, report.bytes / 1e6,
+                  report.seconds))
+
+def load_ontology(args):
+    from .profiling import load_ontology_closure, ontology_closure
+    load_ontology_closure()
+    db.session.commit()
+    print('Loaded {} ancestor links.'.format(len(ontology_closure())))
+
+def migrate_schema(args):
+    from .migrations import upgrade, current_version
+    applied = upgrade(db.engine, target=args.target)
+    if not applied:
+        print('Already at version {}.'.format(current_version(db.engine)))
+    for version in applied:
+        print('Applied migration {}.'.format(version))
+
+def partition_keywords(args):
+    from .migrations import partition_keyword_weights
+    if partition_keyword_weights(db.engine, args.partitions):
+        print('Partitioned keyword weights into {} partitions.'
+              .format(args.partitions))
+    else:
+        print('Already in {} partitions.'.format(args.partitions))
+
+def check_summaries(args):
+    drifted = db.drifted_summaries()
+    if not drifted:
+        print('Every summary is up to date.')
+        return
+    if args.repair:
+        db.refresh_summaries(drifted)
+        db.session.commit()
+    print('{} {} out of date summaries.'
+          .format('Repaired' if args.repair else 'Found', len(drifted)))
+    if not args.repair:
+        sys.exit(1)
+
+def rebuild_statistics(args):
+    start = time.perf_counter()
+    keywords = db.rebuild_keyword_statistics()
+    db.session.commit()
+    print('Recounted the statistics of {} keywords in {:.3f}s.'
+          .format(keywords, time.perf_counter() - start))
+
+parser = argparse.ArgumentParser(prog='oblong',
+        description='Maintains the Oblong expertise database.')
+parser.add_argument('--database-url', metavar='URL',
+        default=os.getenv('DATABASE_URL'),
+        help='The database to connect to. Defaults to $DATABASE_URL.')
+parser.add_argument('--log-level', default='info',
+        choices=['critical', 'error', 'warning', 'info', 'debug'],
+        help='The minimum level for displayed log messages.')
+commands = parser.add_subparsers(metavar='COMMAND')
+commands.required = True
+
+rebuild = commands.add_parser('rebuild-profiles',
+        help='Recompute every profile from its publications.')
+rebuild.add_argument('--workers', metavar='N', type=int,
+        help='The number of worker processes. Defaults to the CPU count.')
+rebuild.add_argument('--batch-size', metavar='N', type=int, default=500,
+        help='The number of publications given to the workers at once.')
+rebuild.add_argument('--checkpoint', metavar='FILE',
+        help='Save progress to FILE, and resume from it if it exists.')
+rebuild.add_argument('--dry-run', action='store_true',
+        help="Report how many weights would change, but don't change them.")
+rebuild.set_defaults(func=rebuild_profiles)
+
+ingest = commands.add_parser('ingest',
+        help='Load papers from a file of newline-delimited JSON.')
+ingest.add_argument('file', metavar='FILE',
+        help='The file to read, or - for standard input.')
+ingest.add_argument('--workers', metavar='N', type=int,
+        help='The number of worker processes. Defaults to the CPU count.')
+ingest.add_argument('--batch-size', metavar='N', type=int, default=500,
+        help='The number of papers stored per transaction.')
+ingest.add_argument('--queue-size', metavar='N', type=int, default=1000,
+        help='The most papers read ahead of those stored.')
+ingest.add_argument('--checkpoint', metavar='FILE',
+        help='Save progress to FILE, and resume from it if it exists.')
+ingest.set_defaults(func=ingest_papers)
+
+age = commands.add_parser('age-profiles',
+        help='Reweigh every keyword for the age of its papers.')
+age.add_argument('--half-life', metavar='YEARS', type=float,
+        default=os.getenv('TIME_DECAY_HALF_LIFE'),
+        help='Halve the weight of a paper every YEARS years, rather than '
+             'decaying it linearly. Defaults to $TIME_DECAY_HALF_LIFE.')
+age.set_defaults(func=age_profiles)
+
+purge = commands.add_parser('purge-keywords',
+        help='Remove keywords from every profile and from the database.')
+purge.add_argument('keywords', metavar='KEYWORD', nargs='*',
+        help='A keyword to remove.')
+purge.add_argument('--pattern', metavar='PATTERN',
+        help='Also remove keywords matching this SQL LIKE pattern.')
+purge.set_defaults(func=purge_keywords)
+
+sweep = commands.add_parser('sweep-keywords',
+        help='Remove keywords that no profile has.')
+sweep.add_argument('--batch-size', metavar='N', type=int, default=1000,
+        help='The number of keywords removed per transaction.')
+sweep.set_defaults(func=sweep_keywords)
+
+export = commands.add_parser('export',
+        help='Copy every table to a directory.')
+export.add_argument('directory', metavar='DIR',
+        help='The directory to write to.')
+export.add_argument('--format', choices=['binary', 'csv'], default='binary',
+        help='How to write each table. Defaults to binary.')
+export.add_argument('--compress', choices=['gzip', 'bz2', 'xz'],
+        help='Compress each table.')
+export.set_defaults(func=export_database)
+
+import_ = commands.add_parser('import',
+        help='Load the tables written by export into an empty database.')
+import_.add_argument('directory', metavar='DIR',
+        help='The directory to read from.')
+import_.set_defaults(func=import_database)
+
+ontology = commands.add_parser('load-ontology',
+        help='Reload the ontology closure table from the ACM ontology.')
+ontology.set_defaults(func=load_ontology)
+
+migrate = commands.add_parser('migrate',
+        help='Apply any schema migrations the database is missing.')
+migrate.add_argument('--target', metavar='VERSION', type=int,
+        help='The version to migrate to. Defaults to the latest.')
+migrate.set_defaults(func=migrate_schema)
+
+partition = commands.add_parser('partition-keywords',
+        help='Hash partition the keyword weights by profile.')
+partition.add_argument('partitions', metavar='N', type=int,
+        help='The number of partitions.')
+partition.set_defaults(func=partition_keywords)
+
+summaries = commands.add_parser('check-summaries',
+        help='Find profiles whose summaries differ from their keywords.')
+summaries.add_argument('--repair', action='store_true',
+        help='Recompute the summaries that differ.')
+summaries.set_defaults(func=check_summaries)
+
+statistics = commands.add_parser('rebuild-statistics',
+        help='Recount the keyword statistics searches are ranked by.')
+statistics.set_defaults(func=rebuild_statistics)
+
+def main(argv=None):
+    args = parser.parse_args(argv)
+    if not args.database_url:
+        parser.error('no database given; use --database-url or $DATABASE_URL')
+    logging.basicConfig(level=getattr(logging, args.log_level.upper()))
+    db.init(args.database_url, migrate=args.func is not migrate_schema)
+    args.func(args)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+"""Negotiated compression of response bodies.
+
+Responses are compressed with brotli if the client accepts it and the
+``brotli`` package is installed, and with gzip otherwise. Small
+responses are sent as they are, since compressing them saves little
+and costs a round of CPU work on both ends.
+
+Examples:
+    >>> from flask import Flask
+    >>> app = Flask(__name__)
+    >>> init_app(app)
+    >>> app.config['COMPRESS_MIN_SIZE']
+    1024
+
+"""
+import zlib
+
+from flask import current_app, request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+#: The media types worth compressing. The API views return JSON
+#: strings, which Flask serves as ``text/html``.
+COMPRESSIBLE = {'application/json', 'text/html', 'text/plain'}
+
+def encodings():
+    """The encodings we can produce, most preferred first."""
+    return ['br', 'gzip'] if brotli is not None else ['gzip']
+
+def choose_encoding(accept_encodings):
+    """Chooses how to encode a response.
+
+    Args:
+        accept_encodings (werkzeug.datastructures.Accept): The parsed
+            ``Accept-Encoding`` header of the request.
+
+    Returns:
+        (Optional[str]): The encoding to use, or ``None`` to send the
+        response as it is. Where the client rates several encodings
+        equally, ours are preferred in the order of :func:`encodings`.
+
+    """
+    best, best_quality = None, 0
+    for encoding in encodings():
+        quality = accept_encodings[encoding]
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+def compress(data, encoding, level):
+    """Compresses a response body.
+
+    Args:
+        data (bytes): The body.
+        encoding (str): One of :func:`encodings`.
+        level (int): The gzip compression level, from 1 to 9. Brotli
+            is given the quality with a similar cost.
+
+    """
+    if encoding == 'br':
+        return brotli.compress(data, quality=max(0, level - 2))
+    # a gzip header with no timestamp, so the same body always compresses
+    # the same; gzip.compress only takes mtime from Python 3.8
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+def compress_response(response):
+    """Compresses a response, if the request and response allow it."""
+    config = current_app.config
+    if (response.mimetype not in COMPRESSIBLE
+            or response.direct_passthrough
+            or not 200 <= response.status_code < 300
+            or 'Content-Encoding' in response.headers):
+        return response
+    response.vary.add('Accept-Encoding')
+    data = response.get_data()
+    if len(data) < config['COMPRESS_MIN_SIZE']:
+        return response
+    encoding = choose_encoding(request.accept_encodings)
+    if encoding is None:
+        return response
+    response.set_data(compress(data, encoding, config['COMPRESS_LEVEL']))
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+def init_app(app):
+    """Compresses every eligible response of an app.
+
+    The size threshold and compression level are read from the
+    ``COMPRESS_MIN_SIZE`` and ``COMPRESS_LEVEL`` config values.
+
+    """
+    app.config.setdefault('COMPRESS_MIN_SIZE', 1024)
+    app.config.setdefault('COMPRESS_LEVEL', 6)
+    app.after_request(compress_response)
@@ -3,6 +3,8 @@
 Attributes:
     engine (sqlalchemy.Engine): The database engine. You shouldn't need
         to interact with this object.
+    replicas (Optional[ReplicaSet]): Read-only replicas of the database,
+        if any were given to :func:`init`.
     session (sqlalchemy.scoped_session): A thread-safe session that
         can be used to access the database, see above examples.
 
@@ -46,27 +48,86 @@ Examples:
     >>> postgresql.stop()
 
 """
-from sqlalchemy import (create_engine, Table, Column, 
+from sqlalchemy import (create_engine, event, Table, Column, Index,
         Enum, Integer, Float, Text, String, Date, ForeignKey,
-        func, exists, desc, or_)
-from sqlalchemy.exc import IntegrityError, InvalidRequestError
+        func, desc, exists, or_, select, literal, union_all, cast, text)
+from sqlalchemy.exc import IntegrityError, InvalidRequestError, DBAPIError
 from sqlalchemy.ext.associationproxy import association_proxy
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.ext.mutable import MutableList
-from sqlalchemy.orm import scoped_session, sessionmaker, relationship, backref
+from sqlalchemy.orm import (scoped_session, sessionmaker, relationship,
+        backref, Session)
 from sqlalchemy.orm.collections import attribute_mapped_collection
+from sqlalchemy.orm.util import identity_key
 from sqlalchemy.orm.exc import (NoResultFound, MultipleResultsFound)
-from sqlalchemy.dialects.postgresql import JSON, JSONB
+from sqlalchemy.dialects.postgresql import (JSON, JSONB, ARRAY, insert,
+        aggregate_order_by)
+from sqlalchemy.sql.expression import Select, CompoundSelect
 
+from collections import defaultdict, namedtuple
+import hashlib
+import itertools
+import json
+import logging
 import operator
+import os
+import select as _select
+import threading
+import time
+import uuid
 from functools import reduce
 
 __author__ = 'Blaine Rogers <br1314@ic.ac.uk>'
 
+log = logging.getLogger(__name__)
+
 #: The database engine.
 engine = None
+#: The read-only replicas of the database.
+replicas = None
 #: A thread-safe session.
 session = None
+#: The number of profiles :func:`read_profiles_by_keyword` returns,
+#: unless asked for another number.
+KEYWORD_PAGE_SIZE = 100
+
+#: The number of keywords in the summary of a profile, see
+#: :attr:`Profile.top_keywords`.
+SUMMARY_KEYWORDS = 5
+
+#: How searches rank the profiles matching their keywords: ``'weight'``
+#: by the sum of their weights, ``'tfidf'`` by weight times inverse
+#: document frequency, or ``'bm25'``. See :func:`_search_profiles`.
+SEARCH_RANKING = 'weight'
+RANKINGS = ('weight', 'tfidf', 'bm25')
+
+#: How soon the term frequency saturates in ``'bm25'`` ranking.
+BM25_K1 = 1.2
+
+#: Identifies the advisory lock held while keyword statistics are
+#: folded or rebuilt, see :func:`fold_keyword_statistics`.
+STATISTICS_LOCK_ID = 0x0b1097
+
+#: The ``keyword_id`` of the :class:`KeywordStatistics` row counting
+#: every profile, the number of documents searches rank by. No keyword
+#: has this id.
+CORPUS_STATISTICS = 0
+
+#: Functions called with the ids of profiles whose keywords have been
+#: changed, once the change is committed. See :func:`profiles_changed`.
+profile_listeners = []
+#: Functions called with a session and the names of the keywords that
+#: :func:`keyword_ids` has just created in it, before it commits.
+keyword_listeners = []
+#: Functions called with the changes another process has published,
+#: by kind. See :func:`publish_changes`.
+change_listeners = defaultdict(list)
+change_listeners['profiles'] = profile_listeners
+change_listeners['reset'] = [lambda changes: _reset()]
+#: Functions called when changes made by other processes may have been
+#: missed, so that in-memory indexes can be reloaded. See
+#: :class:`ChangeListener`.
+reset_listeners = []
 #: The declarative base class.
 Base = declarative_base()
 Base.get = classmethod(lambda cls, uid: cls.query.get(uid))
@@ -111,27 +172,75 @@ def get_one_or_create(model, create_method='', create_method_kwargs=None,
         and a boolean representing whether or not the object already
         existed.
 
+    If ``kwargs`` are backed by a unique index, concurrent calls are
+    safe: whoever loses the race to insert gets the winner's object.
+
     .. _here: http://skien.cc/blog/2014/02/06/sqlalchemy-and-race-conditions-follow-up/
     
     """
     try:
         return session.query(model).filter_by(**kwargs).one(), True
     except NoResultFound:
+        lookup = dict(kwargs)
         kwargs.update(create_method_kwargs or {})
         created = getattr(model, create_method, model)(**kwargs)
         try:
-            session.add(created)
-            session.flush()
+            # only roll back the insert if we lose a race to create it
+            with session.begin_nested():
+                session.add(created)
             return created, False
         except IntegrityError:
-            session.rollback()
-            return session.query(model).filter_by(**kwargs).one(), True
+            return session.query(model).filter_by(**lookup).one(), True
+
+def normalise(text):
+    """Normalises text for use in an identity key.
+
+    Case and runs of whitespace are ignored, and ``None`` is treated as
+    the empty string. :func:`_sql_normalise` does the same in SQL.
+
+    """
+    return ' '.join((text or '').lower().split())
+
+def _sql_normalise(column):
+    return func.btrim(func.regexp_replace(
+        func.lower(func.coalesce(column, '')), r'\s+', ' ', 'g'))
+
+def _key(*parts):
+    # normalised parts can't contain newlines, so they separate unambiguously
+    text = '\n'.join(normalise(p) for p in parts)
+    return hashlib.md5(text.encode('utf-8')).hexdigest()
+
+def _sql_key(*columns):
+    parts = [_sql_normalise(c) for c in columns]
+    return func.md5(func.concat_ws(func.chr(10), *parts))
+
+def profile_identity_key(firstname, lastname, faculty):
+    """The identity key of the author with a name and faculty.
+
+    Authors with the same first name, last name and faculty, up to
+    case and whitespace, are taken to be the same person.
+
+    Returns:
+        (str): A 32 character hex digest.
+
+    """
+    return _key(firstname, lastname, faculty)
+
+def publication_title_key(title):
+    """The identity key of the publication with a title.
+
+    Returns:
+        (str): A 32 character hex digest.
+
+    """
+    return _key(title)
 
 #: Association table for many-to-many link between papers and profiles.
 profile_publication_association = Table(
     'profile_publication_association', Base.metadata,
-    Column('profile_id', Integer, ForeignKey('profile.id')),
-    Column('publication_id', Integer, ForeignKey('publication.id'))
+    Column('profile_id', Integer, ForeignKey('profile.id'), primary_key=True),
+    Column('publication_id', Integer, ForeignKey('publication.id'),
+           primary_key=True, index=True)
 )
 
 class ProfileKeywordAssociation(Base):
@@ -153,6 +262,14 @@ class ProfileKeywordAssociation(Base):
     keyword = association_proxy('keyword_', 'name',
             creator=lambda name: get_one_or_create(Keyword, name=name)[0])
 
+#: The postings list of each keyword: its profiles, most relevant first.
+#: Postgres keeps this up to date on every write, so the profiles of a
+#: keyword can be paged through with a single index range scan.
+Index('ix_profile_keyword_postings',
+      ProfileKeywordAssociation.right_id,
+      ProfileKeywordAssociation.weight.desc(),
+      ProfileKeywordAssociation.left_id)
+
 class Profile(Base):
     """Table to contain user profiles."""
     __tablename__ = 'profile'
@@ -169,6 +286,13 @@ class Profile(Base):
     building = Column(String(80))
     room = Column(String(80))
     website = Column(String(160))
+    #: See :func:`profile_identity_key`. Set automatically on flush.
+    identity_key = Column(String(32), unique=True, index=True)
+    #: The names of the profile's :data:`SUMMARY_KEYWORDS` heaviest
+    #: keywords, heaviest first, for lists of people. Refreshed in the
+    #: same transaction as any change to its keywords, see
+    #: :func:`stale_summaries`.
+    top_keywords = Column(JSONB, nullable=False, server_default='[]')
 
     keywords = association_proxy('keywords_', 'weight',
             creator=lambda k, v: ProfileKeywordAssociation(keyword=k, weight=v)
@@ -204,6 +328,17 @@ class Profile(Base):
         name = "{} {} {}".format(self.title, self.firstname, self.lastname)
         return '<Profile id={} name={}>'.format(self.id, name)
 
+#: :func:`get_profiles_by_keywords` matches the lowercased profile
+#: columns against lists of names; these let it do so without reading
+#: every profile.
+for _column in ( Profile.firstname
+               , Profile.lastname
+               , Profile.department
+               , Profile.campus
+               , Profile.faculty
+               ):
+    Index('ix_profile_lower_' + _column.key, func.lower(_column))
+
 class Keyword(Base):
     """Table to contain keywords for profile lookup."""
     __tablename__ = 'keyword'
@@ -223,6 +358,8 @@ class Publication(Base):
     title = Column(Text)
     abstract = Column(Text)
     date = Column(Date)
+    #: See :func:`publication_title_key`. Set automatically on flush.
+    title_key = Column(String(32), unique=True, index=True)
     authors = relationship('Profile',
             secondary=profile_publication_association,
             back_populates='publications',
@@ -232,7 +369,337 @@ class Publication(Base):
         title = self.title if len(self.title) > 20 else self.title[:17] + '...'
         return '<Publication id={} title={}>'.format(self.id, title)
 
-def init(connection_url):
+class OntologyClosure(Base):
+    """Every ancestor of every concept in the ACM ontology.
+
+    Profiles only hold the keywords found in their papers. A search for
+    a concept also finds profiles with any of its descendants, each
+    counting for ``weight`` times its own weight, where ``weight``
+    falls with the ``depth`` between them.
+
+    """
+    __tablename__ = 'ontology_closure'
+    #: A label of the concept, lowercased as keywords are.
+    concept = Column(Text, primary_key=True)
+    #: The preferred label of the ancestor, also lowercased.
+    ancestor = Column(Text, primary_key=True, index=True)
+    depth = Column(Integer, nullable=False)
+    weight = Column(Float, nullable=False)
+
+    def __repr__(self):
+        return '<OntologyClosure {} -> {} depth={}>'.format(
+                self.concept, self.ancestor, self.depth)
+
+class KeywordExtraction(Base):
+    """The keywords extracted from a piece of text.
+
+    Extracting keywords is by far the slowest part of adding a paper,
+    and the same papers are submitted again and again, so the result
+    for each title and abstract is kept here. See
+    :func:`oblong.profiling.cached_keywords`.
+
+    """
+    __tablename__ = 'keyword_extraction'
+    #: A hash of the text and of ``version``.
+    key = Column(String(32), primary_key=True)
+    #: The version of the extraction pipeline that produced this.
+    version = Column(String(32), nullable=False)
+    keywords = Column(ARRAY(Text), nullable=False)
+
+    def __repr__(self):
+        return '<KeywordExtraction {} {}>'.format(self.key, self.keywords)
+
+class KeywordContribution(Base):
+    """How often a keyword occurs in an author's papers of one year.
+
+    A profile's keyword weights are these, weighted by the age of the
+    papers and summed, so they can be brought up to date as the papers
+    age without extracting any keywords again. See
+    :func:`reweigh_profiles`.
+
+    """
+    __tablename__ = 'keyword_contribution'
+    profile_id = Column(Integer, ForeignKey('profile.id', ondelete='CASCADE'),
+                        primary_key=True)
+    keyword_id = Column(Integer, ForeignKey('keyword.id', ondelete='CASCADE'),
+                        primary_key=True)
+    #: The year the papers were published.
+    year = Column(Integer, primary_key=True)
+    occurrences = Column(Integer, nullable=False)
+
+    def __repr__(self):
+        return '<KeywordContribution {}:{} year={} occurrences={}>'.format(
+                self.profile_id, self.keyword_id, self.year, self.occurrences)
+
+class KeywordStatistics(Base):
+    """How many profiles have a keyword, and their total weight of it.
+
+    Searches read these to rank profiles by TF-IDF or BM25, rather than
+    counting the weights of each keyword they match. They are kept up
+    to date by triggers on ``profile_keyword_association``, which only
+    append the changes each statement makes to
+    ``keyword_statistics_delta``, so concurrent writers never wait on
+    each other's statistics. :func:`fold_keyword_statistics` adds the
+    changes to these rows as a session commits.
+
+    There is no foreign key to ``keyword``: a keyword's statistics may
+    be folded after it has been deleted. They are removed once no
+    profile has the keyword. The row with the id
+    :data:`CORPUS_STATISTICS` counts the profiles themselves, kept by
+    triggers on ``profile`` in the same way.
+
+    """
+    __tablename__ = 'keyword_statistics'
+    keyword_id = Column(Integer, primary_key=True)
+    #: The number of profiles with the keyword: its document frequency.
+    profiles = Column(Integer, nullable=False)
+    total_weight = Column(Float, nullable=False)
+
+    def __repr__(self):
+        return '<KeywordStatistics {} profiles={} total_weight={}>'.format(
+                self.keyword_id, self.profiles, self.total_weight)
+
+#: Changes to :class:`KeywordStatistics` not yet folded into it.
+keyword_statistics_delta = Table(
+    'keyword_statistics_delta', Base.metadata,
+    Column('keyword_id', Integer, nullable=False),
+    Column('profiles', Integer, nullable=False),
+    Column('total_weight', Float, nullable=False)
+)
+
+#: Appends the changes a statement made to ``profile_keyword_association``
+#: to ``keyword_statistics_delta``, one row per keyword. Transition
+#: tables (Postgres 10) give the statement's rows all at once.
+_STATISTICS_TRIGGER_FUNCTION = """
+CREATE OR REPLACE FUNCTION record_keyword_statistics() RETURNS trigger
+LANGUAGE plpgsql AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        INSERT INTO keyword_statistics_delta
+        SELECT right_id, count(*), sum(weight)
+        FROM new_rows GROUP BY right_id;
+    ELSIF TG_OP = 'DELETE' THEN
+        INSERT INTO keyword_statistics_delta
+        SELECT right_id, -count(*), -sum(weight)
+        FROM old_rows GROUP BY right_id;
+    ELSE
+        INSERT INTO keyword_statistics_delta
+        SELECT right_id, sum(profiles), sum(weight)
+        FROM ( SELECT right_id, 1 AS profiles, weight FROM new_rows
+               UNION ALL
+               SELECT right_id, -1, -weight FROM old_rows
+             ) AS changed
+        GROUP BY right_id
+        HAVING sum(profiles) <> 0 OR sum(weight) <> 0;
+    END IF;
+    RETURN NULL;
+END
+$$
+"""
+
+#: Likewise appends the number of profiles a statement inserted or
+#: deleted, as the changes to the :data:`CORPUS_STATISTICS` row.
+_CORPUS_TRIGGER_FUNCTION = """
+CREATE OR REPLACE FUNCTION record_corpus_statistics() RETURNS trigger
+LANGUAGE plpgsql AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        INSERT INTO keyword_statistics_delta
+        SELECT {0}, count(*), 0 FROM new_rows HAVING count(*) > 0;
+    ELSE
+        INSERT INTO keyword_statistics_delta
+        SELECT {0}, -count(*), 0 FROM old_rows HAVING count(*) > 0;
+    END IF;
+    RETURN NULL;
+END
+$$
+""".format(CORPUS_STATISTICS)
+
+def _create_statement_triggers(bind, table, prefix, function, events):
+    for event_, rows in events:
+        name = '{}_{}'.format(prefix, event_.lower())
+        bind.execute('DROP TRIGGER IF EXISTS {} ON {}'.format(name, table))
+        bind.execute('CREATE TRIGGER {} AFTER {} ON {} REFERENCING {} '
+                     'FOR EACH STATEMENT EXECUTE PROCEDURE {}()'
+                     .format(name, event_, table, rows, function))
+
+def create_statistics_triggers(bind):
+    """(Re)creates the triggers behind :class:`KeywordStatistics`.
+
+    Args:
+        bind: A connection, in a transaction.
+
+    """
+    bind.execute(text(_STATISTICS_TRIGGER_FUNCTION))
+    bind.execute(text(_CORPUS_TRIGGER_FUNCTION))
+    inserted = ('INSERT', 'NEW TABLE AS new_rows')
+    deleted = ('DELETE', 'OLD TABLE AS old_rows')
+    updated = ('UPDATE', 'OLD TABLE AS old_rows NEW TABLE AS new_rows')
+    _create_statement_triggers(bind, ProfileKeywordAssociation.__tablename__,
+                               'keyword_statistics',
+                               'record_keyword_statistics',
+                               [inserted, updated, deleted])
+    _create_statement_triggers(bind, Profile.__tablename__,
+                               'corpus_statistics', 'record_corpus_statistics',
+                               [inserted, deleted])
+
+@event.listens_for(ProfileKeywordAssociation.__table__, 'after_create')
+def _create_statistics_triggers(target, connection, **kwargs):
+    create_statistics_triggers(connection)
+
+@event.listens_for(Profile, 'before_insert')
+@event.listens_for(Profile, 'before_update')
+def _set_profile_identity_key(mapper, connection, target):
+    target.identity_key = profile_identity_key(target.firstname,
+                                               target.lastname,
+                                               target.faculty)
+
+@event.listens_for(Publication, 'before_insert')
+@event.listens_for(Publication, 'before_update')
+def _set_publication_title_key(mapper, connection, target):
+    target.title_key = publication_title_key(target.title)
+
+class ReplicaSet:
+    """A round-robin pool of read-only replicas.
+
+    Each replica is health checked with a ``SELECT 1`` at most every
+    ``check_interval`` seconds when it is chosen, and is also marked
+    as down whenever a connection to it fails. Replicas that are down
+    are skipped until their next health check succeeds.
+
+    Args:
+        urls (Sequence[str]): The urls of the replicas.
+        check_interval (float): Seconds between health checks.
+
+    """
+    def __init__(self, urls, check_interval=5.):
+        self.engines = [create_engine(url, pool_pre_ping=True)
+                        for url in urls]
+        self.check_interval = check_interval
+        self._next_check = {e: 0. for e in self.engines}
+        self._healthy = {e: True for e in self.engines}
+        self._turn = itertools.count()
+        self._lock = threading.Lock()
+        for e in self.engines:
+            event.listen(e, 'handle_error', self._handle_error)
+
+    def _handle_error(self, context):
+        if context.is_disconnect or context.connection is None:
+            self.mark_down(context.engine)
+
+    def mark_down(self, engine):
+        """Stops using a replica until its next successful check."""
+        log.warning('Replica %s is down', engine.url)
+        with self._lock:
+            self._healthy[engine] = False
+            self._next_check[engine] = time.time() + self.check_interval
+
+    def _check(self, engine):
+        with self._lock:
+            if time.time() < self._next_check[engine]:
+                return self._healthy[engine]
+            self._next_check[engine] = time.time() + self.check_interval
+        try:
+            with engine.connect() as connection:
+                connection.scalar('SELECT 1')
+            healthy = True
+        except DBAPIError:
+            healthy = False
+        with self._lock:
+            if healthy and not self._healthy[engine]:
+                log.info('Replica %s is back up', engine.url)
+            self._healthy[engine] = healthy
+        return healthy
+
+    def choose(self):
+        """Picks the next healthy replica.
+
+        Returns:
+            (Optional[sqlalchemy.Engine]): A replica, or ``None`` if
+            they are all down.
+
+        """
+        for _ in range(len(self.engines)):
+            engine = self.engines[next(self._turn) % len(self.engines)]
+            if self._check(engine):
+                return engine
+        return None
+
+class RoutingSession(Session):
+    """A session that sends reads to a replica when asked to.
+
+    Sessions are routed to the primary unless :func:`use_replica` has
+    been called on them. Once a read-only session has picked a
+    replica it keeps using it, so a request sees a consistent view.
+    Only plain ``SELECT`` statements go to the replica: anything
+    flushed, any other statement executed on the session, and any
+    ``SELECT ... FOR UPDATE``, still goes to the primary.
+
+    """
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if self.info.get('read_only') and replicas and not self._flushing \
+                and _reads_only(clause):
+            if 'replica' not in self.info:
+                self.info['replica'] = replicas.choose()
+            if self.info['replica'] is not None:
+                return self.info['replica']
+        return super().get_bind(mapper, clause, **kwargs)
+
+def _reads_only(clause):
+    """Whether a statement can run on a replica."""
+    return clause is None or isinstance(clause, (Select, CompoundSelect)) \
+        and clause._for_update_arg is None
+
+def use_replica(read_only=True):
+    """Routes the current session's queries to a replica, if possible.
+
+    Args:
+        read_only (bool): Whether the session should use a replica.
+            This lasts until the session is removed.
+
+    """
+    session.info['read_only'] = read_only
+
+class DeadlineExceeded(Exception):
+    """Raised when a session starts a transaction after its deadline."""
+
+def set_deadline(deadline):
+    """Bounds how long the current session's queries may run.
+
+    Each transaction the session begins sets Postgres's
+    ``statement_timeout`` to the time left, so a query still running
+    at the deadline is cancelled, raising a :class:`DBAPIError` for
+    which :func:`is_timeout` is true. A transaction begun after the
+    deadline raises :class:`DeadlineExceeded` instead.
+
+    Args:
+        deadline (Optional[float]): The deadline, in the seconds of
+            :func:`time.monotonic`, or ``None`` for no deadline. This
+            lasts until the session is removed.
+
+    """
+    session.info['deadline'] = deadline
+
+def is_timeout(error):
+    """Whether a database error is a query cancelled by its deadline."""
+    return (isinstance(error, DBAPIError)
+            and getattr(error.orig, 'pgcode', None) == '57014')
+
+@event.listens_for(RoutingSession, 'after_begin')
+def _set_statement_timeout(session, transaction, connection):
+    deadline = session.info.get('deadline')
+    if deadline is None:
+        return
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise DeadlineExceeded('deadline passed {:.3f}s ago'
+                               .format(-remaining))
+    # SET takes no bound parameters; the value is always an int
+    connection.execute('SET LOCAL statement_timeout = {:d}'
+                       .format(max(1, int(remaining * 1000))))
+
+def init(connection_url, replica_urls=None, migrate=True,
+         keyword_partitions=None):
     """Intialises the module by setting up an engine and session.
     
     Args:
@@ -246,28 +713,914 @@ def init(connection_url):
                 name of a DBAPI, such as ``psycopg2``, ``pyodbc``, 
                 ``cx_oracle``, etc. Alternatively, the URL can be an 
                 instance of ``sqlalchemy.engine.url.URL``.
+        replica_urls (Optional[Sequence[str]]): The urls of read-only
+            replicas of the database. Sessions only use them after
+            :func:`use_replica` is called.
+        migrate (bool): Whether to bring the schema up to date with
+            :func:`oblong.migrations.upgrade`. This costs a single query
+            if the schema is already current.
+        keyword_partitions (Optional[int]): If given, the number of
+            partitions to hash ``profile_keyword_association`` into,
+            see :func:`oblong.migrations.partition_keyword_weights`.
+            This costs a single query if it already has them.
 
     .. _SQLAlchemy docs: http://docs.sqlalchemy.org/en/rel_1_1/core/engines.html?highlight=create_engine#sqlalchemy.create_engine
 
     """
-    global Base, engine, session
+    global Base, engine, replicas, session
     engine = create_engine(connection_url)
-    session = scoped_session(sessionmaker(autocommit=False,
+    replicas = ReplicaSet(replica_urls) if replica_urls else None
+    session = scoped_session(sessionmaker(class_=RoutingSession,
+                                          autocommit=False,
                                           autoflush=False,
                                           expire_on_commit=False,
                                           bind=engine))
     Base.query = session.query_property()
-    Base.metadata.create_all(bind=engine)
+    if migrate:
+        from .migrations import upgrade
+        upgrade(engine)
+    if keyword_partitions:
+        from .migrations import partition_keyword_weights
+        partition_keyword_weights(engine, keyword_partitions)
+
+def keyword_ids(names):
+    """Gets the ids of some keywords, creating any that don't exist.
+
+    Unlike ``get_one_or_create``, this takes two statements however
+    many keywords there are, and is safe against concurrent inserts.
+    The keywords are locked until the end of the transaction, so they
+    can't be removed by :func:`purge_keywords` or
+    :func:`sweep_orphan_keywords` before they are used; any removed
+    just before they were locked are created again. The ORM doesn't
+    see the keywords created, so :data:`keyword_listeners` are told.
+
+    Args:
+        names (Iterable[str]): The names of the keywords.
+
+    Returns:
+        (Dict[str, int]): The id of each keyword, by name.
+
+    """
+    table = Keyword.__table__
+    ids = {}
+    missing = sorted(set(names))
+    while missing:
+        created = [name for name, in session.execute(insert(table)
+                       .values([{'name': n} for n in missing])
+                       .on_conflict_do_nothing(index_elements=['name'])
+                       .returning(table.c.name)
+                       )]
+        if created:
+            for listener in keyword_listeners:
+                listener(session(), created)
+        rows = session.execute(table.select()
+                              .where(table.c.name.in_(missing))
+                              .with_for_update(key_share=True))
+        ids.update((row.name, row.id) for row in rows)
+        missing = [n for n in missing if n not in ids]
+    return ids
+
+def _expire_keywords(uid):
+    """Makes the session reload a profile's keywords, if it has them.
+
+    Its summary is refreshed too, before the session commits.
+
+    """
+    stale_summaries([uid])
+    profile = session.identity_map.get(identity_key(Profile, uid))
+    if profile is not None:
+        session.expire(profile, ['keywords_'])
+
+def stale_summaries(uids=None, bind=None):
+    """Marks the summaries of some profiles as out of date.
+
+    They are refreshed by :func:`refresh_summaries` just before the
+    session commits, in the same transaction. Anything that changes
+    keyword weights through this module, or through the ORM, does this
+    already; only other statements on ``profile_keyword_association``
+    need to.
+
+    Args:
+        uids (Optional[Iterable[int]]): The ids of the profiles, or
+            ``None`` for every profile.
+        bind (Optional[Session]): The session. Defaults to
+            :data:`session`.
+
+    """
+    info = (session if bind is None else bind).info
+    if uids is None:
+        info['stale_summaries'] = None
+    elif info.get('stale_summaries', ()) is not None:
+        info.setdefault('stale_summaries', set()).update(uids)
+
+@event.listens_for(RoutingSession, 'after_flush')
+def _flushed_keywords(s, flush_context):
+    # a profile whose keywords were removed is dirty, even where the
+    # removed weights are only deleted as orphans during the flush
+    changed = [o.id if isinstance(o, Profile) else o.left_id
+               for o in itertools.chain(s.new, s.dirty, s.deleted)
+               if isinstance(o, (Profile, ProfileKeywordAssociation))]
+    if changed:
+        stale_summaries(changed, bind=s)
+
+@event.listens_for(RoutingSession, 'before_commit')
+def _refresh_stale_summaries(s):
+    # flushing first marks any keywords changed through the ORM; the
+    # summaries stay marked until the end of the transaction, for the
+    # hooks that follow
+    s.flush()
+    if 'stale_summaries' in s.info:
+        refresh_summaries(s.info['stale_summaries'], bind=s)
+
+@event.listens_for(RoutingSession, 'after_commit')
+@event.listens_for(RoutingSession, 'after_rollback')
+def _forget_stale_summaries(s):
+    s.info.pop('stale_summaries', None)
+
+def _top_keywords(uids=None):
+    """The summary keywords of the profiles with any keywords.
+
+    Args:
+        uids (Optional[Sequence[int]]): The profiles, or ``None`` for
+            every profile.
+
+    Returns:
+        An alias with a row of ``left_id`` and ``keywords``, a JSON
+        array, for each profile.
+
+    """
+    assoc = ProfileKeywordAssociation.__table__
+    rank = func.row_number().over(partition_by=assoc.c.left_id,
+                                  order_by=(desc(assoc.c.weight),
+                                            Keyword.name))
+    ranked = (select([assoc.c.left_id, Keyword.name, rank.label('rank')])
+             .select_from(assoc.join(Keyword.__table__,
+                                     Keyword.id == assoc.c.right_id)))
+    if uids is not None:
+        ranked = ranked.where(assoc.c.left_id.in_(uids))
+    ranked = ranked.alias('ranked')
+    keywords = func.jsonb_agg(aggregate_order_by(ranked.c.name,
+                                                 ranked.c.rank))
+    return (select([ranked.c.left_id, keywords.label('keywords')])
+           .where(ranked.c.rank <= SUMMARY_KEYWORDS)
+           .group_by(ranked.c.left_id)
+           .alias('top'))
+
+def refresh_summaries(uids=None, bind=None):
+    """Recomputes the :attr:`Profile.top_keywords` of some profiles.
+
+    Args:
+        uids (Optional[Iterable[int]]): The ids of the profiles, or
+            ``None`` for every profile.
+        bind: The connection to use. Defaults to :data:`session`.
+
+    """
+    bind = session if bind is None else bind
+    table = Profile.__table__
+    if uids is not None:
+        uids = sorted(set(uids))
+        if not uids:
+            return
+        # in order of id, as lock_profiles does, so that two refreshes
+        # of overlapping profiles can't deadlock
+        bind.execute(select([table.c.id])
+                    .where(table.c.id.in_(uids))
+                    .order_by(table.c.id)
+                    .with_for_update())
+    top = _top_keywords(uids)
+    with_keywords = (table.update()
+                    .where(table.c.id == top.c.left_id)
+                    .values(top_keywords=top.c.keywords))
+    assoc = ProfileKeywordAssociation.__table__
+    # a bound '[]' would be encoded as the JSON string "[]"
+    empty = func.jsonb_build_array()
+    without = (table.update()
+              .where(table.c.top_keywords != empty)
+              .where(~exists().where(assoc.c.left_id == table.c.id))
+              .values(top_keywords=empty))
+    if uids is not None:
+        without = without.where(table.c.id.in_(uids))
+    bind.execute(with_keywords)
+    bind.execute(without)
+
+def drifted_summaries():
+    """Finds the profiles whose summaries are out of date.
+
+    They should never be; this checks that every change to keyword
+    weights has refreshed them. Pass the result to
+    :func:`refresh_summaries` to repair them.
+
+    Returns:
+        (List[int]): The ids of the profiles, in order.
+
+    """
+    table = Profile.__table__
+    top = _top_keywords()
+    expected = func.coalesce(top.c.keywords, func.jsonb_build_array())
+    q = (select([table.c.id])
+        .select_from(table.outerjoin(top, top.c.left_id == table.c.id))
+        .where(table.c.top_keywords.is_distinct_from(expected))
+        .order_by(table.c.id))
+    return [uid for uid, in session.execute(q)]
+
+def fold_keyword_statistics(bind=None):
+    """Adds the pending changes to :class:`KeywordStatistics`.
+
+    The changes are those committed by other transactions, and any made
+    in this one. Only one transaction folds at a time; if another is
+    already folding, this does nothing, and the changes are folded by
+    the next. The statistics are locked in order of keyword id, from
+    here until the end of the transaction; as every session that
+    changes keyword weights calls this just before it commits, they
+    are held only briefly.
+
+    Args:
+        bind: The connection to use. Defaults to :data:`session`.
+
+    Returns:
+        (Optional[int]): The number of keywords whose statistics
+        changed, or ``None`` if another transaction was folding.
+
+    """
+    bind = session if bind is None else bind
+    if not bind.execute(select([func.pg_try_advisory_xact_lock(
+            STATISTICS_LOCK_ID)])).scalar():
+        return None
+    # a DELETE ... RETURNING can only feed an INSERT from the top level
+    # of a statement, which SQLAlchemy 1.x can't build
+    folded = bind.execute(text("""
+        WITH folded AS (
+            DELETE FROM keyword_statistics_delta
+            RETURNING keyword_id, profiles, total_weight
+        )
+        INSERT INTO keyword_statistics (keyword_id, profiles, total_weight)
+        SELECT keyword_id, sum(profiles), sum(total_weight)
+        FROM folded GROUP BY keyword_id ORDER BY keyword_id
+        ON CONFLICT (keyword_id) DO UPDATE
+        SET profiles = keyword_statistics.profiles + excluded.profiles,
+            total_weight = keyword_statistics.total_weight
+                           + excluded.total_weight
+        """)).rowcount
+    if folded:
+        table = KeywordStatistics.__table__
+        bind.execute(table.delete().where(table.c.profiles <= 0))
+    return folded
+
+@event.listens_for(RoutingSession, 'before_commit')
+def _fold_keyword_statistics(s):
+    # after _refresh_stale_summaries, which flushed; the weights changed
+    # exactly where the summaries did
+    if 'stale_summaries' in s.info:
+        fold_keyword_statistics(bind=s)
+
+def rebuild_keyword_statistics(bind=None):
+    """Recomputes :class:`KeywordStatistics` from the keyword weights.
+
+    The statistics should never need it; this is for repairing them,
+    and for filling them in the first place. Changes committed while
+    it runs are left pending, to be folded later.
+
+    Args:
+        bind: The connection to use. Defaults to :data:`session`, which
+            the caller must commit.
+
+    Returns:
+        (int): The number of keywords with statistics.
+
+    """
+    bind = session if bind is None else bind
+    bind.execute(select([func.pg_advisory_xact_lock(STATISTICS_LOCK_ID)]))
+    bind.execute(KeywordStatistics.__table__.delete())
+    # in one statement, so the pending changes dropped are exactly
+    # those already counted in the weights and profiles it sees
+    return bind.execute(text("""
+        WITH dropped AS (DELETE FROM keyword_statistics_delta),
+        corpus AS (
+            INSERT INTO keyword_statistics (keyword_id, profiles, total_weight)
+            SELECT :corpus, count(*), 0 FROM profile HAVING count(*) > 0
+        )
+        INSERT INTO keyword_statistics (keyword_id, profiles, total_weight)
+        SELECT right_id, count(*), sum(weight)
+        FROM profile_keyword_association
+        GROUP BY right_id ORDER BY right_id
+        """), {'corpus': CORPUS_STATISTICS}).rowcount
+
+def lock_profile(uid):
+    """Locks a profile's row until the end of the transaction.
+
+    Anything that changes several of a profile's keyword weights
+    should do this first: weights are locked row by row, so two
+    transactions changing overlapping sets of a profile's weights
+    could otherwise deadlock.
+
+    Args:
+        uid (int): The id of the profile.
+
+    """
+    session.execute(select([Profile.id])
+                   .where(Profile.id == uid)
+                   .with_for_update())
+
+def lock_profiles(uids):
+    """Locks several profiles' rows, in order of id.
+
+    See :func:`lock_profile`. Taking the locks in a consistent order
+    stops two transactions that lock overlapping sets of profiles from
+    deadlocking.
+
+    Args:
+        uids (Iterable[int]): The ids of the profiles.
+
+    """
+    uids = sorted(set(uids))
+    if uids:
+        session.execute(select([Profile.id])
+                       .where(Profile.id.in_(uids))
+                       .order_by(Profile.id)
+                       .with_for_update())
+
+def add_keyword_weights(uid, weights, replace=False):
+    """Adds to the weights of some of a profile's keywords.
+
+    All of the weights are changed by one
+    ``INSERT ... ON CONFLICT DO UPDATE`` statement, which adds to the
+    weights in the database rather than overwriting them with values
+    computed in Python, so concurrent changes are never lost.
+
+    Args:
+        uid (int): The id of the profile.
+        weights (Dict[int, float]): The amount to add to the weight of
+            each keyword, by keyword id. Keywords the profile doesn't
+            have yet are added to it with this weight.
+        replace (bool): If true, the weights are set rather than added.
+
+    """
+    if not weights:
+        return
+    table = ProfileKeywordAssociation.__table__
+    stmt = insert(table).values([{'left_id': uid, 'right_id': k, 'weight': w}
+                                 for k, w in sorted(weights.items())])
+    weight = (stmt.excluded.weight if replace
+              else table.c.weight + stmt.excluded.weight)
+    session.execute(stmt.on_conflict_do_update(
+        index_elements=[table.c.left_id, table.c.right_id],
+        set_={'weight': weight}))
+    _expire_keywords(uid)
+
+def scale_keyword_weights(uid, maximum):
+    """Scales a profile's keyword weights so the largest is ``maximum``.
+
+    Args:
+        uid (int): The id of the profile.
+        maximum (float): The new largest weight.
+
+    """
+    table = ProfileKeywordAssociation.__table__
+    largest = (select([func.max(table.c.weight)])
+              .where(table.c.left_id == uid)
+              .as_scalar())
+    session.execute(table.update()
+                   .where(table.c.left_id == uid)
+                   .where(largest > 0)
+                   .values(weight=table.c.weight * maximum / largest))
+    _expire_keywords(uid)
+
+def add_weight_deltas(deltas):
+    """Adds to the keyword weights of several profiles at once.
+
+    Like :func:`add_keyword_weights`, but takes a single
+    ``INSERT ... ON CONFLICT DO UPDATE`` for any number of profiles.
+
+    Args:
+        deltas (Dict[Tuple[int, int], float]): The amount to add to each
+            weight, by profile id and keyword id.
+
+    """
+    if not deltas:
+        return
+    table = ProfileKeywordAssociation.__table__
+    stmt = insert(table).values([{'left_id': uid, 'right_id': k, 'weight': w}
+                                 for (uid, k), w in sorted(deltas.items())])
+    session.execute(stmt.on_conflict_do_update(
+        index_elements=[table.c.left_id, table.c.right_id],
+        set_={'weight': table.c.weight + stmt.excluded.weight}))
+    for uid in {uid for uid, _ in deltas}:
+        _expire_keywords(uid)
+
+def scale_profiles(uids, maximum):
+    """Like :func:`scale_keyword_weights`, for several profiles at once.
+
+    Args:
+        uids (Iterable[int]): The ids of the profiles.
+        maximum (float): The new largest weight of each.
+
+    """
+    uids = sorted(set(uids))
+    if not uids:
+        return
+    table = ProfileKeywordAssociation.__table__
+    largest = (select([table.c.left_id, func.max(table.c.weight)
+                                            .label('weight')])
+              .where(table.c.left_id.in_(uids))
+              .group_by(table.c.left_id)
+              .alias())
+    session.execute(table.update()
+                   .where(table.c.left_id == largest.c.left_id)
+                   .where(largest.c.weight > 0)
+                   .values(weight=table.c.weight * maximum / largest.c.weight))
+    for uid in uids:
+        _expire_keywords(uid)
+
+def add_contributions(contributions):
+    """Records the keywords that papers contribute to profiles.
+
+    Args:
+        contributions (Dict[Tuple[int, int, int], int]): The number of
+            times each keyword occurs, by profile id, keyword id and
+            year of publication.
+
+    """
+    if not contributions:
+        return
+    table = KeywordContribution.__table__
+    stmt = insert(table).values([{ 'profile_id': uid
+                                 , 'keyword_id': k
+                                 , 'year': year
+                                 , 'occurrences': n
+                                 } for (uid, k, year), n
+                                 in sorted(contributions.items())])
+    session.execute(stmt.on_conflict_do_update(
+        index_elements=[table.c.profile_id, table.c.keyword_id, table.c.year],
+        set_={'occurrences': table.c.occurrences + stmt.excluded.occurrences}))
+
+def reweigh_profiles(weight, maximum, uids=None):
+    """Recomputes keyword weights from their contributions.
+
+    Each keyword of a profile is weighted by the sum of its
+    occurrences in each year, times the ``weight`` of that year, and
+    the weights of each profile are scaled so that the largest is
+    ``maximum``. This is a single ``UPDATE``, however many profiles
+    there are. Keywords without any contributions, such as those added
+    by hand, are left as they are, as are those that have been removed.
+
+    Nothing is committed. Afterwards, call :func:`profiles_changed`
+    with ``uids``, or :func:`reset_indexes` if they weren't given.
+
+    Args:
+        weight (Callable[[ColumnElement], ColumnElement]): Gives the
+            weight of one occurrence as a SQL expression of the year.
+        maximum (float): The new largest weight of each profile.
+        uids (Optional[Iterable[int]]): The profiles to reweigh.
+            Defaults to all of them.
+
+    Returns:
+        (int): The number of weights updated.
+
+    """
+    table = ProfileKeywordAssociation.__table__
+    contribution = KeywordContribution.__table__
+    summed = (select([ contribution.c.profile_id
+                     , contribution.c.keyword_id
+                     , func.sum(contribution.c.occurrences
+                                * weight(contribution.c.year)).label('weight')
+                     ])
+             .group_by(contribution.c.profile_id, contribution.c.keyword_id))
+    if uids is not None:
+        uids = sorted(set(uids))
+        if not uids:
+            return 0
+        summed = summed.where(contribution.c.profile_id.in_(uids))
+    summed = summed.alias('summed')
+    weights = (select([ summed.c.profile_id
+                      , summed.c.keyword_id
+                      , summed.c.weight
+                      , func.max(summed.c.weight)
+                            .over(partition_by=summed.c.profile_id)
+                            .label('largest')
+                      ])
+              .alias('weights'))
+    updated = session.execute(table.update()
+            .where(table.c.left_id == weights.c.profile_id)
+            .where(table.c.right_id == weights.c.keyword_id)
+            .where(weights.c.largest > 0)
+            .values(weight=weights.c.weight * maximum / weights.c.largest))
+    if uids is None:
+        session.expire_all()
+        stale_summaries()
+    for uid in uids or ():
+        _expire_keywords(uid)
+    return updated.rowcount
+
+def replace_contributions(contributions):
+    """Replaces the keyword contributions of some profiles.
+
+    Args:
+        contributions (Dict[int, Dict[Tuple[int, int], int]]): The new
+            contributions of each profile, by profile id, as
+            occurrences by keyword id and year.
+
+    """
+    table = KeywordContribution.__table__
+    uids = sorted(contributions)
+    for chunk in range(0, len(uids), 1000):
+        session.execute(table.delete().where(
+                table.c.profile_id.in_(uids[chunk:chunk + 1000])))
+    rows = [{'profile_id': uid, 'keyword_id': k, 'year': year,
+             'occurrences': n}
+            for uid in uids for (k, year), n in contributions[uid].items()]
+    for chunk in range(0, len(rows), 5000):
+        session.execute(table.insert().values(rows[chunk:chunk + 5000]))
+
+def remove_keywords(uid, names):
+    """Removes some keywords from a profile.
+
+    Args:
+        uid (int): The id of the profile.
+        names (Iterable[str]): The keywords to remove. Any the profile
+            doesn't have are ignored.
+
+    """
+    names = list(names)
+    if not names:
+        return
+    table = ProfileKeywordAssociation.__table__
+    ids = select([Keyword.id]).where(Keyword.name.in_(names))
+    session.execute(table.delete()
+                   .where(table.c.left_id == uid)
+                   .where(table.c.right_id.in_(ids)))
+    contribution = KeywordContribution.__table__
+    session.execute(contribution.delete()
+                   .where(contribution.c.profile_id == uid)
+                   .where(contribution.c.keyword_id.in_(ids)))
+    _expire_keywords(uid)
+
+def purge_keywords(names=(), pattern=None):
+    """Deletes keywords from every profile, and from the database.
+
+    This takes two statements however many keywords and profiles there
+    are: one deletes every weight of the keywords, after locking them,
+    and the other deletes the keywords themselves, along with their
+    contributions.
+
+    Args:
+        names (Iterable[str]): The keywords to delete.
+        pattern (Optional[str]): A ``LIKE`` pattern, such as
+            ``'%http%'``; any keywords matching it are deleted too.
+
+    Returns:
+        (List[str], Set[int], int): The names of the keywords deleted,
+        the ids of the profiles that had any of them, and the number of
+        weights deleted.
+
+    """
+    names = sorted(set(names))
+    conditions = []
+    if names:
+        conditions.append(Keyword.name.in_(names))
+    if pattern is not None:
+        conditions.append(Keyword.name.like(pattern))
+    if not conditions:
+        return [], set(), 0
+    table = ProfileKeywordAssociation.__table__
+    doomed = (select([Keyword.id])
+             .where(or_(*conditions))
+             .with_for_update())
+    uids = [uid for uid, in session.execute(table.delete()
+                   .where(table.c.right_id.in_(doomed))
+                   .returning(table.c.left_id))]
+    keywords = Keyword.__table__
+    deleted = [name for name, in session.execute(keywords.delete()
+                   .where(or_(*conditions))
+                   .returning(keywords.c.name))]
+    for uid in set(uids):
+        _expire_keywords(uid)
+    return deleted, set(uids), len(uids)
+
+def sweep_orphan_keywords(limit=1000):
+    """Deletes keywords that no profile has.
+
+    Keywords in use by a transaction that hasn't committed yet, see
+    :func:`keyword_ids`, are skipped rather than waited for.
+
+    Args:
+        limit (int): The most keywords to delete.
+
+    Returns:
+        (List[str]): The names of the keywords deleted.
+
+    """
+    table = ProfileKeywordAssociation.__table__
+    keywords = Keyword.__table__
+    orphans = (select([keywords.c.id])
+              .where(~exists().where(table.c.right_id == keywords.c.id))
+              .limit(limit)
+              .with_for_update(skip_locked=True))
+    return [name for name, in session.execute(keywords.delete()
+                   .where(keywords.c.id.in_(orphans))
+                   .returning(keywords.c.name))]
+
+def add_publication(uid, publication_id):
+    """Records that a profile is an author of a publication.
+
+    Args:
+        uid (int): The id of the profile.
+        publication_id (int): The id of the publication.
+
+    """
+    table = profile_publication_association
+    session.execute(insert(table)
+                   .values(profile_id=uid, publication_id=publication_id)
+                   .on_conflict_do_nothing())
+    profile = session.identity_map.get(identity_key(Profile, uid))
+    if profile is not None:
+        session.expire(profile, ['publications'])
+
+def replace_ontology_closure(rows, bind=None):
+    """Replaces the contents of the ontology closure table.
+
+    Args:
+        rows (Sequence[dict]): The new rows, with the columns of
+            :class:`OntologyClosure` as keys.
+        bind: The connection to use. Defaults to :data:`session`,
+            which the caller must commit.
+
+    """
+    bind = session if bind is None else bind
+    table = OntologyClosure.__table__
+    bind.execute(table.delete())
+    # one multi-row INSERT per chunk is far faster than executemany
+    for chunk in range(0, len(rows), 5000):
+        bind.execute(table.insert().values(rows[chunk:chunk + 5000]))
+
+def get_extractions(keys):
+    """Looks up cached keyword extractions.
+
+    Args:
+        keys (Iterable[str]): The keys of the texts.
+
+    Returns:
+        (Dict[str, Tuple[str]]): The keywords of each text that has
+        been cached, by key.
+
+    """
+    keys = list(keys)
+    if not keys:
+        return {}
+    table = KeywordExtraction.__table__
+    rows = session.execute(select([table.c.key, table.c.keywords])
+                          .where(table.c.key.in_(keys)))
+    return {key: tuple(keywords) for key, keywords in rows}
+
+def add_extractions(extractions, version, bind=None):
+    """Caches keyword extractions, keeping any already cached.
+
+    Args:
+        extractions (Dict[str, Sequence[str]]): The keywords of each
+            text, by key.
+        version (str): The version of the pipeline that produced them.
+        bind: The connection to use. Defaults to :data:`session`,
+            which the caller must commit.
+
+    """
+    if not extractions:
+        return
+    bind = session if bind is None else bind
+    table = KeywordExtraction.__table__
+    bind.execute(insert(table)
+                .values([{'key': k, 'version': version, 'keywords': list(v)}
+                         for k, v in sorted(extractions.items())])
+                .on_conflict_do_nothing(index_elements=['key']))
+
+def prune_extractions(version):
+    """Removes the cached extractions of other pipeline versions.
+
+    Returns:
+        (int): The number of extractions removed.
+
+    """
+    table = KeywordExtraction.__table__
+    return session.execute(table.delete()
+                          .where(table.c.version != version)).rowcount
+
+def _keyword_terms():
+    """Every keyword under its own name and those of its ancestors.
+
+    Each row is a keyword id, a name it can be found by, and the
+    fraction of its weight that counts towards that name.
+
+    """
+    closure = OntologyClosure.__table__
+    own = select([ Keyword.id.label('id')
+                 , Keyword.name.label('term')
+                 , literal(1.).label('weight')
+                 ])
+    inherited = (select([Keyword.id, closure.c.ancestor, closure.c.weight])
+                .select_from(Keyword.__table__.join(
+                        closure, closure.c.concept == Keyword.name)))
+    return union_all(own, inherited).alias('terms')
+
+def profiles_changed(uids):
+    """Tells each of :data:`profile_listeners` that profiles have changed.
+
+    This should be called after committing changes to the keywords of
+    some profiles, so that any in-memory indexes can be updated.
+
+    Args:
+        uids (Iterable[int]): The ids of the changed profiles.
+
+    """
+    uids = set(uids)
+    for listener in profile_listeners:
+        listener(uids)
+    publish_changes('profiles', sorted(uids))
+
+def reset_indexes():
+    """Tells every in-memory index to reload, here and elsewhere.
+
+    This should be called after committing a change to the keywords
+    of every profile, such as by :func:`reweigh_profiles`, where
+    reloading is cheaper than refreshing each profile. Other processes
+    running a :class:`ChangeListener` are told too.
+
+    """
+    _reset()
+    publish_changes('reset', [None])
+
+def _reset():
+    for listener in reset_listeners:
+        listener()
+
+#: The Postgres channel on which processes publish their changes.
+CHANGES_CHANNEL = 'oblong_changes'
+#: The most bytes of changes sent in one notification. Postgres
+#: refuses payloads of 8000 bytes or more.
+NOTIFY_BYTES = 7000
+
+_ORIGIN = uuid.uuid4().hex
+
+def _origin():
+    """Identifies this process, even once forked."""
+    return '{}.{}'.format(_ORIGIN, os.getpid())
+
+def publish_changes(kind, changes):
+    """Tells other processes about changes this one has committed.
+
+    Each process running a :class:`ChangeListener` passes the changes
+    on to its :data:`change_listeners` of the same kind. They are sent
+    as Postgres notifications, split so that each fits in one.
+    Failing to send them is logged, since the changes themselves are
+    already committed.
+
+    Args:
+        kind (str): The kind of change, such as ``'profiles'``.
+        changes (List): The changes, which must serialise as JSON.
+
+    """
+    if not changes:
+        return
+    messages, chunk, size = [], [], 0
+    for change in changes:
+        length = len(json.dumps(change)) + 2
+        if chunk and size + length > NOTIFY_BYTES:
+            messages.append(chunk)
+            chunk, size = [], 0
+        chunk.append(change)
+        size += length
+    messages.append(chunk)
+    origin = _origin()
+    try:
+        with engine.begin() as connection:
+            # numbered, since Postgres drops duplicate notifications
+            for part, chunk in enumerate(messages):
+                connection.execute(select([func.pg_notify(CHANGES_CHANNEL,
+                        json.dumps([origin, kind, part, chunk]))]))
+    except DBAPIError:
+        log.exception('failed to publish %d %s changes', len(changes), kind)
+
+class ChangeListener:
+    """Passes on the changes that other processes publish.
+
+    Several processes share the database, such as web server workers
+    and :mod:`oblong.ingest`, and each keeps its own in-memory indexes.
+    This listens on :data:`CHANGES_CHANNEL`, on a connection to the
+    primary of its own, in a background thread, calling
+    :data:`change_listeners` with each change published by another
+    process. Notifications sent while it isn't connected are lost, so
+    each time it connects it calls :data:`reset_listeners` first.
+
+    Args:
+        timeout (float): The most seconds to wait for a notification
+            before checking whether to stop, or whether
+            :func:`init` has been called again.
+        retry_interval (float): The number of seconds to wait before
+            reconnecting after losing the connection.
+
+    """
+    def __init__(self, timeout=1., retry_interval=5.):
+        self.timeout = timeout
+        self.retry_interval = retry_interval
+        #: Set while listening.
+        self.connected = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Starts listening in the background."""
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name='change-listener')
+        self._thread.start()
+
+    def stop(self):
+        """Stops listening."""
+        if self._thread is None:
+            return
+        self._stopped.set()
+        self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        self._origin = _origin()
+        while not self._stopped.is_set():
+            try:
+                self._listen(engine)
+            except Exception:
+                self.connected.clear()
+                log.exception('failed to listen for changes')
+                self._stopped.wait(self.retry_interval)
+        session.remove()
+
+    def _listen(self, bind):
+        connection = bind.raw_connection()
+        connection.detach()
+        try:
+            connection.connection.autocommit = True
+            cursor = connection.cursor()
+            cursor.execute('LISTEN ' + CHANGES_CHANNEL)
+            _reset()
+            self.connected.set()
+            while not self._stopped.is_set() and engine is bind:
+                if _select.select([connection.connection], [], [],
+                                  self.timeout)[0]:
+                    connection.connection.poll()
+                    notifies = connection.connection.notifies
+                    while notifies:
+                        self._dispatch(notifies.pop(0).payload)
+        finally:
+            self.connected.clear()
+            connection.close()
+
+    def _dispatch(self, payload):
+        origin, kind, _, changes = json.loads(payload)
+        if origin == self._origin:
+            return
+        for listener in change_listeners.get(kind, ()):
+            try:
+                listener(changes)
+            except Exception:
+                session.rollback()
+                log.exception('failed to apply %s changes', kind)
+        session.remove()
+
+#: The running :class:`ChangeListener`, if any.
+change_listener = None
+
+def enable_change_listener(**kwargs):
+    """Starts applying other processes' changes, see
+    :class:`ChangeListener`.
+
+    Args:
+        **kwargs: Passed to :class:`ChangeListener`.
+
+    Returns:
+        (ChangeListener): The listener, already started.
+
+    """
+    global change_listener
+    disable_change_listener()
+    change_listener = ChangeListener(**kwargs)
+    change_listener.start()
+    return change_listener
 
-def get_profiles_by_keywords(keywords, page_no, page_size):
+def disable_change_listener():
+    """Stops any change listener."""
+    global change_listener
+    if change_listener is not None:
+        change_listener.stop()
+        change_listener = None
+
+def get_profiles_by_keywords(keywords, page_no, page_size, ranking=None):
     """Gets a list of profiles that have any of the keywords.
 
     The weighting of a profile is calculated as the sum of the
     weghtings of the links between the profile and any relevant
-    keywords.
+    keywords, adjusted for how common each keyword is unless
+    ``ranking`` is ``'weight'``.
 
     Args:
         keywords (Sequence[str]): The keywords to search for.
+        ranking (Optional[str]): How to rank the profiles, see
+            :data:`SEARCH_RANKING`, which is the default.
 
     Returns:
         (int, List[Tuple[Profile, float]]): The number of results
@@ -276,16 +1629,63 @@ def get_profiles_by_keywords(keywords, page_no, page_size):
         the requested page.
 
     """
+    q = _search_profiles(Profile, keywords, ranking=ranking)
+    count = q.count()
+    return count, q.slice(page_no * page_size, (page_no + 1) * page_size)
+
+def _keyword_score(weight, ranking):
+    """How much a profile's weight of a keyword counts in a search.
+
+    Args:
+        weight: The weight, from ``profile_keyword_association``.
+        ranking (str): See :data:`SEARCH_RANKING`.
+
+    Returns:
+        The score, and the :class:`KeywordStatistics` table, to be
+        outer joined on ``keyword_id``, if the score needs it.
+
+    """
+    if ranking == 'weight':
+        return weight, None
+    stats = KeywordStatistics.__table__
+    # statistics not yet folded count as a keyword of this profile alone
+    df = func.greatest(func.coalesce(stats.c.profiles, 1), 1)
+    corpus = stats.alias('corpus')
+    n = cast(func.greatest(select([corpus.c.profiles])
+                          .where(corpus.c.keyword_id == CORPUS_STATISTICS)
+                          .as_scalar(), df), Float)
+    if ranking == 'tfidf':
+        return weight * func.ln(1. + n / df), stats
+    # weights are already scaled to the same maximum in every profile,
+    # so BM25's document length normalisation is left out (b = 0), and
+    # the term frequency is the weight relative to the keyword's mean
+    mean = func.coalesce(stats.c.total_weight, weight) / df
+    tf = weight / func.nullif(mean, 0)
+    idf = func.ln(1. + (n - df + .5) / (df + .5))
+    return func.coalesce(idf * tf * (BM25_K1 + 1) / (tf + BM25_K1), 0), stats
+
+def _search_profiles(entity, keywords, query_session=None, ranking=None):
+    """The query behind :func:`get_profiles_by_keywords`.
+
+    Args:
+        entity: What to select for each profile, along with its weight.
+        keywords (Sequence[str]): The keywords to search for.
+        query_session (Optional[Session]): The session to query.
+            Defaults to :data:`session`.
+        ranking (Optional[str]): See :data:`SEARCH_RANKING`, which is
+            the default.
+
+    """
+    query_session = session if query_session is None else query_session
+    ranking = SEARCH_RANKING if ranking is None else ranking
+    if ranking not in RANKINGS:
+        raise ValueError('unknown ranking {!r}'.format(ranking))
+
     def contains_any(col, keywords):
         return or_(*[col.like('%' + k + '%') for k in keywords])
  
     keywords = [k.lower() for k in keywords]
 
-    weight_sum = (func
-                 .sum(ProfileKeywordAssociation.weight)
-                 .label('weight_sum')
-                 )
-
     searched_columns = [ Profile.firstname
                        , Profile.lastname
                        , Profile.department
@@ -296,15 +1696,10 @@ def get_profiles_by_keywords(keywords, page_no, page_size):
 
     searched_columns = [func.lower(s) for s in searched_columns]
 
-    q = (session.query(Profile, weight_sum)
-        .join(ProfileKeywordAssociation)
-        .join(Keyword)
-        )
-
     notkeywords = set()
     cond = None
     for col in searched_columns:
-        matches = (session.query(col)
+        matches = (query_session.query(col)
                   .filter(contains_any(col, keywords))
                   .distinct().all()
                   )
@@ -315,17 +1710,341 @@ def get_profiles_by_keywords(keywords, page_no, page_size):
                 cond = col.in_(matches)
             cond |= col.in_(matches)
     
-    if cond is not None:
-        q = q.filter(cond)
-
     for k0 in notkeywords:
         for k1 in keywords:
             if k1 in k0:
                 keywords.remove(k1)
 
     if keywords:
-        q = q.filter(contains_any(Keyword.name, keywords))
+        # a concept also matches the keywords below it in the ontology.
+        # The weights are summed before they are joined to profiles, by
+        # the column profile_keyword_association is partitioned on, so
+        # that each of its partitions can be summed separately.
+        terms = _keyword_terms()
+        assoc = ProfileKeywordAssociation.__table__
+        score, stats = _keyword_score(assoc.c.weight, ranking)
+        matched = assoc.join(terms, terms.c.id == assoc.c.right_id)
+        if stats is not None:
+            matched = matched.outerjoin(stats,
+                                        stats.c.keyword_id == assoc.c.right_id)
+        weights = (select([ assoc.c.left_id
+                          , func.sum(score * terms.c.weight).label('weight')
+                          ])
+                  .select_from(matched)
+                  .where(contains_any(terms.c.term, keywords))
+                  .group_by(assoc.c.left_id)
+                  .alias('weights'))
+        weight_sum = weights.c.weight.label('weight_sum')
+        q = (query_session.query(entity, weight_sum)
+            .select_from(Profile)
+            .join(weights, weights.c.left_id == Profile.id)
+            )
+    else:
+        weight_sum = (func
+                     .sum(ProfileKeywordAssociation.weight)
+                     .label('weight_sum')
+                     )
+        q = (query_session.query(entity, weight_sum)
+            .select_from(Profile)
+            .join(ProfileKeywordAssociation)
+            )
 
-    q = q.group_by(Profile.id).order_by(desc('weight_sum'))
-    count = q.count()
-    return count, q.slice(page_no * page_size, (page_no + 1) * page_size)
+    if cond is not None:
+        q = q.filter(cond)
+    if not keywords:
+        q = q.group_by(Profile.id)
+
+    return q.order_by(desc('weight_sum'), Profile.id)
+
+# ------------ READ MODEL -----------------
+# The functions below serve the read-only endpoints. They run Core
+# statements and return plain tuples, skipping the cost of building
+# ORM objects and tracking them in the session's identity map. Each
+# takes an optional ``bind``, the connection to use, defaulting to
+# :data:`session`; :mod:`oblong.asgi` passes its own.
+
+class ProfileRow(namedtuple('ProfileRow', [ 'id', 'title', 'firstname'
+                                          , 'lastname', 'initials', 'alias'
+                                          , 'email', 'faculty', 'department'
+                                          , 'campus', 'building', 'room'
+                                          , 'website'
+                                          ])):
+    """A read-only profile, without its keywords or publications."""
+    __slots__ = ()
+
+    name = Profile.name
+
+class SummaryRow(namedtuple('SummaryRow', [ 'id', 'title', 'firstname'
+                                          , 'lastname', 'initials', 'alias'
+                                          , 'email', 'faculty', 'department'
+                                          , 'top_keywords'
+                                          ])):
+    """What lists of people show of a profile, see :func:`read_summaries`."""
+    __slots__ = ()
+
+    name = Profile.name
+
+#: A read-only publication, without its authors.
+PublicationRow = namedtuple('PublicationRow', 'id title abstract date')
+
+_profile_columns = [Profile.__table__.c[f] for f in ProfileRow._fields]
+_summary_columns = [Profile.__table__.c[f] for f in SummaryRow._fields]
+_publication_columns = [Publication.__table__.c[f]
+                        for f in PublicationRow._fields]
+
+def read_profile(uid, bind=None):
+    """Reads a profile.
+
+    Returns:
+        (Optional[ProfileRow]): The profile, or ``None`` if there is no
+        profile with id ``uid``.
+
+    """
+    bind = session if bind is None else bind
+    row = bind.execute(select(_profile_columns)
+                      .where(Profile.id == uid)).first()
+    return ProfileRow(*row) if row else None
+
+def read_profiles(uids, bind=None):
+    """Reads several profiles.
+
+    Args:
+        uids (Sequence[int]): The ids of the profiles.
+
+    Returns:
+        (List[ProfileRow]): The profiles that exist, in the order of
+        ``uids``.
+
+    """
+    bind = session if bind is None else bind
+    if not uids:
+        return []
+    rows = bind.execute(select(_profile_columns)
+                       .where(Profile.id.in_(uids)))
+    found = {row.id: ProfileRow(*row) for row in rows}
+    return [found[uid] for uid in uids if uid in found]
+
+def read_profile_page(page_no, page_size, bind=None):
+    """Reads a page of profiles, in order of id."""
+    bind = session if bind is None else bind
+    rows = bind.execute(select(_profile_columns)
+                       .order_by(Profile.id)
+                       .offset(page_no * page_size)
+                       .limit(page_size))
+    return [ProfileRow(*row) for row in rows]
+
+def read_summaries(uids, bind=None):
+    """Reads the summaries of several profiles.
+
+    Summaries are kept on the ``profile`` table, so this reads no other.
+
+    Args:
+        uids (Sequence[int]): The ids of the profiles.
+
+    Returns:
+        (List[SummaryRow]): The summaries of the profiles that exist,
+        in the order of ``uids``.
+
+    """
+    bind = session if bind is None else bind
+    if not uids:
+        return []
+    rows = bind.execute(select(_summary_columns)
+                       .where(Profile.id.in_(uids)))
+    found = {row.id: SummaryRow(*row) for row in rows}
+    return [found[uid] for uid in uids if uid in found]
+
+def read_summary_page(page_no, page_size, bind=None):
+    """Reads a page of profile summaries, in order of id."""
+    bind = session if bind is None else bind
+    rows = bind.execute(select(_summary_columns)
+                       .order_by(Profile.id)
+                       .offset(page_no * page_size)
+                       .limit(page_size))
+    return [SummaryRow(*row) for row in rows]
+
+def read_keywords(uids, n=None, bind=None):
+    """Reads the keywords of several profiles.
+
+    Args:
+        uids (Sequence[int]): The ids of the profiles.
+        n (Optional[int]): The number of keywords to read for each
+            profile, or ``None`` to read them all.
+
+    Returns:
+        (Dict[int, List[Tuple[str, float]]]): For each profile with
+        any keywords, their names and weights, heaviest first.
+
+    """
+    bind = session if bind is None else bind
+    keywords = {}
+    if not uids:
+        return keywords
+    assoc = ProfileKeywordAssociation.__table__
+    order = (desc(assoc.c.weight), Keyword.name)
+    q = (select([assoc.c.left_id, Keyword.name, assoc.c.weight])
+        .select_from(assoc.join(Keyword.__table__,
+                                Keyword.id == assoc.c.right_id))
+        .where(assoc.c.left_id.in_(uids)))
+    if n is not None:
+        rank = func.row_number().over(partition_by=assoc.c.left_id,
+                                      order_by=order)
+        ranked = q.column(rank.label('rank')).alias()
+        q = (select([ranked.c.left_id, ranked.c.name, ranked.c.weight])
+            .where(ranked.c.rank <= n)
+            .order_by(ranked.c.left_id, ranked.c.rank))
+    else:
+        q = q.order_by(assoc.c.left_id, *order)
+    for uid, name, weight in bind.execute(q):
+        keywords.setdefault(uid, []).append((name, weight))
+    return keywords
+
+def read_publications_of(uid, n=None, bind=None):
+    """Reads the publications of a profile, in order of id.
+
+    Args:
+        uid (int): The id of the profile.
+        n (Optional[int]): The number of publications to read, or
+            ``None`` to read them all.
+
+    Returns:
+        (List[PublicationRow]): The publications.
+
+    """
+    bind = session if bind is None else bind
+    table = profile_publication_association
+    rows = bind.execute(select(_publication_columns)
+                       .select_from(Publication.__table__.join(table))
+                       .where(table.c.profile_id == uid)
+                       .order_by(Publication.id)
+                       .limit(n))
+    return [PublicationRow(*row) for row in rows]
+
+def read_publication(uid, bind=None):
+    """Reads a publication.
+
+    Returns:
+        (Optional[PublicationRow]): The publication, or ``None`` if
+        there is no publication with id ``uid``.
+
+    """
+    bind = session if bind is None else bind
+    row = bind.execute(select(_publication_columns)
+                      .where(Publication.id == uid)).first()
+    return PublicationRow(*row) if row else None
+
+def read_publication_page(page_no, page_size, bind=None):
+    """Reads a page of publications, in order of id."""
+    bind = session if bind is None else bind
+    rows = bind.execute(select(_publication_columns)
+                       .order_by(Publication.id)
+                       .offset(page_no * page_size)
+                       .limit(page_size))
+    return [PublicationRow(*row) for row in rows]
+
+def read_authors(publication_ids, bind=None):
+    """Reads the authors of several publications.
+
+    Args:
+        publication_ids (Sequence[int]): The ids of the publications.
+
+    Returns:
+        (Dict[int, List[int]]): For each publication with any authors,
+        their profile ids in ascending order.
+
+    """
+    bind = session if bind is None else bind
+    authors = {}
+    if not publication_ids:
+        return authors
+    table = profile_publication_association
+    rows = bind.execute(select([table.c.publication_id, table.c.profile_id])
+                       .where(table.c.publication_id.in_(publication_ids))
+                       .order_by(table.c.publication_id,
+                                 table.c.profile_id))
+    for publication_id, uid in rows:
+        authors.setdefault(publication_id, []).append(uid)
+    return authors
+
+def read_profiles_by_keyword(name, page_no=0, page_size=KEYWORD_PAGE_SIZE,
+                             bind=None):
+    """Gets the profiles that have a keyword, most relevant first.
+
+    If the keyword is a concept in the ontology, profiles with any of
+    the concepts below it are included too, as in
+    :func:`get_profiles_by_keywords`, and their weights are summed.
+    Otherwise the keyword's postings are read in order from
+    ``ix_profile_keyword_postings``, stopping at the end of the page.
+
+    Args:
+        name (str): The exact name of the keyword.
+        page_no (int): The number of the page to return.
+        page_size (int): The number of results per page.
+
+    Returns:
+        (Optional[List[Tuple[ProfileRow, float]]]): The profiles with
+        the keyword and their weights for it, sorted by weight in
+        descending order, or ``None`` if there is no such keyword.
+
+    """
+    bind = session if bind is None else bind
+    assoc = ProfileKeywordAssociation.__table__
+    closure = OntologyClosure.__table__
+    concept = bind.execute(select([literal(1)])
+                          .where(closure.c.ancestor == name)
+                          .limit(1)).first() is not None
+    if concept:
+        own = (select([Keyword.id.label('id'), literal(1.).label('weight')])
+              .where(Keyword.name == name))
+        inherited = (select([Keyword.id, closure.c.weight])
+                    .select_from(Keyword.__table__.join(
+                            closure, closure.c.concept == Keyword.name))
+                    .where(closure.c.ancestor == name))
+        terms = union_all(own, inherited).alias('terms')
+        weight = func.sum(assoc.c.weight * terms.c.weight).label('weight')
+        q = (select(_profile_columns + [weight])
+            .select_from(terms
+                        .join(assoc, assoc.c.right_id == terms.c.id)
+                        .join(Profile.__table__,
+                              Profile.id == assoc.c.left_id))
+            .group_by(Profile.id)
+            .order_by(desc(weight), Profile.id))
+    else:
+        q = (select(_profile_columns + [assoc.c.weight])
+            .select_from(Keyword.__table__
+                        .join(assoc, assoc.c.right_id == Keyword.id)
+                        .join(Profile.__table__,
+                              Profile.id == assoc.c.left_id))
+            .where(Keyword.name == name)
+            .order_by(desc(assoc.c.weight), assoc.c.left_id))
+    rows = bind.execute(q.offset(page_no * page_size)
+                        .limit(page_size)).fetchall()
+    if not rows and not concept:
+        known = select([Keyword.id]).where(Keyword.name == name)
+        if bind.execute(known).first() is None:
+            return None
+    return [(ProfileRow(*row[:-1]), row[-1]) for row in rows]
+
+def search_profiles(keywords, page_no, page_size, bind=None, ranking=None):
+    """Like :func:`get_profiles_by_keywords`, but returns ids.
+
+    Returns:
+        (int, List[Tuple[int, float]]): The number of results, and the
+        ids and weightings of the profiles on the requested page.
+
+    """
+    query_session = session if bind is None else Session(bind=bind)
+    try:
+        q = _search_profiles(Profile.id, keywords, query_session, ranking)
+        count = q.count()
+        return count, q.slice(page_no * page_size,
+                              (page_no + 1) * page_size).all()
+    finally:
+        if bind is not None:
+            query_session.close()
+
+def read_count(model, bind=None):
+    """Counts the rows of a model's table."""
+    bind = session if bind is None else bind
+    return bind.execute(select([func.count()])
+                       .select_from(model.__table__)).scalar()
@@ -1,16 +1,44 @@
+import atexit
+import math
+import queue
+import threading
+import time
 import unittest
+from unittest import mock
 import testing.postgresql
-from . import database as db
+from sqlalchemy import create_engine
+from . import database as db, migrations
 
-Postgresql = testing.postgresql.PostgresqlFactory(cache_initialized_db=True)
+def migrate(postgresql):
+    engine = create_engine(postgresql.url())
+    migrations.upgrade(engine)
+    engine.dispose()
 
-def gpbk(keywords):
-    count, results = db.get_profiles_by_keywords(keywords, 0, 25)
+# migrate the cached database once, rather than every test's copy
+Postgresql = testing.postgresql.PostgresqlFactory(cache_initialized_db=True,
+                                                  on_initialized=migrate)
+
+def gpbk(keywords, ranking=None):
+    count, results = db.get_profiles_by_keywords(keywords, 0, 25, ranking)
     return count, list(results)
 
-def tearDownModule():
-    # clear cached database at end of tests
-    Postgresql.clear_cache()
+def keyword_statistics():
+    """The folded statistics of each keyword, by name."""
+    stats = db.KeywordStatistics.__table__
+    rows = db.session.execute(
+            db.select([db.Keyword.name, stats.c.profiles, stats.c.total_weight])
+            .select_from(stats.join(db.Keyword.__table__,
+                                    db.Keyword.id == stats.c.keyword_id)))
+    return {name: (profiles, weight) for name, profiles, weight in rows}
+
+def corpus_statistics():
+    """The folded number of profiles."""
+    return db.session.query(db.KeywordStatistics.profiles).filter_by(
+            keyword_id=db.CORPUS_STATISTICS).scalar()
+
+# clear cached database at end of tests; other test modules share it,
+# so this can't be done in tearDownModule
+atexit.register(Postgresql.clear_cache)
 
 class DatabaseTestCase(unittest.TestCase):
     def setUp(self):
@@ -21,6 +49,73 @@ class DatabaseTestCase(unittest.TestCase):
         db.session.remove()
         self.postgresql.stop()
 
+class ChangeListenerTestCase(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.heard = queue.Queue()
+        self.resets = []
+        db.change_listeners['test'].append(self.heard.put)
+        db.reset_listeners.append(lambda: self.resets.append(1))
+        listener = db.enable_change_listener(timeout=.1)
+        self.assertTrue(listener.connected.wait(10))
+
+    def tearDown(self):
+        db.disable_change_listener()
+        del db.change_listeners['test']
+        db.reset_listeners.pop()
+        super().tearDown()
+
+    def publish(self, changes):
+        """Publishes changes as if from another process."""
+        with mock.patch.object(db, '_origin', return_value='other'):
+            db.publish_changes('test', changes)
+
+    def testResetOnConnect(self):
+        self.assertEqual(self.resets, [1])
+
+    def testOtherProcesses(self):
+        self.publish([1, 2])
+        self.assertEqual(self.heard.get(timeout=10), [1, 2])
+
+    def testOwnChangesIgnored(self):
+        db.publish_changes('test', ['mine'])
+        self.publish(['theirs'])
+        self.assertEqual(self.heard.get(timeout=10), ['theirs'])
+
+    def testResetOtherProcesses(self):
+        with mock.patch.object(db, '_origin', return_value='other'):
+            db.reset_indexes()
+        for _ in range(100):
+            if len(self.resets) == 3:
+                break
+            time.sleep(.1)
+        self.assertEqual(self.resets, [1, 1, 1])
+
+    def testSplit(self):
+        changes = ['x' * 1000 for _ in range(20)]
+        self.publish(changes)
+        heard = []
+        while len(heard) < len(changes):
+            chunk = self.heard.get(timeout=10)
+            self.assertLess(len(chunk), len(changes))
+            heard.extend(chunk)
+        self.assertEqual(heard, changes)
+
+    def testReconnect(self):
+        db.change_listener.retry_interval = 0
+        db.session.execute("SELECT pg_terminate_backend(pid) "
+                           "FROM pg_stat_activity "
+                           "WHERE query = 'LISTEN oblong_changes'")
+        db.session.commit()
+        for _ in range(100):
+            if len(self.resets) == 2:
+                break
+            time.sleep(.1)
+        self.assertEqual(self.resets, [1, 1])
+        self.assertTrue(db.change_listener.connected.wait(10))
+        self.publish(['again'])
+        self.assertEqual(self.heard.get(timeout=10), ['again'])
+
 class KeywordDictTestCase(DatabaseTestCase):
     def setUp(self):
         super().setUp()
@@ -137,6 +232,407 @@ class QuerySortingTestCase(QueryTestCase):
                         , (2, [(self.mary, 2.), (self.john, 1.)])
                         )
 
+class PostingsTestCase(QueryTestCase):
+    def postings(self, *args):
+        results = db.read_profiles_by_keyword(*args)
+        return results if results is None else [(p.id, w) for p, w in results]
+
+    def testOrderedByWeight(self):
+        self.assertEqual( self.postings('horse')
+                        , [(self.mary.id, 2.), (self.john.id, 1.)]
+                        )
+
+    def testPaging(self):
+        self.assertEqual(self.postings('cart', 0, 1), [(self.jane.id, 4.)])
+        self.assertEqual(self.postings('cart', 1, 1), [(self.mary.id, 3.)])
+        self.assertEqual(self.postings('cart', 2, 1), [])
+
+    def testExactMatch(self):
+        self.assertIsNone(self.postings('car'))
+        self.assertIsNone(self.postings('car', 1, 1))
+
+    def testNoProfiles(self):
+        db.session.add(db.Keyword(name='unicorn'))
+        db.session.commit()
+        self.assertEqual(self.postings('unicorn'), [])
+
+class ReadModelTestCase(QueryTestCase):
+    def testProfile(self):
+        profile = db.read_profile(self.peng.id)
+        self.assertIsInstance(profile, db.ProfileRow)
+        self.assertEqual(profile.name, self.peng.name)
+        self.assertEqual(profile.campus, 'South Kensington')
+        self.assertIsNone(db.read_profile(1000))
+
+    def testProfilesInOrder(self):
+        uids = [self.mary.id, 1000, self.john.id]
+        self.assertEqual( [p.firstname for p in db.read_profiles(uids)]
+                        , ['Mary', 'John']
+                        )
+        self.assertEqual( [p.id for p in db.read_profile_page(1, 2)]
+                        , [self.mary.id, self.peng.id]
+                        )
+
+    def testSummaries(self):
+        uids = [self.jane.id, 1000, self.peng.id]
+        summaries = db.read_summaries(uids)
+        self.assertEqual([s.id for s in summaries], [self.jane.id, self.peng.id])
+        self.assertEqual(summaries[0].name, self.jane.name)
+        self.assertEqual(summaries[0].top_keywords, ['descartes', 'cart'])
+        self.assertEqual( [s.id for s in db.read_summary_page(1, 2)]
+                        , [self.mary.id, self.peng.id]
+                        )
+
+    def testKeywords(self):
+        uids = [self.john.id, self.jane.id, 1000]
+        self.assertEqual( db.read_keywords(uids)
+                        , { self.john.id: [('porcupine taming', 1.25),
+                                           ('horse', 1.)]
+                          , self.jane.id: [('descartes', 5.), ('cart', 4.)]
+                          }
+                        )
+        self.assertEqual( db.read_keywords(uids, n=1)
+                        , { self.john.id: [('porcupine taming', 1.25)]
+                          , self.jane.id: [('descartes', 5.)]
+                          }
+                        )
+
+    def testPublications(self):
+        paper = db.Publication(title='Horses', date='2016-01-01',
+                               authors=[self.mary, self.john])
+        db.session.add(paper)
+        db.session.commit()
+        self.assertEqual( db.read_publication(paper.id).title
+                        , 'Horses'
+                        )
+        self.assertEqual( db.read_authors([paper.id])
+                        , {paper.id: sorted([self.john.id, self.mary.id])}
+                        )
+        self.assertEqual( [p.id for p in db.read_publications_of(self.john.id)]
+                        , [paper.id]
+                        )
+
+    def testProfilesByKeyword(self):
+        self.assertEqual( [(p.id, w) for p, w in
+                           db.read_profiles_by_keyword('cart', 0, 1)]
+                        , [(self.jane.id, 4.)]
+                        )
+        self.assertEqual(db.read_profiles_by_keyword('cart', 2, 1), [])
+        self.assertIsNone(db.read_profiles_by_keyword('car'))
+
+    def testSearch(self):
+        self.assertEqual( db.search_profiles(['Peng'], 0, 25)
+                        , (2, [(self.mary.id, 5.), (self.peng.id, 2.33)])
+                        )
+
+class OntologyExpansionTestCase(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.john = db.Profile(title="Mr", firstname="John", lastname="Smith")
+        self.jane = db.Profile(title="Ms", firstname="Jane", lastname="Doe")
+        self.john.keywords["trees"] = 10.
+        self.jane.keywords["graph theory"] = 5.
+        self.jane.keywords["horse"] = 50.
+        db.session.add(self.john)
+        db.session.add(self.jane)
+        db.session.commit()
+        self.weight = dict(db.session.query(db.OntologyClosure.depth,
+                                            db.OntologyClosure.weight)
+                                     .filter_by(concept='trees'))
+
+    def testSearchExpands(self):
+        count, results = gpbk(['Discrete mathematics'])
+        self.assertEqual(count, 2)
+        self.assertEqual([p for p, _ in results], [self.john, self.jane])
+        self.assertAlmostEqual(results[0][1], 10 * self.weight[2])
+        self.assertAlmostEqual(results[1][1], 5 * self.weight[1])
+
+    def testKeywordExpands(self):
+        results = db.read_profiles_by_keyword('graph theory')
+        self.assertEqual( [p.id for p, _ in results]
+                        , [self.john.id, self.jane.id]
+                        )
+        self.assertAlmostEqual(results[0][1], 10 * self.weight[1])
+        self.assertEqual(results[1][1], 5.)
+
+    def testConceptWithoutProfiles(self):
+        self.assertEqual(db.read_profiles_by_keyword('software notations '
+                                                     'and tools'), [])
+        self.assertIsNone(db.read_profiles_by_keyword('not a concept'))
+
+class KeywordWeightsTestCase(QueryTestCase):
+    def weights(self, profile):
+        db.session.expire_all()
+        return dict(db.Profile.get(profile.id).keywords)
+
+    def testAdd(self):
+        ids = db.keyword_ids(['horse', 'unicorn'])
+        db.add_keyword_weights(self.john.id, {ids['horse']: 1.5,
+                                              ids['unicorn']: 2.})
+        db.session.commit()
+        self.assertEqual( self.weights(self.john)
+                        , {'porcupine taming': 1.25, 'horse': 2.5, 'unicorn': 2.}
+                        )
+
+    def testReplace(self):
+        ids = db.keyword_ids(['horse'])
+        db.add_keyword_weights(self.john.id, {ids['horse']: 7.}, replace=True)
+        db.session.commit()
+        self.assertEqual(self.weights(self.john)['horse'], 7.)
+
+    def testScale(self):
+        db.scale_keyword_weights(self.jane.id, 100)
+        db.session.commit()
+        self.assertEqual( self.weights(self.jane)
+                        , {'cart': 80., 'descartes': 100.}
+                        )
+
+    def testRemove(self):
+        db.remove_keywords(self.jane.id, ['cart', 'not in db'])
+        db.session.commit()
+        self.assertEqual(self.weights(self.jane), {'descartes': 5.})
+        self.assertEqual(self.weights(self.mary)['cart'], 3.)
+
+    def testConcurrentIncrements(self):
+        kid = db.keyword_ids(['horse'])['horse']
+        db.session.commit()
+
+        def work():
+            for _ in range(25):
+                db.lock_profile(self.john.id)
+                db.add_keyword_weights(self.john.id, {kid: 1.})
+                db.session.commit()
+            db.session.remove()
+
+        threads = [threading.Thread(target=work) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(self.weights(self.john)['horse'], 201.)
+
+class SummaryTestCase(QueryTestCase):
+    def summary(self, profile):
+        return db.read_summaries([profile.id])[0].top_keywords
+
+    def testOrmChanges(self):
+        self.assertEqual(self.summary(self.mary), ['cart', 'horse'])
+        self.mary.keywords['unicorn'] = 10.
+        self.mary.keywords['horse'] = 20.
+        db.session.commit()
+        self.assertEqual(self.summary(self.mary), ['horse', 'unicorn', 'cart'])
+
+    def testPlainSession(self):
+        # nothing but the ORM marks the summary stale in this session
+        s = db.session.session_factory()
+        try:
+            mary = s.query(db.Profile).get(self.mary.id)
+            mary.keywords['horse'] = 20.
+            s.commit()
+        finally:
+            s.close()
+        self.assertEqual(self.summary(self.mary), ['horse', 'cart'])
+
+    def testTopKeywordsOnly(self):
+        for i in range(db.SUMMARY_KEYWORDS + 2):
+            self.john.keywords['keyword {}'.format(i)] = 10. + i
+        db.session.commit()
+        self.assertEqual( self.summary(self.john)
+                        , ['keyword {}'.format(i) for i in
+                           range(db.SUMMARY_KEYWORDS + 1, 1, -1)]
+                        )
+
+    def testCoreChanges(self):
+        ids = db.keyword_ids(['unicorn'])
+        db.add_keyword_weights(self.john.id, {ids['unicorn']: 2.})
+        db.remove_keywords(self.jane.id, ['descartes'])
+        db.session.commit()
+        self.assertEqual( self.summary(self.john)
+                        , ['unicorn', 'porcupine taming', 'horse']
+                        )
+        self.assertEqual(self.summary(self.jane), ['cart'])
+
+    def testPurge(self):
+        db.purge_keywords(['cart', 'compsci'])
+        db.session.commit()
+        self.assertEqual(self.summary(self.mary), ['horse'])
+        self.assertEqual(self.summary(self.peng), [])
+
+    def testRollback(self):
+        db.remove_keywords(self.jane.id, ['descartes'])
+        db.session.rollback()
+        self.john.keywords['unicorn'] = 2.
+        db.session.commit()
+        self.assertEqual(self.summary(self.jane), ['descartes', 'cart'])
+
+    def testDrift(self):
+        self.assertEqual(db.drifted_summaries(), [])
+        db.session.execute("UPDATE profile SET top_keywords = '[\"x\"]' "
+                           "WHERE id = :id", {'id': self.jane.id})
+        db.session.execute("DELETE FROM profile_keyword_association "
+                           "WHERE left_id = :id", {'id': self.peng.id})
+        db.session.commit()
+        drifted = db.drifted_summaries()
+        self.assertEqual(drifted, sorted([self.jane.id, self.peng.id]))
+        db.refresh_summaries(drifted)
+        db.session.commit()
+        self.assertEqual(db.drifted_summaries(), [])
+        self.assertEqual(self.summary(self.jane), ['descartes', 'cart'])
+        self.assertEqual(self.summary(self.peng), [])
+
+class KeywordStatisticsTestCase(QueryTestCase):
+    expected = { 'porcupine taming': (1, 1.25)
+               , 'horse': (2, 3.)
+               , 'cart': (2, 7.)
+               , 'descartes': (1, 5.)
+               , 'compsci': (1, 2.33)
+               }
+
+    def testFolded(self):
+        self.assertEqual(keyword_statistics(), self.expected)
+        pending = db.session.execute(
+                db.keyword_statistics_delta.count()).scalar()
+        self.assertEqual(pending, 0)
+
+    def testChanges(self):
+        ids = db.keyword_ids(['horse', 'unicorn'])
+        db.add_keyword_weights(self.jane.id, {ids['horse']: 1.,
+                                              ids['unicorn']: 2.})
+        db.add_keyword_weights(self.john.id, {ids['horse']: 1.})
+        db.remove_keywords(self.mary.id, ['cart'])
+        self.jane.keywords['descartes'] = 6.
+        db.session.commit()
+        self.assertEqual( keyword_statistics()
+                        , dict(self.expected, horse=(3, 5.), cart=(1, 4.),
+                               unicorn=(1, 2.), descartes=(1, 6.))
+                        )
+
+    def testPurge(self):
+        db.purge_keywords(['horse'])
+        db.session.commit()
+        self.assertNotIn('horse', keyword_statistics())
+        self.assertEqual( db.session.query(db.KeywordStatistics).count()
+                        , len(self.expected)
+                        )
+
+    def testProfilesCounted(self):
+        self.assertEqual(corpus_statistics(), 4)
+        db.session.add(db.Profile(firstname="Ada", lastname="Byron"))
+        db.session.delete(self.peng)
+        db.session.add(db.Profile(firstname="Bob", lastname="Byron"))
+        db.session.commit()
+        self.assertEqual(corpus_statistics(), 5)
+        with db.engine.begin() as connection:
+            connection.execute(db.Profile.__table__.insert(),
+                               [{'firstname': 'Cy', 'lastname': 'Byron'}])
+        self.john.keywords['unicorn'] = 1.
+        db.session.commit()
+        self.assertEqual(corpus_statistics(), 6)
+
+    def testFoldedLater(self):
+        # a change committed outside a session is folded by the next
+        with db.engine.begin() as connection:
+            connection.execute(db.ProfileKeywordAssociation.__table__.delete()
+                              .where(db.ProfileKeywordAssociation.left_id
+                                     == self.jane.id))
+        self.assertEqual(keyword_statistics(), self.expected)
+        self.assertEqual(db.fold_keyword_statistics(), 2)
+        db.session.commit()
+        expected = dict(self.expected, cart=(1, 3.))
+        del expected['descartes']
+        self.assertEqual(keyword_statistics(), expected)
+
+    def testRebuild(self):
+        db.session.execute(db.KeywordStatistics.__table__.update()
+                          .values(profiles=100))
+        db.session.commit()
+        self.assertEqual(db.rebuild_keyword_statistics(), len(self.expected))
+        db.session.commit()
+        self.assertEqual(keyword_statistics(), self.expected)
+        self.assertEqual(corpus_statistics(), 4)
+
+class RankingTestCase(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.a = db.Profile(title="Mr", firstname="Abe", lastname="Smith")
+        self.b = db.Profile(title="Ms", firstname="Bea", lastname="Doe")
+        self.c = db.Profile(title="Mr", firstname="Cal", lastname="Peng")
+        self.a.keywords['horse'] = 3.
+        self.b.keywords['unicorn'] = 2.5
+        self.c.keywords['horse'] = 1.
+        for p in (self.a, self.b, self.c):
+            db.session.add(p)
+        db.session.commit()
+
+    def ranked(self, ranking):
+        count, results = gpbk(['horse', 'unicorn'], ranking)
+        self.assertEqual(count, 3)
+        return [p for p, _ in results]
+
+    def testWeight(self):
+        self.assertEqual(self.ranked('weight'), [self.a, self.b, self.c])
+
+    def testRareKeywordsFirst(self):
+        for ranking in ('tfidf', 'bm25'):
+            with self.subTest(ranking=ranking):
+                self.assertEqual( self.ranked(ranking)
+                                , [self.b, self.a, self.c]
+                                )
+
+    def testTfidfScores(self):
+        _, results = gpbk(['unicorn'], 'tfidf')
+        self.assertAlmostEqual(results[0][1], 2.5 * math.log(1 + 3 / 1))
+
+    def testUnknownRanking(self):
+        with self.assertRaises(ValueError):
+            gpbk(['horse'], 'pagerank')
+
+class IdentityKeyTestCase(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.john = db.Profile(title="Mr", firstname="John", lastname="Smith",
+                               faculty="Engineering")
+        self.paper = db.Publication(title="A Paper  about Horses")
+        db.session.add(self.john)
+        db.session.add(self.paper)
+        db.session.commit()
+
+    def testNormalisation(self):
+        self.assertEqual( db.profile_identity_key(' john', 'SMITH ', 'Engineering')
+                        , db.profile_identity_key('John', 'Smith', 'engineering')
+                        )
+        self.assertNotEqual( db.profile_identity_key('John', 'Smith', None)
+                           , db.profile_identity_key('John', None, 'Smith')
+                           )
+
+    def testKeysSetOnFlush(self):
+        self.assertEqual( self.john.identity_key
+                        , db.profile_identity_key('John', 'Smith', 'Engineering')
+                        )
+        self.assertEqual( self.paper.title_key
+                        , db.publication_title_key('a paper about horses')
+                        )
+
+    def testSqlKeysMatch(self):
+        key = db.session.query(db._sql_key(db.Profile.firstname,
+                db.Profile.lastname, db.Profile.faculty)).scalar()
+        self.assertEqual(key, self.john.identity_key)
+        key = db.session.query(db._sql_key(db.Publication.title)).scalar()
+        self.assertEqual(key, self.paper.title_key)
+
+    def testGetOneOrCreate(self):
+        key = db.profile_identity_key('JOHN', 'Smith', 'Engineering')
+        profile, existed = db.get_one_or_create(db.Profile, identity_key=key)
+        self.assertTrue(existed)
+        self.assertIs(profile, self.john)
+
+    def testUnique(self):
+        db.session.add(db.Profile(firstname="john", lastname="smith",
+                                  faculty="engineering"))
+        with self.assertRaises(db.IntegrityError):
+            db.session.commit()
+
 #class DeleteTestCase(DatabaseTestCase):
 #    keyword_name = "horse"
 #    other_keyword_name = "cart"
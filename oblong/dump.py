@@ -0,0 +1,333 @@
+"""Exports and imports the whole database with ``COPY``.
+
+Going through the ORM, a large database takes hours to move. Instead,
+:func:`export_database` streams every table straight out of Postgres
+with ``COPY ... TO STDOUT``, all from one snapshot, into a file per
+table, and :func:`import_database` streams them back in with
+``COPY ... FROM STDIN``. Tables are copied in ``binary`` form, which is
+the fastest, or as ``csv``, which can be read by other tools.
+
+Each file can be compressed, and a ``manifest.json`` records the
+schema version, the format, and the columns, number of rows and
+SHA-256 checksum of each file. An import checks all of these, and only
+loads into a database at the same schema version whose tables are all
+empty, other than those filled in by migrations. Everything is loaded
+in a single transaction:
+
+1. The tables are truncated, so that they can be loaded with
+   ``COPY ... FREEZE``, and their keys and indexes are dropped.
+2. Each table is copied in.
+3. The indexes and keys are recreated, each in one pass over its
+   table, the sequences of the ``id`` columns are moved past the
+   largest ids loaded, and the tables are analyzed.
+
+Examples:
+    Move a database, with the schema created by ``oblong migrate``::
+
+        $ oblong --database-url $OLD export dump --compress gzip
+        $ oblong --database-url $NEW import dump
+
+"""
+from collections import namedtuple
+import bz2
+import datetime
+import gzip
+import hashlib
+import json
+import logging
+import lzma
+import os
+import time
+
+from . import database as db
+from . import migrations
+
+log = logging.getLogger(__name__)
+
+#: The version of the manifest's layout.
+MANIFEST_VERSION = 1
+
+MANIFEST = 'manifest.json'
+
+FORMATS = ('binary', 'csv')
+
+#: How to open a file with each kind of compression.
+COMPRESSION = { None: open
+              , 'gzip': lambda path, mode: gzip.open(path, mode,
+                                                     compresslevel=1)
+              , 'bz2': bz2.open
+              , 'xz': lzma.open
+              }
+
+_SUFFIXES = {None: '', 'gzip': '.gz', 'bz2': '.bz2', 'xz': '.xz'}
+
+#: Tables filled in by migrations, so that are replaced by an import
+#: rather than having to be empty.
+REPLACED = {'ontology_closure'}
+
+#: The memory each index build may use while importing.
+MAINTENANCE_WORK_MEM = '256MB'
+
+#: The number of bytes read at a time while importing.
+BUFFER_SIZE = 1 << 20
+
+#: The outcome of an export or import. ``bytes`` is the size of the
+#: tables before compression.
+Report = namedtuple('Report', 'tables rows bytes seconds')
+
+class ManifestError(ValueError):
+    """A dump can't be imported into this database."""
+
+class _Hashed:
+    """Wraps a file, hashing and counting the bytes passed through it."""
+    def __init__(self, f):
+        self.f = f
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.sha256.update(data)
+        self.size += len(data)
+        return self.f.write(data)
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.sha256.update(data)
+        self.size += len(data)
+        return data
+
+def tables():
+    """Every table of the models, with each after those it refers to."""
+    return db.Base.metadata.sorted_tables
+
+def _options(fmt, *extra):
+    options = ['FORMAT binary'] if fmt == 'binary' \
+              else ['FORMAT csv', 'HEADER']
+    return '({})'.format(', '.join(options + list(extra)))
+
+def _columns(table):
+    return ', '.join('"{}"'.format(c.name) for c in table.columns)
+
+def export_database(directory, fmt='binary', compression=None):
+    """Writes every table to a directory.
+
+    The tables are read in one ``REPEATABLE READ`` transaction, so
+    together they are consistent, even if the database is written to
+    meanwhile.
+
+    Args:
+        directory (str): Where to write the files. It is created if it
+            doesn't exist.
+        fmt (str): ``'binary'`` or ``'csv'``.
+        compression (Optional[str]): ``'gzip'``, ``'bz2'`` or ``'xz'``.
+
+    Returns:
+        (Report): How much was written.
+
+    """
+    if fmt not in FORMATS:
+        raise ValueError('unknown format: {}'.format(fmt))
+    opener = COMPRESSION[compression]
+    os.makedirs(directory, exist_ok=True)
+    start = time.perf_counter()
+    manifest = { 'version': MANIFEST_VERSION
+               , 'schema_version': migrations.current_version(db.engine)
+               , 'format': fmt
+               , 'compression': compression
+               , 'created_at': datetime.datetime.utcnow().isoformat()
+               , 'tables': []
+               }
+    connection = db.engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, '
+                       'READ ONLY')
+        for table in tables():
+            name = table.name + '.' + fmt + _SUFFIXES[compression]
+            started = time.perf_counter()
+            with opener(os.path.join(directory, name), 'wb') as f:
+                out = _Hashed(f)
+                cursor.copy_expert('COPY {} ({}) TO STDOUT WITH {}'.format(
+                        table.name, _columns(table), _options(fmt)), out)
+            manifest['tables'].append({ 'name': table.name
+                                      , 'file': name
+                                      , 'columns': [c.name for c in
+                                                    table.columns]
+                                      , 'rows': cursor.rowcount
+                                      , 'bytes': out.size
+                                      , 'sha256': out.sha256.hexdigest()
+                                      })
+            _log_table('exported', table.name, cursor.rowcount, out.size,
+                       time.perf_counter() - started)
+        connection.rollback()
+    finally:
+        connection.close()
+    with open(os.path.join(directory, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return _report(manifest, start)
+
+def _log_table(verb, name, rows, size, seconds):
+    log.info('%s %s: %d rows, %.1f MB in %.2fs (%.1f MB/s)', verb, name,
+             rows, size / 1e6, seconds, size / 1e6 / max(seconds, 1e-9))
+
+def _report(manifest, start):
+    return Report(len(manifest['tables']),
+                  sum(t['rows'] for t in manifest['tables']),
+                  sum(t['bytes'] for t in manifest['tables']),
+                  time.perf_counter() - start)
+
+def read_manifest(directory):
+    """Reads and checks the manifest of a dump against the database.
+
+    Raises:
+        ManifestError: If the dump doesn't match the database's schema.
+
+    """
+    with open(os.path.join(directory, MANIFEST)) as f:
+        manifest = json.load(f)
+    if manifest.get('version') != MANIFEST_VERSION:
+        raise ManifestError('unsupported manifest version {}'
+                            .format(manifest.get('version')))
+    version = migrations.current_version(db.engine)
+    if manifest['schema_version'] != version:
+        raise ManifestError('dump is of schema version {}, but the database '
+                            'is at {}'.format(manifest['schema_version'],
+                                              version))
+    if manifest['format'] not in FORMATS \
+            or manifest['compression'] not in COMPRESSION:
+        raise ManifestError('unknown format or compression')
+    known = {t.name: t for t in tables()}
+    for entry in manifest['tables']:
+        table = known.get(entry['name'])
+        if table is None:
+            raise ManifestError('unknown table {}'.format(entry['name']))
+        if set(entry['columns']) != {c.name for c in table.columns}:
+            raise ManifestError('the columns of {} differ'.format(table.name))
+    return manifest
+
+def _deferred(cursor, names):
+    """The constraints and indexes of some tables.
+
+    Returns:
+        (List[Tuple[str, str, str]], List[Tuple[str, str]]): The table,
+        name and definition of each key, foreign keys first, and the
+        name and definition of each index that doesn't back a key.
+
+    """
+    cursor.execute("SELECT conrelid::regclass::text, conname, "
+                   "pg_get_constraintdef(oid) FROM pg_constraint "
+                   "WHERE contype IN ('f', 'p', 'u') "
+                   "AND conrelid::regclass::text = ANY(%s) "
+                   "ORDER BY contype = 'f' DESC, 1, 2", (names,))
+    constraints = cursor.fetchall()
+    cursor.execute("SELECT indexrelid::regclass::text, "
+                   "pg_get_indexdef(indexrelid) FROM pg_index i "
+                   "WHERE indrelid::regclass::text = ANY(%s) "
+                   "AND NOT EXISTS (SELECT 1 FROM pg_constraint "
+                   "                WHERE conindid = i.indexrelid) "
+                   "ORDER BY 1", (names,))
+    return constraints, cursor.fetchall()
+
+def import_database(directory):
+    """Loads a dump written by :func:`export_database`.
+
+    Args:
+        directory (str): Where the dump is.
+
+    Returns:
+        (Report): How much was loaded.
+
+    Raises:
+        ManifestError: If the dump can't be loaded into the database,
+            because it doesn't match the schema, the database already
+            has data, or a file is corrupt. Nothing is changed.
+
+    """
+    manifest = read_manifest(directory)
+    known = {t.name: t for t in tables()}
+    opener = COMPRESSION[manifest['compression']]
+    fmt = manifest['format']
+    start = time.perf_counter()
+    connection = db.engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        names = [t.name for t in tables()]
+        for name in sorted(set(names) - REPLACED):
+            cursor.execute('SELECT EXISTS (SELECT 1 FROM {})'.format(name))
+            if cursor.fetchone()[0]:
+                raise ManifestError('table {} is not empty'.format(name))
+        constraints, indexes = _deferred(cursor, names)
+        # partitioned tables can't be frozen, only their partitions
+        cursor.execute("SELECT relname FROM pg_class WHERE relkind = 'p' "
+                       "AND relname = ANY(%s)", (names,))
+        partitioned = {name for name, in cursor.fetchall()}
+        # truncating in the same transaction is what allows FREEZE
+        cursor.execute('TRUNCATE {}'.format(', '.join(names)))
+        for table, name, _ in constraints:
+            cursor.execute('ALTER TABLE {} DROP CONSTRAINT "{}"'
+                           .format(table, name))
+        for name, _ in indexes:
+            cursor.execute('DROP INDEX {}'.format(name))
+        # the keyword statistics are in the dump already, so the
+        # triggers that keep them up to date mustn't count the weights
+        # and profiles again as they are loaded
+        counted = [ db.ProfileKeywordAssociation.__tablename__
+                  , db.Profile.__tablename__
+                  ]
+        for name in counted:
+            cursor.execute('ALTER TABLE {} DISABLE TRIGGER USER'.format(name))
+
+        for entry in manifest['tables']:
+            table = known[entry['name']]
+            started = time.perf_counter()
+            with opener(os.path.join(directory, entry['file']), 'rb') as f:
+                source = _Hashed(f)
+                cursor.copy_expert(
+                        'COPY {} ({}) FROM STDIN WITH {}'.format(
+                            table.name,
+                            ', '.join('"{}"'.format(c)
+                                      for c in entry['columns']),
+                            _options(fmt, *() if table.name in partitioned
+                                               else ('FREEZE',))),
+                        source, size=BUFFER_SIZE)
+            if source.sha256.hexdigest() != entry['sha256']:
+                raise ManifestError('{} is corrupt'.format(entry['file']))
+            _log_table('imported', table.name, entry['rows'], source.size,
+                       time.perf_counter() - started)
+        for name in counted:
+            cursor.execute('ALTER TABLE {} ENABLE TRIGGER USER'.format(name))
+
+        cursor.execute("SET LOCAL maintenance_work_mem = %s",
+                       (MAINTENANCE_WORK_MEM,))
+        for name, definition in indexes:
+            log.info('building index %s', name)
+            # the index of a partitioned table is defined ON ONLY it,
+            # but must be rebuilt on its partitions too
+            cursor.execute(definition.replace(' ON ONLY ', ' ON ', 1))
+        for table, name, definition in reversed(constraints):
+            cursor.execute('ALTER TABLE {} ADD CONSTRAINT "{}" {}'
+                           .format(table, name, definition))
+        _reset_sequences(cursor)
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        connection.close()
+    with db.engine.connect() as c:
+        c.execution_options(isolation_level='AUTOCOMMIT').execute(
+                'ANALYZE {}'.format(', '.join(names)))
+    return _report(manifest, start)
+
+def _reset_sequences(cursor):
+    """Moves each ``id`` sequence past the largest id in its table."""
+    for table in tables():
+        if 'id' not in table.c:
+            continue
+        cursor.execute("SELECT pg_get_serial_sequence(%s, 'id')",
+                       (table.name,))
+        sequence = cursor.fetchone()[0]
+        if sequence is not None:
+            cursor.execute('SELECT setval(%s, coalesce(max(id), 1), '
+                           'max(id) IS NOT NULL) FROM {}'.format(table.name),
+                           (sequence,))
@@ -0,0 +1,125 @@
+import json
+import os
+import tempfile
+from . import dump, profiling, database as db
+from .database_tests import DatabaseTestCase, Postgresql
+
+def author(first, last):
+    return { 'name': { 'title': 'Dr'
+                     , 'first': first
+                     , 'last': last
+                     , 'initials': None
+                     , 'alias': None
+                     }
+           , 'email': None
+           , 'faculty': 'Natural Sciences'
+           , 'department': None
+           , 'campus': None
+           , 'building': None
+           , 'room': None
+           , 'website': None
+           }
+
+class DumpTestCase(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        john, jane = author('John', 'Smith'), author('Jane', 'Doe')
+        profiling.update_authors_profiles("porcupine, fluctuations",
+                                          "Of wild horses.", [john],
+                                          "2016-01-01")
+        profiling.update_authors_profiles("porcupine, graph theory", None,
+                                          [john, jane], "2015-01-01")
+        self.source = self.postgresql
+        self.target = Postgresql()
+        self.tmp = tempfile.TemporaryDirectory()
+        self.expected = self.contents()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+        db.session.remove()
+        self.target.stop()
+        super().tearDown()
+
+    def contents(self):
+        with db.engine.connect() as c:
+            return {t.name: sorted(map(tuple, c.execute(t.select())),
+                                   key=repr)
+                    for t in dump.tables()}
+
+    def copy(self, **kwargs):
+        directory = os.path.join(self.tmp.name, 'dump')
+        exported = dump.export_database(directory, **kwargs)
+        db.session.remove()
+        db.init(self.target.url())
+        return directory, exported
+
+    def testRoundTrip(self):
+        for fmt, compression in [ ('binary', None)
+                                , ('csv', 'gzip')
+                                , ('binary', 'xz')
+                                ]:
+            with self.subTest(fmt=fmt, compression=compression):
+                db.init(self.source.url())
+                directory, exported = self.copy(fmt=fmt,
+                                                compression=compression)
+                db.session.execute('TRUNCATE {}'.format(
+                        ', '.join(t.name for t in dump.tables())))
+                db.session.commit()
+
+                imported = dump.import_database(directory)
+
+                self.assertEqual(imported[:3], exported[:3])
+                self.assertEqual(exported.tables, len(dump.tables()))
+                self.assertEqual(exported.rows,
+                                 sum(map(len, self.expected.values())))
+                self.assertEqual(self.contents(), self.expected)
+
+    def testSequences(self):
+        directory, _ = self.copy()
+        dump.import_database(directory)
+        profile = db.Profile(firstname='Mary', lastname='Sue')
+        db.session.add(profile)
+        db.session.commit()
+        self.assertEqual(profile.id, 3)
+
+    def testIndexesRebuilt(self):
+        before = self.indexes()
+        directory, _ = self.copy()
+        dump.import_database(directory)
+        self.assertEqual(self.indexes(), before)
+
+    def indexes(self):
+        return sorted(db.session.execute(
+                "SELECT indexname, indexdef FROM pg_indexes "
+                "WHERE schemaname = 'public'").fetchall())
+
+    def testNotEmpty(self):
+        directory, _ = self.copy()
+        dump.import_database(directory)
+        with self.assertRaises(dump.ManifestError):
+            dump.import_database(directory)
+
+    def testCorrupt(self):
+        directory, _ = self.copy(fmt='csv')
+        path = os.path.join(directory, 'keyword.csv')
+        with open(path, 'rb') as f:
+            data = f.read()
+        with open(path, 'wb') as f:
+            f.write(data.replace(b'porcupine', b'porcupino'))
+
+        with self.assertRaises(dump.ManifestError):
+            dump.import_database(directory)
+        self.assertEqual(db.Keyword.query.count(), 0)
+        self.assertGreater(len(self.indexes()), 0)
+
+    def testSchemaVersion(self):
+        directory, _ = self.copy()
+        path = os.path.join(directory, dump.MANIFEST)
+        with open(path) as f:
+            manifest = json.load(f)
+        manifest['schema_version'] -= 1
+        with open(path, 'w') as f:
+            json.dump(manifest, f)
+
+        with self.assertRaises(dump.ManifestError):
+            dump.import_database(directory)
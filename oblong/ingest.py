@@ -0,0 +1,401 @@
+"""Loads papers from a file of newline-delimited JSON.
+
+Each line of the input is one paper, in the form accepted by
+``POST /api/publications``::
+
+    {"title": "...", "abstract": "...", "date": "2016-01-01",
+     "authors": [{"name": {"first": "John", ...}, ...}]}
+
+:func:`ingest` streams the input through four stages. Papers pass
+between them through bounded queues, so that a slow stage holds back
+the ones before it rather than letting work pile up in memory:
+
+1. A reader thread reads the input a line at a time.
+2. A parser thread parses whatever lines are waiting, looks up all
+   their texts in the extraction cache in one query, and hands each
+   paper to a pool of worker processes.
+3. The workers extract the paper's keywords, skipping any
+   text whose keywords were in the extraction cache.
+4. A single writer thread stores the papers, in the order they were
+   read, committing a batch at a time.
+
+After each commit, the byte offset in the input just past the last
+stored paper is saved to a checkpoint file, so a failed ingest can be
+resumed from there. Lines that can't be parsed, and papers whose
+keywords can't be extracted, are logged and skipped.
+
+"""
+from collections import defaultdict, namedtuple
+import json
+import logging
+import multiprocessing
+import queue
+import sys
+import threading
+import time
+
+from sqlalchemy.exc import DataError
+
+from . import database as db
+from . import profiling
+from . import rebuild
+
+log = logging.getLogger(__name__)
+
+#: The outcome of an ingest. ``offset`` is the number of bytes of the
+#: input read, including any skipped before it resumed.
+Report = namedtuple('Report', 'papers skipped offset')
+
+#: Marks the end of the input on a queue.
+_DONE = object()
+
+#: The error codes of transactions that failed only because of a
+#: concurrent one, and so may succeed if they are tried again.
+RETRYABLE = {'40001', '40P01'}
+
+#: The most papers whose texts are looked up in the extraction cache in
+#: one query.
+LOOKUP_SIZE = 100
+
+class Checkpoint(rebuild.Checkpoint):
+    """Saves how far through its input an ingest has got."""
+    def load(self):
+        """The offset of the first byte not yet stored."""
+        offset, _ = super().load()
+        return offset
+
+    def save(self, offset):
+        super().save(offset, {})
+
+class _Progress:
+    """How far the writer has got, shared with the other threads."""
+    def __init__(self, offset):
+        self.papers = 0
+        self.skipped = 0
+        self.offset = offset
+        self.error = None
+
+def _paper(line):
+    """Parses one line of the input.
+
+    Raises:
+        ValueError: If the line isn't a paper.
+
+    """
+    paper = json.loads(line.decode('utf-8'))
+    if not isinstance(paper, dict):
+        raise ValueError('expected an object')
+    missing = {'title', 'date', 'authors'} - paper.keys()
+    if missing:
+        raise ValueError('missing ' + ', '.join(sorted(missing)))
+    if not isinstance(paper['title'], str) \
+            or not isinstance(paper.get('abstract') or '', str):
+        raise ValueError('title and abstract must be strings')
+    return paper
+
+def _extract(paper, cached):
+    """Extracts the keywords of a paper in a worker process.
+
+    Returns:
+        The occurrences of the paper's keywords, and the keywords of its
+        texts that weren't ``cached``.
+
+    """
+    extracted = dict(cached)
+    occurrences = profiling.paper_occurrences(paper['title'],
+                                              paper.get('abstract'), extracted)
+    return occurrences, {t: k for t, k in extracted.items() if t not in cached}
+
+def _open(path, offset):
+    """Opens the input, positioned ``offset`` bytes in."""
+    if path != '-':
+        stream = open(path, 'rb')
+        stream.seek(offset)
+        return stream
+    stream = sys.stdin.buffer
+    remaining = offset
+    while remaining:
+        skipped = len(stream.read(min(remaining, 1 << 20)))
+        if not skipped:
+            break
+        remaining -= skipped
+    return stream
+
+def _put(q, item, stop):
+    """Puts an item on a queue, unless the ingest is stopped first."""
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+def _get(q, stop):
+    """Takes an item from a queue, unless the ingest is stopped first.
+
+    Returns:
+        The item, or ``None`` if the ingest was stopped.
+
+    """
+    while not stop.is_set():
+        try:
+            return q.get(timeout=.1)
+        except queue.Empty:
+            pass
+    return None
+
+def _read(stream, offset, lines, stop, progress):
+    """The first stage: reads the input a line at a time.
+
+    Each line is queued for the parser with the offset just past it.
+
+    """
+    try:
+        for line in stream:
+            offset += len(line)
+            if not _put(lines, (offset, line), stop):
+                return
+    except Exception as e:
+        progress.error = e
+    finally:
+        _put(lines, (offset, _DONE), stop)
+
+def _parse(lines, offset, pool, pending, stop, progress):
+    """The second stage: parses papers and hands them to the workers.
+
+    The lines waiting when the parser gets to them, up to
+    :data:`LOOKUP_SIZE`, have their texts looked up in the extraction
+    cache together, in one query rather than one per paper; it doesn't
+    wait for more, so a slowly written input isn't held back.
+
+    Each paper is queued for the writer with the offset just past its
+    line and the pending result of its keyword extraction. The queue
+    is bounded, so at most its size papers are held at once.
+
+    """
+    try:
+        done = False
+        while not done:
+            item = _get(lines, stop)
+            if item is None:
+                return
+            group = [item]
+            while len(group) < LOOKUP_SIZE and group[-1][1] is not _DONE:
+                try:
+                    group.append(lines.get_nowait())
+                except queue.Empty:
+                    break
+            papers = []
+            for end, line in group:
+                offset = end
+                if line is _DONE:
+                    done = True
+                elif line.strip():
+                    try:
+                        papers.append((end, _paper(line)))
+                    except ValueError as e:
+                        log.warning('skipping line ending at byte %d: %s',
+                                    end, e)
+                        papers.append((end, None))
+            cached = profiling.cached_keywords(
+                    t for _, paper in papers if paper is not None
+                    for t in (paper['title'], paper.get('abstract')))
+            db.session.rollback()
+            for end, paper in papers:
+                result = None
+                if paper is not None:
+                    texts = paper['title'], paper.get('abstract')
+                    result = pool.apply_async(_extract, (paper,
+                            {t: cached[t] for t in texts if t in cached}))
+                if not _put(pending, (end, paper, result), stop):
+                    return
+    except Exception as e:
+        progress.error = e
+    finally:
+        db.session.remove()
+        _put(pending, (offset, _DONE, None), stop)
+
+def _retryable(error):
+    return getattr(error.orig, 'pgcode', None) in RETRYABLE
+
+def _store(papers):
+    """Stores a batch of papers in one transaction.
+
+    Each profile is locked once, in order of id, and then has the
+    papers applied to it and is weighed again from its contributions,
+    ending up exactly as if they had been submitted one at a time.
+
+    Args:
+        papers (List[Tuple[dict, Dict[str, int], dict]]): Each paper,
+            the occurrences of its keywords, and any extractions to
+            cache.
+
+    Returns:
+        (int, Set[int]): The number of papers stored, and the ids of
+        the profiles changed.
+
+    """
+    stored = []
+    extracted = {}
+    for paper, occurrences, new in papers:
+        extracted.update(new)
+        try:
+            year = int(paper['date'][:4])
+            with db.session.begin_nested():
+                publication, authors = profiling.store_paper(
+                        paper['title'], paper.get('abstract'),
+                        paper['authors'], paper['date'])
+        except (KeyError, TypeError, ValueError, DataError) as e:
+            log.warning('skipping %r: %r', paper['title'], e)
+            continue
+        stored.append((publication, authors, year, occurrences))
+
+    ids = db.keyword_ids({k for _, _, _, occurrences in stored
+                          for k in occurrences})
+    changes = defaultdict(list)
+    contributions = defaultdict(int)
+    for publication, authors, year, occurrences in stored:
+        weight = profiling.occurrence_weight(year)
+        weights = {ids[word]: n * weight for word, n in occurrences.items()}
+        for uid in set(authors):
+            changes[uid].append((publication, weights))
+            for word, n in occurrences.items():
+                contributions[uid, ids[word], year] += n
+    for uid in sorted(changes):
+        db.lock_profile(uid)
+        for publication, weights in changes[uid]:
+            db.add_keyword_weights(uid, weights)
+            db.add_publication(uid, publication)
+    db.add_contributions(contributions)
+    db.reweigh_profiles(profiling.decayed_weight(), 100, changes)
+    profiling.cache_keywords(extracted)
+    db.session.commit()
+    return len(stored), set(changes)
+
+def _write(pending, stop, progress, checkpoint, batch_size, retries):
+    """The last stage: stores papers a batch at a time.
+
+    A batch is committed once it is full, or whenever no papers are
+    waiting, so a slowly written input is still stored promptly.
+
+    """
+    batch = []
+
+    def flush(offset):
+        if batch:
+            for attempt in range(retries + 1):
+                try:
+                    stored, changed = _store(batch)
+                    break
+                except db.DBAPIError as e:
+                    db.session.rollback()
+                    if attempt == retries or not _retryable(e):
+                        raise
+                    log.info('retrying batch after conflict: %s', e.orig)
+            db.profiles_changed(changed)
+            progress.papers += stored
+            progress.skipped += len(batch) - stored
+            batch.clear()
+        if offset != progress.offset:
+            checkpoint.save(offset)
+            progress.offset = offset
+
+    try:
+        offset = progress.offset
+        while True:
+            try:
+                end, paper, result = pending.get(timeout=1)
+            except queue.Empty:
+                flush(offset)
+                continue
+            if paper is _DONE:
+                flush(end)
+                return
+            offset = end
+            if paper is None:
+                progress.skipped += 1
+                continue
+            try:
+                batch.append((paper,) + result.get())
+            except Exception as e:
+                log.warning('skipping %r: %r', paper['title'], e)
+                progress.skipped += 1
+            if len(batch) >= batch_size:
+                flush(offset)
+    except Exception as e:
+        progress.error = e
+        stop.set()
+    finally:
+        db.session.remove()
+
+def ingest(path, workers=None, batch_size=500, checkpoint=None,
+           queue_size=1000, retries=3, out=None, interval=1.):
+    """Stores every paper in a file of newline-delimited JSON.
+
+    Args:
+        path (str): The file to read, or ``-`` for standard input.
+        workers (Optional[int]): The number of worker processes used to
+            extract keywords. Defaults to the number of CPUs.
+        batch_size (int): The number of papers stored per transaction.
+        checkpoint (Optional[str]): A file to save progress to. If it
+            already exists, the ingest resumes from it. It is removed
+            once the whole input is stored.
+        queue_size (int): The most papers read but not yet stored.
+        retries (int): How many times to retry a batch that conflicts
+            with a concurrent transaction.
+        out (Optional[TextIO]): Where to report throughput, every
+            ``interval`` seconds.
+        interval (float): The number of seconds between reports.
+
+    Returns:
+        (Report): How much was stored.
+
+    Raises:
+        Exception: Whatever stopped the ingest. Everything before the
+            offset saved in the checkpoint is stored.
+
+    """
+    checkpoint = Checkpoint(checkpoint)
+    offset = checkpoint.load()
+    if offset:
+        log.info('Resuming from byte %d', offset)
+    progress = _Progress(offset)
+    lines = queue.Queue(LOOKUP_SIZE)
+    pending = queue.Queue(queue_size)
+    stop = threading.Event()
+    stream = _open(path, offset)
+    try:
+        # the workers are forked before any threads are started
+        with multiprocessing.Pool(workers) as pool:
+            reader = threading.Thread(target=_read, daemon=True,
+                    args=(stream, offset, lines, stop, progress))
+            parser = threading.Thread(target=_parse, daemon=True,
+                    args=(lines, offset, pool, pending, stop, progress))
+            writer = threading.Thread(target=_write, daemon=True,
+                    args=(pending, stop, progress, checkpoint, batch_size,
+                          retries))
+            reader.start()
+            parser.start()
+            writer.start()
+            last, papers = time.time(), progress.papers
+            while writer.is_alive():
+                writer.join(interval)
+                now = time.time()
+                if out is not None:
+                    print('{} papers stored ({:.1f}/s), {} skipped, '
+                          '{} bytes read'.format(progress.papers,
+                              (progress.papers - papers) / (now - last),
+                              progress.skipped, progress.offset),
+                          file=out, flush=True)
+                last, papers = now, progress.papers
+            stop.set()
+            reader.join()
+            parser.join()
+    finally:
+        if stream is not sys.stdin.buffer:
+            stream.close()
+    if progress.error is not None:
+        raise progress.error
+    checkpoint.clear()
+    return Report(progress.papers, progress.skipped, progress.offset)
@@ -0,0 +1,162 @@
+import io
+import json
+import os
+import tempfile
+from unittest import mock
+from . import ingest, profiling, database as db
+from .database_tests import DatabaseTestCase
+
+def author(first, last):
+    return { 'name': { 'title': 'Mr'
+                     , 'first': first
+                     , 'last': last
+                     , 'initials': None
+                     , 'alias': None
+                     }
+           , 'email': None
+           , 'faculty': 'Natural Sciences'
+           , 'department': None
+           , 'campus': None
+           , 'building': None
+           , 'room': None
+           , 'website': None
+           }
+
+class IngestTestCase(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'papers.ndjson')
+        self.checkpoint = os.path.join(self.tmp.name, 'ingest.ckpt')
+        john, jane = author('John', 'Smith'), author('Jane', 'Doe')
+        self.papers = [ { 'title': 'porcupine, fluctuations'
+                        , 'abstract': None
+                        , 'date': '2016-01-01'
+                        , 'authors': [john]
+                        }
+                      , { 'title': 'porcupine, graph theory'
+                        , 'abstract': None
+                        , 'date': '2015-01-01'
+                        , 'authors': [john, jane]
+                        }
+                      , { 'title': 'gravitational waves'
+                        , 'abstract': 'Of porcupines.'
+                        , 'date': '2014-01-01'
+                        , 'authors': [jane]
+                        }
+                      ]
+        self.lines = [json.dumps(p).encode() + b'\n' for p in self.papers]
+
+    def tearDown(self):
+        self.tmp.cleanup()
+        super().tearDown()
+
+    def write(self, lines):
+        with open(self.path, 'wb') as f:
+            f.writelines(lines)
+        return sum(len(line) for line in lines)
+
+    def keywords(self):
+        db.session.expire_all()
+        return {p.lastname: dict(p.keywords) for p in db.Profile.query}
+
+    def expected(self):
+        """The keywords of the papers submitted one at a time."""
+        for paper in self.papers:
+            profiling.update_authors_profiles(**paper)
+        expected = self.keywords()
+        for table in ('profile_keyword_association',
+                      'profile_publication_association',
+                      'publication', 'profile'):
+            db.session.execute('DELETE FROM ' + table)
+        db.session.commit()
+        return expected
+
+    def testIngest(self):
+        expected = self.expected()
+        size = self.write(self.lines[:2] + [b'\n', b'{"title": \n']
+                          + self.lines[2:])
+        out = io.StringIO()
+
+        report = ingest.ingest(self.path, workers=1, batch_size=2,
+                               checkpoint=self.checkpoint, out=out)
+
+        self.assertEqual(report, ingest.Report(3, 1, size))
+        self.assertEqual(db.Publication.query.count(), 3)
+        self.assertEqual(self.keywords(), expected)
+        self.assertIn('3 papers stored', out.getvalue())
+        self.assertFalse(os.path.exists(self.checkpoint))
+
+    def testSkipsBadPapers(self):
+        bad = [ {'title': 'no authors', 'date': '2016-01-01'}
+              , dict(self.papers[0], date='not a date')
+              , dict(self.papers[0], title='bad authors', authors=[{}])
+              ]
+        self.write([json.dumps(p).encode() + b'\n' for p in bad]
+                   + self.lines[1:2])
+
+        report = ingest.ingest(self.path, workers=1)
+
+        self.assertEqual(report.papers, 1)
+        self.assertEqual(report.skipped, 3)
+        self.assertEqual([p.title for p in db.Publication.query],
+                         [self.papers[1]['title']])
+
+    def testResume(self):
+        self.write(self.lines)
+        ingest.Checkpoint(self.checkpoint).save(len(self.lines[0]))
+
+        report = ingest.ingest(self.path, workers=1,
+                               checkpoint=self.checkpoint)
+
+        self.assertEqual(report.papers, 2)
+        self.assertEqual(sorted(p.title for p in db.Publication.query),
+                         sorted(p['title'] for p in self.papers[1:]))
+
+    def testFailure(self):
+        expected = self.expected()
+        self.write(self.lines)
+        store_paper = profiling.store_paper
+        calls = []
+        def fail_second(*args):
+            calls.append(args)
+            if len(calls) == 2:
+                raise RuntimeError('lost connection')
+            return store_paper(*args)
+
+        with mock.patch.object(profiling, 'store_paper', fail_second):
+            with self.assertRaises(RuntimeError):
+                ingest.ingest(self.path, workers=1, batch_size=1,
+                              checkpoint=self.checkpoint)
+        self.assertEqual(ingest.Checkpoint(self.checkpoint).load(),
+                         len(self.lines[0]))
+
+        report = ingest.ingest(self.path, workers=1, batch_size=1,
+                               checkpoint=self.checkpoint)
+
+        self.assertEqual(report.papers, 2)
+        self.assertEqual(self.keywords(), expected)
+
+    def testCacheLookedUpPerGroup(self):
+        lines = ingest.queue.Queue()
+        end = 0
+        for line in self.lines + [b'{"title": \n']:
+            end += len(line)
+            lines.put((end, line))
+        lines.put((end, ingest._DONE))
+        pending = ingest.queue.Queue()
+        pool = mock.Mock()
+        profiling.cache_keywords({self.papers[0]['title']: ['porcupine']})
+        db.session.commit()
+
+        with mock.patch.object(profiling, 'cached_keywords',
+                               wraps=profiling.cached_keywords) as lookup:
+            ingest._parse(lines, 0, pool, pending,
+                          ingest.threading.Event(), ingest._Progress(0))
+
+        self.assertEqual(lookup.call_count, 1)
+        self.assertEqual([pending.get()[1] for _ in range(5)],
+                         self.papers + [None, ingest._DONE])
+        self.assertEqual(
+                [call[0][1][1] for call in pool.apply_async.call_args_list],
+                [{self.papers[0]['title']: ('porcupine',)}, {}, {}])
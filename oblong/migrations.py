@@ -0,0 +1,366 @@
+"""Versioned changes to the database schema.
+
+Each migration is a function that takes a connection and brings the
+schema from one version to the next. The versions applied so far are
+recorded in the ``schema_version`` table, so :func:`upgrade` only runs
+the ones a database is missing, and once a database is up to date it
+costs a single query. :func:`oblong.database.init` calls it on start.
+
+Indexes are declared on the models in :mod:`oblong.database`, where
+``create_all`` builds them with the tables of a new database. Existing
+databases get them from :func:`ensure_indexes`, which builds any that
+are missing with ``CREATE INDEX CONCURRENTLY``, so profiles can still be
+written while it runs. Migrations that do so are not transactional, and
+so must be safe to run again if they are interrupted.
+
+Examples:
+    After declaring a new index on a model, build it in existing
+    databases by appending a migration to this module::
+
+        @migration('Index publications by date', transactional=False)
+        def _publication_date(connection):
+            ensure_indexes(connection)
+
+"""
+from collections import namedtuple
+import logging
+import re
+
+from sqlalchemy import (MetaData, Table, Column, Integer, String, DateTime,
+        func, select, exists, text)
+from sqlalchemy.schema import AddConstraint, CreateIndex
+
+from . import database as db
+
+log = logging.getLogger(__name__)
+
+#: A change to the schema.
+Migration = namedtuple('Migration', 'version description apply transactional')
+
+#: Every migration, in the order they are applied.
+migrations = []
+
+#: Identifies the advisory lock held while migrating, so that processes
+#: started at the same time don't migrate concurrently.
+LOCK_ID = 0x0b1096
+
+#: Planner settings that let Postgres aggregate and join each partition
+#: of ``profile_keyword_association`` separately, see
+#: :func:`partition_keyword_weights`. They need Postgres 11, as
+#: partitioning does, so are only set where the table is partitioned.
+PARTITIONWISE_SETTINGS = ( 'enable_partitionwise_aggregate'
+                         , 'enable_partitionwise_join'
+                         )
+
+metadata = MetaData()
+schema_version = Table(
+    'schema_version', metadata,
+    Column('version', Integer, primary_key=True),
+    Column('description', String(200)),
+    Column('applied_at', DateTime, server_default=func.now())
+)
+
+def migration(description, transactional=True):
+    """Registers a function as the next migration.
+
+    Args:
+        description (str): What the migration does.
+        transactional (bool): Whether to run the migration in a
+            transaction. Migrations that build indexes concurrently
+            can't, and run in autocommit mode instead.
+
+    """
+    def register(apply):
+        migrations.append(Migration(len(migrations) + 1, description, apply,
+                                    transactional))
+        return apply
+    return register
+
+def latest_version():
+    """The version of the schema once every migration is applied."""
+    return migrations[-1].version
+
+def current_version(bind):
+    """The version of a database's schema.
+
+    Args:
+        bind: An engine or connection.
+
+    Returns:
+        (int): The last migration applied, or ``0`` if there are none.
+
+    """
+    if bind.execute(select([func.to_regclass('schema_version')])).scalar() \
+            is None:
+        return 0
+    return bind.execute(select([func.max(schema_version.c.version)])) \
+               .scalar() or 0
+
+def upgrade(engine, target=None):
+    """Applies any migrations the database is missing.
+
+    Args:
+        engine (sqlalchemy.Engine): The database to migrate.
+        target (Optional[int]): The version to stop at. Defaults to
+            the latest.
+
+    Returns:
+        (List[int]): The versions applied, in order.
+
+    """
+    target = latest_version() if target is None else target
+    if current_version(engine) >= target:
+        return []
+    # an idle transaction here would stop concurrent index builds from
+    # ever finishing, so the lock is taken outside of one
+    with engine.connect() as lock:
+        lock = lock.execution_options(isolation_level='AUTOCOMMIT')
+        lock.execute(select([func.pg_advisory_lock(LOCK_ID)]))
+        try:
+            metadata.create_all(bind=lock)
+            version = current_version(lock)
+            applied = []
+            for m in migrations[version:target]:
+                log.info('applying migration %d: %s', m.version, m.description)
+                if m.transactional:
+                    with engine.begin() as connection:
+                        m.apply(connection)
+                        _record(connection, m)
+                else:
+                    m.apply(lock)
+                    _record(lock, m)
+                applied.append(m.version)
+            return applied
+        finally:
+            lock.execute(select([func.pg_advisory_unlock(LOCK_ID)]))
+
+def _record(connection, m):
+    connection.execute(schema_version.insert()
+                      .values(version=m.version, description=m.description))
+
+def index_valid(connection, name):
+    """Whether an index exists and is usable.
+
+    Returns:
+        (Optional[bool]): ``None`` if there is no such index, ``False``
+        if it is left over from a failed concurrent build.
+
+    """
+    return connection.execute(
+            text('SELECT indisvalid FROM pg_index '
+                 'WHERE indexrelid = to_regclass(:name)'),
+            name=name).scalar()
+
+def create_index(connection, name, sql):
+    """Builds an index concurrently, unless it already exists.
+
+    An invalid index left by an interrupted build is dropped first.
+
+    Args:
+        connection: A connection in autocommit mode.
+        name (str): The name of the index.
+        sql (str): The ``CREATE INDEX`` statement.
+
+    """
+    valid = index_valid(connection, name)
+    if valid:
+        return
+    if valid is not None:
+        log.warning('rebuilding invalid index %s', name)
+        connection.execute('DROP INDEX CONCURRENTLY {}'.format(name))
+    log.info('building index %s', name)
+    connection.execute(re.sub(r'^CREATE (UNIQUE )?INDEX',
+                              r'CREATE \1INDEX CONCURRENTLY', sql))
+
+def ensure_indexes(connection):
+    """Builds every index declared on the models that is missing.
+
+    Args:
+        connection: A connection in autocommit mode.
+
+    """
+    for table in db.Base.metadata.sorted_tables:
+        for index in sorted(table.indexes, key=lambda i: i.name):
+            sql = str(CreateIndex(index).compile(dialect=connection.dialect))
+            create_index(connection, index.name, sql)
+
+def keyword_partitions(bind):
+    """The number of partitions of ``profile_keyword_association``.
+
+    Returns:
+        (int): ``0`` if the table isn't partitioned.
+
+    """
+    return bind.execute(
+            text("SELECT count(*) FROM pg_inherits "
+                 "WHERE inhparent = to_regclass(:table)"),
+            table=db.ProfileKeywordAssociation.__tablename__).scalar()
+
+def partition_keyword_weights(engine, partitions):
+    """Hash partitions ``profile_keyword_association`` by profile.
+
+    The table is copied into ``partitions`` partitions by ``left_id``,
+    and its keys and indexes are rebuilt on them. Every partition is
+    then only a fraction of the size of the table, so each can be
+    vacuumed and indexed separately, and searches, which group weights
+    by profile, can aggregate each partition on its own: Postgres only
+    plans that when asked, so :data:`PARTITIONWISE_SETTINGS` are turned
+    on for the database. They only apply to new connections, so the
+    engine's pool is emptied once the table is partitioned. Searches
+    only get faster where Postgres has cores to spare for parallel
+    workers; see ``benchmarks/partitioning.py``.
+
+    This runs in a single transaction that locks the table, so that
+    nothing can read or write keyword weights until it is done; with
+    tens of millions of weights, that takes minutes. A partitioned
+    table can be partitioned again, into a different number of
+    partitions, in the same way. Nothing is done if the table already
+    has ``partitions`` partitions.
+
+    Args:
+        engine (sqlalchemy.Engine): The database.
+        partitions (int): The number of partitions.
+
+    Returns:
+        (bool): Whether the table was partitioned.
+
+    """
+    table = db.ProfileKeywordAssociation.__table__
+    with engine.begin() as connection:
+        connection.execute(select([func.pg_advisory_xact_lock(LOCK_ID)]))
+        if keyword_partitions(connection) == partitions:
+            return False
+        log.info('partitioning %s into %d partitions', table.name, partitions)
+        new = '{}_h{}'.format(table.name, partitions)
+        connection.execute('LOCK TABLE {} IN ACCESS EXCLUSIVE MODE'
+                           .format(table.name))
+        connection.execute('CREATE TABLE {} (LIKE {} INCLUDING DEFAULTS) '
+                           'PARTITION BY HASH (left_id)'
+                           .format(new, table.name))
+        for i in range(partitions):
+            connection.execute('CREATE TABLE {0}_{1} PARTITION OF {0} '
+                               'FOR VALUES WITH (MODULUS {2}, REMAINDER {1})'
+                               .format(new, i, partitions))
+        connection.execute('INSERT INTO {} SELECT {} FROM {}'.format(
+                new, ', '.join(c.name for c in table.columns), table.name))
+        connection.execute('DROP TABLE {}'.format(table.name))
+        connection.execute('ALTER TABLE {} RENAME TO {}'
+                           .format(new, table.name))
+        connection.execute(AddConstraint(table.primary_key))
+        for constraint in sorted(table.foreign_key_constraints,
+                                 key=lambda c: c.column_keys):
+            connection.execute(AddConstraint(constraint))
+        for index in sorted(table.indexes, key=lambda i: i.name):
+            connection.execute(CreateIndex(index))
+        # the triggers were dropped with the old table
+        db.create_statistics_triggers(connection)
+        database = connection.execute(
+                select([func.current_database()])).scalar()
+        for setting in PARTITIONWISE_SETTINGS:
+            connection.execute('ALTER DATABASE {} SET {} = on'.format(
+                    connection.dialect.identifier_preparer.quote(database),
+                    setting))
+    engine.dispose()
+    return True
+
+@migration('Create tables')
+def _create_tables(connection):
+    # a new database gets the current schema, so later migrations must
+    # check for what they add; an older one just gets any missing tables
+    db.Base.metadata.create_all(bind=connection)
+
+@migration('Add identity keys to profiles and publications')
+def _identity_keys(connection):
+    # where several rows share a key, only the oldest gets it; the
+    # duplicates are left without one, and so are never matched again
+    targets = [ (db.Profile, db.Profile.identity_key,
+                 (db.Profile.firstname, db.Profile.lastname, db.Profile.faculty))
+              , (db.Publication, db.Publication.title_key,
+                 (db.Publication.title,))
+              ]
+    for model, key, columns in targets:
+        table, name = model.__table__, key.key
+        connection.execute('ALTER TABLE {} ADD COLUMN IF NOT EXISTS {} '
+                           'VARCHAR(32)'.format(table.name, name))
+        keys = (select([func.min(model.id).label('id'),
+                        db._sql_key(*columns).label('key')])
+               .group_by(db._sql_key(*columns))
+               .alias())
+        other = table.alias()
+        taken = exists().where(other.c[name] == keys.c.key)
+        connection.execute(table.update()
+                          .values({name: keys.c.key})
+                          .where(model.id == keys.c.id)
+                          .where(key.is_(None))
+                          .where(~taken))
+        duplicates = connection.execute(select([func.count()])
+                                       .where(key.is_(None))).scalar()
+        if duplicates:
+            log.warning('%d duplicate rows in %s left without an identity key',
+                        duplicates, table.name)
+
+@migration('Index searches, postings and authorship', transactional=False)
+def _index_plan(connection):
+    table = db.profile_publication_association.name
+    pkey = table + '_pkey'
+    has_pkey = connection.execute(
+            text("SELECT 1 FROM pg_constraint "
+                 "WHERE conrelid = to_regclass(:table) AND contype = 'p'"),
+            table=table).scalar()
+    if not has_pkey:
+        connection.execute('DELETE FROM {} WHERE profile_id IS NULL '
+                           'OR publication_id IS NULL'.format(table))
+        connection.execute('DELETE FROM {0} a USING {0} b '
+                           'WHERE a.profile_id = b.profile_id '
+                           'AND a.publication_id = b.publication_id '
+                           'AND a.ctid > b.ctid'.format(table))
+        create_index(connection, pkey, 'CREATE UNIQUE INDEX {} ON {} '
+                     '(profile_id, publication_id)'.format(pkey, table))
+        connection.execute('ALTER TABLE {0} ADD CONSTRAINT {1} '
+                           'PRIMARY KEY USING INDEX {1}'.format(table, pkey))
+    ensure_indexes(connection)
+
+@migration('Index keyword names for substring search', transactional=False)
+def _trigram_indexes(connection):
+    # substring matches can only use an index through pg_trgm, which
+    # isn't available everywhere; without it they stay sequential scans
+    available = connection.execute(
+            text("SELECT 1 FROM pg_available_extensions "
+                 "WHERE name = 'pg_trgm'")).scalar()
+    if not available:
+        log.warning('pg_trgm is not available; keyword substring searches '
+                    'will not be indexed')
+        return
+    connection.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    create_index(connection, 'ix_keyword_name_trgm',
+                 'CREATE INDEX ix_keyword_name_trgm ON keyword '
+                 'USING gin (name gin_trgm_ops)')
+
+@migration('Load the ontology closure table')
+def _ontology_closure(connection):
+    from . import profiling
+    db.OntologyClosure.__table__.create(bind=connection, checkfirst=True)
+    profiling.load_ontology_closure(connection)
+
+@migration('Cache extracted keywords')
+def _keyword_extraction(connection):
+    db.KeywordExtraction.__table__.create(bind=connection, checkfirst=True)
+
+@migration('Record keyword contributions by year')
+def _keyword_contribution(connection):
+    # existing profiles have no contributions until they are rebuilt,
+    # and until then are left alone when profiles are aged
+    db.KeywordContribution.__table__.create(bind=connection, checkfirst=True)
+
+@migration('Summarise profiles for lists of people')
+def _profile_summaries(connection):
+    connection.execute("ALTER TABLE profile ADD COLUMN IF NOT EXISTS "
+                       "top_keywords JSONB NOT NULL DEFAULT '[]'")
+    db.refresh_summaries(bind=connection)
+
+@migration('Keep statistics of keywords for ranking searches')
+def _keyword_statistics(connection):
+    db.KeywordStatistics.__table__.create(bind=connection, checkfirst=True)
+    db.keyword_statistics_delta.create(bind=connection, checkfirst=True)
+    db.create_statistics_triggers(connection)
+    db.rebuild_keyword_statistics(bind=connection)
@@ -0,0 +1,247 @@
+from sqlalchemy import func
+from . import migrations, database as db
+from .database_tests import DatabaseTestCase, keyword_statistics
+
+class VersionTestCase(DatabaseTestCase):
+    def testVersionRecorded(self):
+        self.assertEqual( migrations.current_version(db.engine)
+                        , migrations.latest_version()
+                        )
+        versions = db.session.execute('SELECT version FROM schema_version '
+                                      'ORDER BY version').fetchall()
+        self.assertEqual( [v for v, in versions]
+                        , [m.version for m in migrations.migrations]
+                        )
+
+    def testUpToDate(self):
+        self.assertEqual(migrations.upgrade(db.engine), [])
+
+    def testIndexesValid(self):
+        for table in db.Base.metadata.sorted_tables:
+            for index in table.indexes:
+                self.assertTrue( migrations.index_valid(db.engine, index.name)
+                               , index.name
+                               )
+
+class UpgradeTestCase(DatabaseTestCase):
+    """Upgrades a database created before migrations existed."""
+    def setUp(self):
+        super().setUp()
+        self.john = db.Profile(title="Mr", firstname="John", lastname="Smith",
+                               faculty="Engineering")
+        self.john.keywords['horse'] = 1.
+        self.paper = db.Publication(title="A Paper  about Horses")
+        self.paper.authors.append(self.john)
+        db.session.add(self.paper)
+        db.session.commit()
+
+        statements = [ 'DROP TABLE schema_version'
+                     , 'ALTER TABLE profile DROP COLUMN identity_key'
+                     , 'ALTER TABLE profile DROP COLUMN top_keywords'
+                     , 'DROP FUNCTION record_keyword_statistics() CASCADE'
+                     , 'DROP FUNCTION record_corpus_statistics() CASCADE'
+                     , 'DROP TABLE keyword_statistics, keyword_statistics_delta'
+                     , 'ALTER TABLE publication DROP COLUMN title_key'
+                     , 'DROP INDEX ix_profile_keyword_postings'
+                     , 'DROP INDEX ix_profile_lower_firstname'
+                     , 'DROP INDEX ix_profile_publication_association_publication_id'
+                     , 'ALTER TABLE profile_publication_association '
+                       'DROP CONSTRAINT profile_publication_association_pkey'
+                     , "INSERT INTO profile (firstname, lastname, faculty) "
+                       "VALUES ('john', 'smith', 'engineering')"
+                     , 'INSERT INTO profile_publication_association '
+                       'SELECT * FROM profile_publication_association'
+                     ]
+        for statement in statements:
+            db.session.execute(statement)
+        db.session.commit()
+
+    def testUpgrade(self):
+        self.assertEqual(migrations.current_version(db.engine), 0)
+        self.assertEqual( migrations.upgrade(db.engine)
+                        , [m.version for m in migrations.migrations]
+                        )
+
+        db.session.expire_all()
+        self.assertEqual( db.Profile.get(self.john.id).identity_key
+                        , db.profile_identity_key('John', 'Smith', 'Engineering')
+                        )
+        self.assertEqual( db.Publication.get(self.paper.id).title_key
+                        , db.publication_title_key(self.paper.title)
+                        )
+        duplicate = db.Profile.query.filter(db.Profile.id != self.john.id).one()
+        self.assertIsNone(duplicate.identity_key)
+        self.assertEqual(db.Profile.get(self.john.id).top_keywords, ['horse'])
+        self.assertEqual(duplicate.top_keywords, [])
+        self.assertEqual(keyword_statistics(), {'horse': (1, 1.)})
+
+        authorships = (db.session
+                      .query(func.count())
+                      .select_from(db.profile_publication_association)
+                      .scalar())
+        self.assertEqual(authorships, 1)
+        for table in db.Base.metadata.sorted_tables:
+            for index in table.indexes:
+                self.assertTrue( migrations.index_valid(db.engine, index.name)
+                               , index.name
+                               )
+
+    def testInvalidIndexRebuilt(self):
+        connection = db.engine.connect().execution_options(
+                isolation_level='AUTOCOMMIT')
+        db.session.execute('INSERT INTO profile_publication_association '
+                           'SELECT * FROM profile_publication_association')
+        db.session.commit()
+        # the duplicate makes the concurrent build fail, leaving it invalid
+        with self.assertRaises(db.IntegrityError):
+            migrations.create_index(connection, 'ix_test',
+                    'CREATE UNIQUE INDEX ix_test ON '
+                    'profile_publication_association (publication_id)')
+        self.assertIs(migrations.index_valid(connection, 'ix_test'), False)
+
+        migrations.create_index(connection, 'ix_test',
+                'CREATE INDEX ix_test ON '
+                'profile_publication_association (publication_id)')
+        self.assertIs(migrations.index_valid(connection, 'ix_test'), True)
+        connection.close()
+
+class ExplainTestCase(DatabaseTestCase):
+    """Checks that the main queries can be answered from indexes."""
+    def setUp(self):
+        super().setUp()
+        self.john = db.Profile(title="Mr", firstname="John", lastname="Smith",
+                               faculty="Engineering")
+        self.john.keywords['horse'] = 1.
+        self.paper = db.Publication(title="Horses")
+        self.paper.authors.append(self.john)
+        db.session.add(self.paper)
+        db.session.commit()
+        # the tables are tiny, so the planner would rather read them whole
+        db.session.execute('SET enable_seqscan = off')
+
+    def explain(self, query):
+        statement = getattr(query, 'statement', query)
+        sql = statement.compile(dialect=db.engine.dialect,
+                                compile_kwargs={'literal_binds': True})
+        plan = db.session.connection().execute('EXPLAIN ' + str(sql))
+        return '\n'.join(line for line, in plan)
+
+    def assertUsesIndex(self, query, index):
+        plan = self.explain(query)
+        self.assertIn(index, plan)
+        self.assertNotIn('Seq Scan', plan)
+
+    def testPostings(self):
+        assoc = db.ProfileKeywordAssociation
+        q = (db.session.query(assoc.left_id, assoc.weight)
+            .filter(assoc.right_id == 1)
+            .order_by(assoc.weight.desc(), assoc.left_id)
+            .limit(10))
+        self.assertUsesIndex(q, 'ix_profile_keyword_postings')
+
+    def testProfileKeywords(self):
+        q = (db.session.query(db.ProfileKeywordAssociation)
+            .filter_by(left_id=self.john.id))
+        self.assertUsesIndex(q, 'profile_keyword_association_pkey')
+
+    def testKeywordByName(self):
+        q = db.session.query(db.Keyword).filter_by(name='horse')
+        self.assertUsesIndex(q, 'keyword_name_key')
+
+    def testIdentityKeys(self):
+        q = db.session.query(db.Profile).filter_by(
+                identity_key=self.john.identity_key)
+        self.assertUsesIndex(q, 'ix_profile_identity_key')
+        q = db.session.query(db.Publication).filter_by(
+                title_key=self.paper.title_key)
+        self.assertUsesIndex(q, 'ix_publication_title_key')
+
+    def testAuthors(self):
+        assoc = db.profile_publication_association
+        q = (db.session.query(assoc.c.profile_id)
+            .filter(assoc.c.publication_id == self.paper.id))
+        self.assertUsesIndex(q,
+                'ix_profile_publication_association_publication_id')
+        q = (db.session.query(assoc.c.publication_id)
+            .filter(assoc.c.profile_id == self.john.id))
+        self.assertUsesIndex(q, 'profile_publication_association_pkey')
+
+    def testLowercaseSearch(self):
+        for column in ( db.Profile.firstname
+                      , db.Profile.lastname
+                      , db.Profile.department
+                      , db.Profile.campus
+                      , db.Profile.faculty
+                      ):
+            q = (db.session.query(db.Profile.id)
+                .filter(func.lower(column).in_(['john', 'smith'])))
+            self.assertUsesIndex(q, 'ix_profile_lower_' + column.key)
+
+class PartitionTestCase(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.john = db.Profile(title="Mr", firstname="John", lastname="Smith")
+        self.jane = db.Profile(title="Ms", firstname="Jane", lastname="Doe")
+        self.john.keywords['horse'] = 1.
+        self.john.keywords['cart'] = 2.
+        self.jane.keywords['horse'] = 3.
+        db.session.add(self.john)
+        db.session.add(self.jane)
+        db.session.commit()
+
+    def partition(self, partitions):
+        db.session.remove()
+        return migrations.partition_keyword_weights(db.engine, partitions)
+
+    def testPartition(self):
+        self.assertEqual(migrations.keyword_partitions(db.engine), 0)
+        self.assertIs(self.partition(4), True)
+        self.assertEqual(migrations.keyword_partitions(db.engine), 4)
+        self.assertIs(self.partition(4), False)
+        self.assertIs(self.partition(2), True)
+        self.assertEqual(migrations.keyword_partitions(db.engine), 2)
+
+    def testPartitionwisePlans(self):
+        setting = 'SHOW enable_partitionwise_aggregate'
+        self.assertEqual(db.session.execute(setting).scalar(), 'off')
+        self.partition(4)
+        self.assertEqual(db.session.execute(setting).scalar(), 'on')
+
+    def testWeightsKept(self):
+        self.partition(4)
+        self.assertEqual( dict(db.Profile.get(self.john.id).keywords)
+                        , {'horse': 1., 'cart': 2.}
+                        )
+        count, results = db.get_profiles_by_keywords(['horse', 'cart'], 0, 25)
+        self.assertEqual(count, 2)
+        self.assertEqual( [(p.id, w) for p, w in results]
+                        , [(self.john.id, 3.), (self.jane.id, 3.)]
+                        )
+
+    def testStatisticsKept(self):
+        self.partition(4)
+        self.assertEqual( keyword_statistics()
+                        , {'horse': (2, 4.), 'cart': (1, 2.)}
+                        )
+        ids = db.keyword_ids(['cart'])
+        db.add_keyword_weights(self.jane.id, {ids['cart']: 1.})
+        db.session.commit()
+        self.assertEqual(keyword_statistics()['cart'], (2, 3.))
+
+    def testKeysRebuilt(self):
+        self.partition(4)
+        for index in db.ProfileKeywordAssociation.__table__.indexes:
+            self.assertTrue( migrations.index_valid(db.engine, index.name)
+                           , index.name
+                           )
+        ids = db.keyword_ids(['horse'])
+        with self.assertRaises(db.IntegrityError):
+            db.session.execute(db.ProfileKeywordAssociation.__table__.insert(),
+                               {'left_id': self.john.id,
+                                'right_id': ids['horse'], 'weight': 1.})
+        db.session.rollback()
+        with self.assertRaises(db.IntegrityError):
+            db.session.execute(db.ProfileKeywordAssociation.__table__.insert(),
+                               {'left_id': 1000,
+                                'right_id': ids['horse'], 'weight': 1.})
+        db.session.rollback()
@@ -3,6 +3,7 @@
 import rdflib
 import os.path
 import logging
+from collections import defaultdict
 
 
 #define constants
@@ -77,6 +78,45 @@ class Ontology:
             parent = self._find_parent(parent)
         return results
 
+    def closure(self):
+        """Finds every ancestor of every concept in the ontology.
+
+        Unlike :meth:`find_superclasses`, which follows a single parent
+        at each level, this follows all of them.
+
+        Yields:
+            (Tuple[str, str, int]): A label of a concept, lowercased;
+            the preferred label of one of its ancestors; and the number
+            of levels between them. Where several paths lead to the
+            same ancestor, only the shortest is given.
+
+        Example usage:
+            >>> sorted(r for r in onto.closure() if r[0] == "trees")
+            [('trees', 'Discrete mathematics', 2), ('trees', 'Graph theory', 1), ('trees', 'Mathematics of computing', 3)]
+        """
+        parents = defaultdict(set)
+        for child, parent in self.g.subject_objects(self.n.broader):
+            parents[child].add(parent)
+        labels = defaultdict(set)
+        for predicate in (self.n.prefLabel, self.n.altLabel):
+            for URI, label in self.g.subject_objects(predicate):
+                labels[URI].add(str(label).lower())
+
+        for URI, names in labels.items():
+            depths = {}
+            frontier, depth = [URI], 0
+            while frontier:
+                depth += 1
+                frontier = [parent for node in frontier
+                            for parent in parents[node]
+                            if parent not in depths and parent != URI]
+                for parent in frontier:
+                    depths.setdefault(parent, depth)
+            for ancestor, depth in depths.items():
+                ancestor = self._find_label(ancestor)
+                for name in names:
+                    yield name, ancestor, depth
+
     def _find_parent(self, URI):
         """Finds the URI of the parent of a given URI
 
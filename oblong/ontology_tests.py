@@ -14,6 +14,23 @@ class OntologyTestCate(unittest.TestCase):
                           ]
                         )
                           
+    def test_closure(self):
+        self.assertEqual( sorted(r for r in self.onto.closure()
+                                 if r[0] == 'trees')
+                        , [ ('trees', 'Discrete mathematics', 2)
+                          , ('trees', 'Graph theory', 1)
+                          , ('trees', 'Mathematics of computing', 3)
+                          ]
+                        )
+
+    def test_closure_follows_every_parent(self):
+        closure = {}
+        for concept, ancestor, depth in self.onto.closure():
+            closure.setdefault(concept, set()).add(ancestor)
+        for concept, ancestors in closure.items():
+            chain = self.onto.find_superclasses(concept)[1:]
+            self.assertLessEqual(set(chain), ancestors, concept)
+
     def test__find_parent(self):
         database = self.onto._find_URI('database')
         parent = self.onto._find_parent(database)
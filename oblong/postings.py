@@ -0,0 +1,562 @@
+"""Boolean keyword search over an in-memory inverted index.
+
+Searches such as ``machine learning AND medicine NOT imaging`` would
+take a join per term in SQL. Instead, the profiles having each keyword
+are held in memory as a compressed bitmap of their ids, and a query is
+answered by combining bitmaps: AND is an intersection, OR a union and
+NOT a difference. Only the profiles that survive are ranked, by the
+summed weight of the keywords they matched.
+
+The bitmaps are roaring-style: ids are split into chunks of 65536 by
+their high bits, and each chunk is stored either as a sorted array of
+its low bits or, once it holds more than 4096 ids, as a 65536-bit
+integer, whichever is smaller.
+
+Query syntax:
+    - A term is one or more words, and matches profiles with that
+      keyword or any of its descendants in the ontology. Quote a term
+      to include a word that would otherwise be an operator.
+    - ``AND``, ``OR`` and ``NOT``, in capitals, combine terms. ``NOT``
+      after a term means "and not". Terms next to each other must all
+      match. ``AND`` binds more tightly than ``OR``, and parentheses
+      group.
+
+Queries without an operator are not boolean, and are searched by
+:func:`oblong.profiling.fulfill_query_ids` as before.
+
+The index is loaded from the database the first time it is used, and
+kept up to date through :data:`oblong.database.profile_listeners`,
+which hear of other processes' changes too while an
+:class:`oblong.database.ChangeListener` is running.
+
+Examples:
+    >>> b = Bitmap([3, 70000, 1])
+    >>> list(b), len(b), 70000 in b
+    ([1, 3, 70000], 3, True)
+    >>> list(b & Bitmap([1, 70000, 5])), list(b - Bitmap([3]))
+    ([1, 70000], [1, 70000])
+    >>> parse('machine learning AND (medicine OR biology) NOT imaging')
+    ('and', ('term', 'machine learning'), ('or', ('term', 'medicine'), ('term', 'biology')), ('not', ('term', 'imaging')))
+
+"""
+from array import array
+from bisect import bisect_left
+from collections import defaultdict
+from functools import reduce
+import re
+import threading
+
+from . import database as db
+
+#: The most ids in a chunk stored as an array.
+ARRAY_MAX = 4096
+_CHUNK_BYTES = 65536 // 8
+_NONZERO = re.compile(b'[^\x00]')
+_BITS = [tuple(i for i in range(8) if byte >> i & 1) for byte in range(256)]
+
+def _dense(container):
+    """A chunk as an integer bitset."""
+    if isinstance(container, int):
+        return container
+    bits = bytearray(_CHUNK_BYTES)
+    for low in container:
+        bits[low >> 3] |= 1 << (low & 7)
+    return int.from_bytes(bits, 'little')
+
+def _positions(bits):
+    """The set bits of an integer bitset, in order."""
+    data = bits.to_bytes(_CHUNK_BYTES, 'little')
+    return array('H', [m.start() * 8 + i for m in _NONZERO.finditer(data)
+                       for i in _BITS[data[m.start()]]])
+
+def _popcount(bits):
+    """The number of set bits of an integer bitset."""
+    # int.bit_count is faster, but needs Python 3.10
+    return bin(bits).count('1')
+
+def _compact(container):
+    """Stores a chunk in its smaller form, or ``None`` if it's empty."""
+    if isinstance(container, int):
+        count = _popcount(container)
+        if count > ARRAY_MAX:
+            return container
+        return _positions(container) if count else None
+    if len(container) > ARRAY_MAX:
+        return _dense(container)
+    return container if len(container) else None
+
+def _and(a, b):
+    if isinstance(a, int) and isinstance(b, int):
+        return a & b
+    if isinstance(a, int):
+        a, b = b, a
+    if isinstance(b, int):
+        data = b.to_bytes(_CHUNK_BYTES, 'little')
+        return array('H', [x for x in a if data[x >> 3] >> (x & 7) & 1])
+    return array('H', sorted(set(a).intersection(b)))
+
+def _or(a, b):
+    if isinstance(a, int) or isinstance(b, int):
+        return _dense(a) | _dense(b)
+    return array('H', sorted(set(a).union(b)))
+
+def _andnot(a, b):
+    if isinstance(a, int):
+        return a & ~_dense(b)
+    if isinstance(b, int):
+        data = b.to_bytes(_CHUNK_BYTES, 'little')
+        return array('H', [x for x in a if not data[x >> 3] >> (x & 7) & 1])
+    b = set(b)
+    return array('H', [x for x in a if x not in b])
+
+def _copy(container):
+    return container if isinstance(container, int) else array('H', container)
+
+class Bitmap:
+    """A compressed set of non-negative integers.
+
+    Args:
+        values (Iterable[int]): The initial members.
+
+    """
+    __slots__ = ('_chunks',)
+
+    def __init__(self, values=()):
+        chunks = defaultdict(list)
+        for value in values:
+            chunks[value >> 16].append(value & 0xffff)
+        self._chunks = {}
+        for high, lows in chunks.items():
+            self._chunks[high] = _compact(array('H', sorted(set(lows))))
+
+    def __len__(self):
+        return sum(_popcount(c) if isinstance(c, int) else len(c)
+                   for c in self._chunks.values())
+
+    def __bool__(self):
+        return bool(self._chunks)
+
+    def __contains__(self, value):
+        container = self._chunks.get(value >> 16)
+        if container is None:
+            return False
+        low = value & 0xffff
+        if isinstance(container, int):
+            return bool(container >> low & 1)
+        i = bisect_left(container, low)
+        return i < len(container) and container[i] == low
+
+    def __iter__(self):
+        for high in sorted(self._chunks):
+            container = self._chunks[high]
+            if isinstance(container, int):
+                container = _positions(container)
+            base = high << 16
+            for low in container:
+                yield base | low
+
+    def add(self, value):
+        high, low = value >> 16, value & 0xffff
+        container = self._chunks.get(high)
+        if container is None:
+            self._chunks[high] = array('H', [low])
+        elif isinstance(container, int):
+            self._chunks[high] = container | 1 << low
+        else:
+            i = bisect_left(container, low)
+            if i == len(container) or container[i] != low:
+                container.insert(i, low)
+                if len(container) > ARRAY_MAX:
+                    self._chunks[high] = _dense(container)
+
+    def discard(self, value):
+        high, low = value >> 16, value & 0xffff
+        container = self._chunks.get(high)
+        if container is None:
+            return
+        if isinstance(container, int):
+            container = container & ~(1 << low)
+        else:
+            i = bisect_left(container, low)
+            if i < len(container) and container[i] == low:
+                del container[i]
+        container = _compact(container)
+        if container is None:
+            del self._chunks[high]
+        else:
+            self._chunks[high] = container
+
+    def _combine(self, other, op, keys):
+        result = Bitmap()
+        for high in keys:
+            a, b = self._chunks.get(high), other._chunks.get(high)
+            if a is None or b is None:
+                container = _copy(a if b is None else b)
+            else:
+                container = _compact(op(a, b))
+            if container is not None:
+                result._chunks[high] = container
+        return result
+
+    def __and__(self, other):
+        return self._combine(other, _and,
+                             self._chunks.keys() & other._chunks.keys())
+
+    def __or__(self, other):
+        return self._combine(other, _or,
+                             self._chunks.keys() | other._chunks.keys())
+
+    def __sub__(self, other):
+        result = Bitmap()
+        for high, a in self._chunks.items():
+            b = other._chunks.get(high)
+            container = _copy(a) if b is None else _compact(_andnot(a, b))
+            if container is not None:
+                result._chunks[high] = container
+        return result
+
+class QueryError(ValueError):
+    """Raised for a boolean query that can't be parsed."""
+
+OPERATORS = {'AND', 'OR', 'NOT'}
+_TOKEN = re.compile(r'\s*(?:(\()|(\))|"([^"]*)"|([^\s()"]+))')
+
+def is_boolean(text):
+    """Whether a query uses any boolean operators."""
+    return any(word in OPERATORS for word in re.findall(r'[^\s()"]+', text))
+
+def _tokens(text):
+    """Splits a query into parentheses, operators and terms.
+
+    Adjacent words that aren't operators make up a single term.
+
+    """
+    tokens, words, pos = [], [], 0
+    text = text.rstrip()
+    while pos < len(text):
+        match = _TOKEN.match(text, pos)
+        if match is None:
+            raise QueryError('unbalanced quotes')
+        pos = match.end()
+        open_, close, quoted, word = match.groups()
+        if word is not None and word not in OPERATORS:
+            words.append(word)
+            continue
+        if words:
+            tokens.append(('term', ' '.join(words)))
+            words = []
+        if open_ or close:
+            tokens.append((open_ or close, None))
+        elif quoted is not None:
+            if quoted.strip():
+                tokens.append(('term', ' '.join(quoted.split())))
+        else:
+            tokens.append((word, None))
+    if words:
+        tokens.append(('term', ' '.join(words)))
+    return tokens
+
+def parse(text):
+    """Parses a boolean query.
+
+    Returns:
+        A tree of tuples: ``('term', str)``, ``('not', node)``, or
+        ``('and', *nodes)`` and ``('or', *nodes)``.
+
+    Raises:
+        QueryError: If the query is malformed.
+
+    """
+    tokens = _tokens(text)
+    pos = 0
+
+    def peek():
+        return tokens[pos][0] if pos < len(tokens) else None
+
+    def take():
+        nonlocal pos
+        pos += 1
+        return tokens[pos - 1]
+
+    def disjunction():
+        nodes = [conjunction()]
+        while peek() == 'OR':
+            take()
+            nodes.append(conjunction())
+        return nodes[0] if len(nodes) == 1 else ('or',) + tuple(nodes)
+
+    def conjunction():
+        nodes = [unary()]
+        while peek() in ('AND', 'NOT', 'term', '('):
+            if peek() == 'AND':
+                take()
+            nodes.append(unary())
+        return nodes[0] if len(nodes) == 1 else ('and',) + tuple(nodes)
+
+    def unary():
+        kind, value = take() if pos < len(tokens) else (None, None)
+        if kind == 'NOT':
+            return ('not', unary())
+        if kind == 'term':
+            return ('term', value)
+        if kind == '(':
+            node = disjunction()
+            if peek() != ')':
+                raise QueryError('unbalanced parentheses')
+            take()
+            return node
+        raise QueryError('expected a term, found {}'
+                         .format(kind or 'the end of the query'))
+
+    node = disjunction()
+    if pos < len(tokens):
+        raise QueryError('unexpected {}'.format(tokens[pos][0]))
+    return node
+
+def _positive_terms(node):
+    """The terms of a query that aren't negated."""
+    kind = node[0]
+    if kind == 'term':
+        return [node[1]]
+    if kind == 'not':
+        return []
+    return [t for child in node[1:] for t in _positive_terms(child)]
+
+class PostingsIndex:
+    """The profiles having each keyword, as bitmaps.
+
+    Also holds each profile's keyword weights, to rank the results of a
+    search.
+
+    """
+    def __init__(self):
+        self._postings = {}
+        self._vectors = {}
+        self._all = Bitmap()
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._vectors)
+
+    def postings(self, keyword):
+        """The ids of the profiles with a keyword."""
+        return self._postings.get(keyword, Bitmap())
+
+    def load(self, vectors):
+        """Replaces the whole index, much faster than :meth:`update`.
+
+        Args:
+            vectors (Dict[int, Dict[str, float]]): The keyword weights
+                of every profile, by id.
+
+        """
+        holders = defaultdict(list)
+        for uid, vector in vectors.items():
+            for keyword in vector:
+                holders[keyword].append(uid)
+        with self._lock:
+            self._postings = {k: Bitmap(uids) for k, uids in holders.items()}
+            self._vectors = {uid: dict(v) for uid, v in vectors.items() if v}
+            self._all = Bitmap(self._vectors)
+
+    def update(self, uid, vector):
+        """Adds a profile to the index, replacing any previous version.
+
+        Args:
+            uid (int): The id of the profile.
+            vector (Dict[str, float]): Its keyword weights, by name.
+
+        """
+        with self._lock:
+            old = self._vectors.pop(uid, {})
+            for keyword in old.keys() - vector.keys():
+                postings = self._postings[keyword]
+                postings.discard(uid)
+                if not postings:
+                    del self._postings[keyword]
+            for keyword in vector.keys() - old.keys():
+                self._postings.setdefault(keyword, Bitmap()).add(uid)
+            if vector:
+                self._vectors[uid] = dict(vector)
+                self._all.add(uid)
+            else:
+                self._all.discard(uid)
+
+    def remove(self, uid):
+        self.update(uid, {})
+
+    def search(self, query, expand=None):
+        """Finds the profiles matching a boolean query.
+
+        Args:
+            query: A query, as returned by :func:`parse`.
+            expand (Optional[Callable[[str], Sequence[Tuple[str, float]]]]):
+                Gives the keywords a term matches, and how much each
+                counts towards a profile's score. By default, a term
+                matches only the keyword with the same name.
+
+        Returns:
+            (List[Tuple[int, float]]): The ids and scores of the
+            matching profiles, best first.
+
+        """
+        if expand is None:
+            expand = lambda term: [(term, 1.)]
+        expansions = {}
+
+        def matches(term):
+            if term not in expansions:
+                expansions[term] = expand(term)
+            return reduce(Bitmap.__or__, (self.postings(k)
+                                          for k, _ in expansions[term]),
+                          Bitmap())
+
+        def evaluate(node):
+            kind = node[0]
+            if kind == 'term':
+                return matches(node[1])
+            if kind == 'not':
+                return self._all - evaluate(node[1])
+            if kind == 'or':
+                return reduce(Bitmap.__or__, map(evaluate, node[1:]))
+            # intersect the positive terms, smallest first, then take
+            # away the negated ones
+            positive = sorted((evaluate(n) for n in node[1:]
+                               if n[0] != 'not'), key=len)
+            result = reduce(Bitmap.__and__, positive) if positive \
+                     else self._all
+            for n in node[1:]:
+                if n[0] == 'not' and result:
+                    result = result - evaluate(n[1])
+            return result
+
+        with self._lock:
+            found = evaluate(query)
+            scoring = defaultdict(float)
+            for term in set(_positive_terms(query)):
+                for keyword, factor in expansions.get(term) or expand(term):
+                    scoring[keyword] += factor
+            scored = []
+            for uid in found:
+                vector = self._vectors[uid]
+                scored.append((uid, sum(vector.get(k, 0.) * f
+                                        for k, f in scoring.items())))
+        scored.sort(key=lambda p: (-p[1], p[0]))
+        return scored
+
+class ProfilePostings:
+    """A :class:`PostingsIndex` over the profiles in the database.
+
+    The index is built the first time it is queried after
+    :func:`oblong.database.init`, and refreshed for individual
+    profiles whenever :func:`oblong.database.profiles_changed` is
+    called.
+
+    """
+    def __init__(self):
+        self._index = None
+        self._descendants = {}
+        self._engine = None
+        self._lock = threading.Lock()
+
+    def _vectors(self, uids=None):
+        assoc = db.ProfileKeywordAssociation
+        q = (db.session.query(assoc.left_id, db.Keyword.name, assoc.weight)
+            .join(db.Keyword, db.Keyword.id == assoc.right_id))
+        if uids is not None:
+            q = q.filter(assoc.left_id.in_(uids))
+        vectors = defaultdict(dict)
+        for uid, name, weight in q:
+            vectors[uid][name] = weight
+        return vectors
+
+    @property
+    def index(self):
+        if self._index is None or self._engine is not db.engine:
+            with self._lock:
+                if self._index is None or self._engine is not db.engine:
+                    index = PostingsIndex()
+                    index.load(self._vectors())
+                    closure = db.OntologyClosure
+                    descendants = defaultdict(list)
+                    for concept, ancestor, weight in db.session.query(
+                            closure.concept, closure.ancestor, closure.weight):
+                        descendants[ancestor].append((concept, weight))
+                    self._descendants = dict(descendants)
+                    self._engine = db.engine
+                    self._index = index
+        return self._index
+
+    def reset(self):
+        """Forgets the index, so it is reloaded on next use."""
+        with self._lock:
+            self._index = None
+            self._engine = None
+
+    def refresh(self, uids):
+        """Reloads the keywords of some profiles from the database.
+
+        Args:
+            uids (Iterable[int]): The ids of the profiles to reload.
+
+        """
+        uids = list(uids)
+        if self._index is None or self._engine is not db.engine or not uids:
+            return
+        vectors = self._vectors(uids)
+        for uid in uids:
+            self._index.update(uid, vectors.get(uid, {}))
+
+    def expand(self, keywords):
+        """The keywords that a term matches, with their score factors.
+
+        Args:
+            keywords (Iterable[str]): The keywords named by the term.
+
+        """
+        expanded = {}
+        for keyword in keywords:
+            keyword = ' '.join(keyword.lower().split())
+            expanded[keyword] = 1.
+            for concept, weight in self._descendants.get(keyword, ()):
+                expanded[concept] = max(expanded.get(concept, 0), weight)
+        return list(expanded.items())
+
+    def search(self, query, page_no, page_size, resolve=None):
+        """Finds a page of the profiles matching a boolean query.
+
+        Args:
+            query (str): The query. See the module's documentation.
+            page_no (int): The number of the page to return.
+            page_size (int): The number of results per page.
+            resolve (Optional[Callable[[str], Sequence[str]]]): Gives
+                the keywords named by a term that isn't a keyword
+                itself, such as the singular of a plural.
+
+        Returns:
+            (int, List[Tuple[int, float]]): The number of matching
+            profiles, and the ids and scores of those on the page.
+
+        Raises:
+            QueryError: If the query is malformed.
+
+        """
+        tree = parse(query)
+        index = self.index
+
+        def expand(term):
+            keywords = [term]
+            term = ' '.join(term.lower().split())
+            if (resolve is not None and not index.postings(term)
+                    and term not in self._descendants):
+                keywords = resolve(term) or keywords
+            return self.expand(keywords)
+
+        results = index.search(tree, expand)
+        start = page_no * page_size
+        return len(results), results[start:start + page_size]
+
+#: The postings of the current database.
+profiles = ProfilePostings()
+db.profile_listeners.append(profiles.refresh)
+db.reset_listeners.append(profiles.reset)
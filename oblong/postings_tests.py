@@ -0,0 +1,157 @@
+import random
+import time
+import unittest
+from unittest import mock
+from . import postings, database as db
+from .database_tests import DatabaseTestCase
+
+class BitmapTestCase(unittest.TestCase):
+    def setUp(self):
+        rng = random.Random(0)
+        # a dense chunk, a sparse chunk and a chunk in only one of them
+        self.a = set(rng.sample(range(65536), 10000)) \
+               | set(rng.sample(range(65536, 131072), 100))
+        self.b = set(rng.sample(range(65536), 3000)) \
+               | set(rng.sample(range(65536, 131072), 5000)) \
+               | {200000}
+
+    def testMembership(self):
+        bitmap = postings.Bitmap(self.a)
+        self.assertEqual(len(bitmap), len(self.a))
+        self.assertEqual(list(bitmap), sorted(self.a))
+        self.assertIn(min(self.a), bitmap)
+        self.assertNotIn(131072, bitmap)
+
+    def testOperators(self):
+        a, b = postings.Bitmap(self.a), postings.Bitmap(self.b)
+        self.assertEqual(list(a & b), sorted(self.a & self.b))
+        self.assertEqual(list(a | b), sorted(self.a | self.b))
+        self.assertEqual(list(a - b), sorted(self.a - self.b))
+        self.assertEqual(list(b - a), sorted(self.b - self.a))
+        self.assertEqual(list(a), sorted(self.a))
+
+    def testAddAndDiscard(self):
+        bitmap = postings.Bitmap()
+        values = list(range(0, 20000, 2))
+        for value in values:
+            bitmap.add(value)
+        self.assertIsInstance(bitmap._chunks[0], int)
+        for value in values[100:]:
+            bitmap.discard(value)
+        self.assertNotIsInstance(bitmap._chunks[0], int)
+        self.assertEqual(list(bitmap), values[:100])
+        for value in values[:100]:
+            bitmap.discard(value)
+        self.assertFalse(bitmap)
+
+class ParseTestCase(unittest.TestCase):
+    def testPrecedence(self):
+        self.assertEqual(postings.parse('a OR b c AND NOT d'),
+                         ('or', ('term', 'a'),
+                                ('and', ('term', 'b c'), ('not', ('term', 'd')))))
+        self.assertEqual(postings.parse('(a OR b) "c  OR d"'),
+                         ('and', ('or', ('term', 'a'), ('term', 'b')),
+                                 ('term', 'c OR d')))
+
+    def testIsBoolean(self):
+        self.assertTrue(postings.is_boolean('machine learning NOT imaging'))
+        self.assertFalse(postings.is_boolean('machine learning and not imaging'))
+
+    def testMalformed(self):
+        for query in ['a AND', '(a OR b', 'a OR b)', 'NOT', '"a AND b', '()']:
+            with self.assertRaises(postings.QueryError, msg=query):
+                postings.parse(query)
+
+class PostingsIndexTestCase(unittest.TestCase):
+    def setUp(self):
+        self.index = postings.PostingsIndex()
+        self.index.update(1, {'machine learning': 10., 'medicine': 5.})
+        self.index.update(2, {'machine learning': 3., 'medicine': 9.,
+                              'imaging': 4.})
+        self.index.update(3, {'machine learning': 6.})
+
+    def search(self, query):
+        return self.index.search(postings.parse(query))
+
+    def testSearch(self):
+        self.assertEqual(self.search('machine learning AND medicine'),
+                         [(1, 15.), (2, 12.)])
+        self.assertEqual(self.search('machine learning AND medicine '
+                                     'NOT imaging'), [(1, 15.)])
+        self.assertEqual(self.search('imaging OR NOT medicine'),
+                         [(2, 4.), (3, 0.)])
+        self.assertEqual(self.search('horse'), [])
+
+    def testLoad(self):
+        index = postings.PostingsIndex()
+        index.load({ 1: {'machine learning': 10., 'medicine': 5.}
+                   , 2: {'machine learning': 3., 'medicine': 9., 'imaging': 4.}
+                   , 3: {'machine learning': 6.}
+                   , 4: {}
+                   })
+        query = postings.parse('machine learning NOT imaging')
+        self.assertEqual(index.search(query), self.index.search(query))
+        self.assertEqual(len(index), 3)
+
+    def testUpdate(self):
+        self.index.update(2, {'imaging': 1.})
+        self.assertEqual(self.search('medicine'), [(1, 5.)])
+        self.index.remove(1)
+        self.assertEqual(self.search('medicine'), [])
+        self.assertEqual(len(self.index), 2)
+
+class ProfilePostingsTestCase(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.john = db.Profile(title="Mr", firstname="John", lastname="Smith")
+        self.jane = db.Profile(title="Ms", firstname="Jane", lastname="Doe")
+        for p in (self.john, self.jane):
+            db.session.add(p)
+        self.john.keywords["trees"] = 10.
+        self.john.keywords["porcupine"] = 5.
+        self.jane.keywords["graph theory"] = 10.
+        db.session.commit()
+
+    def testOntologyExpansion(self):
+        count, results = postings.profiles.search('graph theory', 0, 10)
+        self.assertEqual(count, 2)
+        self.assertEqual(results[0], (self.jane.id, 10.))
+        uid, score = results[1]
+        self.assertEqual(uid, self.john.id)
+        self.assertLess(score, 10.)
+
+        count, results = postings.profiles.search(
+                'graph theory NOT porcupine', 0, 10)
+        self.assertEqual(results, [(self.jane.id, 10.)])
+
+    def testResolve(self):
+        count, _ = postings.profiles.search('porcupines AND trees', 0, 10)
+        self.assertEqual(count, 0)
+        count, results = postings.profiles.search(
+                'porcupines AND trees', 0, 10,
+                resolve=lambda term: [term.rstrip('s')])
+        self.assertEqual(results, [(self.john.id, 15.)])
+
+    def testRefresh(self):
+        self.assertEqual(postings.profiles.search('horse', 0, 10), (0, []))
+        self.jane.keywords["horse"] = 10.
+        db.session.commit()
+        db.profiles_changed([self.jane.id])
+        self.assertEqual(postings.profiles.search('horse OR porcupine', 0, 1),
+                         (2, [(self.jane.id, 10.)]))
+
+    def testRefreshedByOtherProcess(self):
+        listener = db.enable_change_listener(timeout=.1)
+        self.addCleanup(db.disable_change_listener)
+        self.assertTrue(listener.connected.wait(10))
+        self.assertEqual(postings.profiles.search('horse', 0, 10), (0, []))
+        self.jane.keywords["horse"] = 10.
+        db.session.commit()
+        with mock.patch.object(db, '_origin', return_value='other'):
+            db.publish_changes('profiles', [self.jane.id])
+        for _ in range(100):
+            if postings.profiles.search('horse', 0, 10)[0]:
+                break
+            time.sleep(.1)
+        self.assertEqual(postings.profiles.search('horse', 0, 10),
+                         (1, [(self.jane.id, 10.)]))
@@ -1,22 +1,169 @@
 """Algorithms that profile users based on paper metadata."""
+import atexit
+from collections import defaultdict, namedtuple
 import datetime
+from functools import lru_cache
+import hashlib
+import json
+import logging
 from os import linesep
 import os.path
+import threading
+import time
 from time import gmtime
 
 import nltk
 from nltk import pos_tag, word_tokenize, RegexpParser
 from nltk.stem import WordNetLemmatizer
+from sqlalchemy import Float, case, cast, func
+from sqlalchemy.exc import IntegrityError
 
 from . import database as db
+from . import postings
+from .vocabulary import vocabulary, terms_changed
 
 from .ontology import *
 
+log = logging.getLogger(__name__)
+
 BASE_DIR = os.path.dirname(__file__)
 nltk.data.path.append(os.path.join(BASE_DIR, 'data', 'nltk'))
 
 onto = Ontology() #import the ACM ontology
 
+#: The words that are never keywords, one per line.
+STOPWORDS_FILE = os.path.join(BASE_DIR, 'data', 'stopwords.txt')
+
+#We don't want keywords to contain anything in this list
+FORBIDDEN = ['.',',',';',':','?','!','+',')','(','[',']','/','<','>','"','©','1','2','3','4','5','6','7','8','9','0']
+
+# NLTK Chunking - detects noun phrases and phrases of form verb noun or adj noun
+CHUNK_GRAMMAR = """NP: {<JJ>*<NN><NNS>}
+                      {<JJR><NNS>}
+                      {<JJ>*<NNS>}
+                      {<NN><NNS>} 
+                      {<JJ><NNS>}
+                      {<JJ>*<NN>*}
+                      {<NN>*}
+                      {<NNS>*}"""
+
+lemmatizer = WordNetLemmatizer()
+
+#: Bump this when changing how :func:`get_keywords` works, other than
+#: through the stopwords, grammar or lemmatizer, which are accounted
+#: for by :data:`PIPELINE_VERSION`.
+EXTRACTION_VERSION = 1
+
+def _pipeline_version():
+    h = hashlib.md5()
+    with open(STOPWORDS_FILE, 'rb') as f:
+        h.update(f.read())
+    for part in [ str(EXTRACTION_VERSION)
+                , ''.join(FORBIDDEN)
+                , CHUNK_GRAMMAR
+                , type(lemmatizer).__module__
+                , type(lemmatizer).__qualname__
+                , nltk.__version__
+                ]:
+        h.update(b'\0' + part.encode('utf-8'))
+    return h.hexdigest()
+
+#: Identifies the keyword extraction pipeline, so that cached
+#: extractions are ignored once it changes.
+PIPELINE_VERSION = _pipeline_version()
+
+class SingleFlight:
+    """Shares the result of a call among concurrent identical callers.
+
+    While a call for some key is in progress, any other thread calling
+    :meth:`do` with the same key waits for it and receives its result,
+    or its exception, rather than repeating the work. Nothing is kept
+    once the call returns, so a later call always runs afresh.
+
+    Some exceptions say more about the thread that made the call than
+    about the call, such as running out of the time that thread was
+    given. Threads that waited for a call that raised one of those make
+    the call themselves instead.
+
+    Args:
+        private (Optional[Callable[[BaseException], bool]]): Whether an
+            exception is only the calling thread's own.
+
+    Attributes:
+        calls (int): The number of calls to :meth:`do`.
+        coalesced (int): The number of those that waited for another
+            thread's call instead of running their own.
+
+    """
+    def __init__(self, private=None):
+        self.private = private
+        self.calls = 0
+        self.coalesced = 0
+        self._lock = threading.Lock()
+        self._running = {}
+
+    def do(self, key, f, *args):
+        """Calls ``f(*args)``, unless a call for ``key`` is running.
+
+        Args:
+            key (Hashable): Identifies calls that are interchangeable.
+            f (Callable): The function to call.
+            *args: Passed to ``f``.
+
+        Returns:
+            The result of the call for ``key``.
+
+        """
+        with self._lock:
+            self.calls += 1
+            call = self._running.get(key)
+            leader = call is None
+            if leader:
+                call = self._running[key] = _Call()
+            else:
+                self.coalesced += 1
+        if not leader:
+            call.done.wait()
+            if (call.error is not None and self.private is not None
+                    and self.private(call.error)):
+                return f(*args)
+        else:
+            try:
+                call.result = f(*args)
+            except BaseException as e:
+                call.error = e
+            finally:
+                with self._lock:
+                    del self._running[key]
+                call.done.set()
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+def _timed_out(error):
+    return isinstance(error, db.DeadlineExceeded) or db.is_timeout(error)
+
+#: Coalesces identical searches made at the same time; see
+#: :func:`fulfill_query_ids`. A search that runs out of the leading
+#: thread's time is made again by each thread that waited for it, in
+#: the time it has left.
+searches = SingleFlight(private=_timed_out)
+
+def normalise_query(text):
+    """Collapses the whitespace in a search query.
+
+    Queries that only differ in whitespace have the same keywords and
+    boolean structure, so they are searched once between them.
+
+    """
+    return ' '.join(text.split())
+
 def fulfill_query(text, page_no, page_size):
     """Fulfills a query by searching the database.
 
@@ -27,19 +174,81 @@ def fulfill_query(text, page_no, page_size):
         page_size (int): The number of results per page.
 
     """
-    keywords = get_keywords(text)
+    n, uids = _coalesced_search(text, page_no, page_size, boolean=False)
+    if not uids:
+        return n, ()
+    profiles = {p.id: p for p in
+                db.Profile.query.filter(db.Profile.id.in_(uids))}
+    return n, tuple(profiles[uid] for uid in uids if uid in profiles)
+
+def fulfill_query_ids(text, page_no, page_size):
+    """Like :func:`fulfill_query`, but returns the ids of the profiles.
+
+    See :func:`oblong.database.search_profiles`. Queries that use
+    ``AND``, ``OR`` or ``NOT`` are answered by
+    :data:`oblong.postings.profiles` instead.
+
+    Threads making the same search, up to whitespace, for the same
+    page at the same time share a single search, see :data:`searches`,
+    if their sessions are both routed to the primary or both to a
+    replica.
+
+    Raises:
+        oblong.postings.QueryError: If a boolean query is malformed.
+
+    """
+    n, uids = _coalesced_search(text, page_no, page_size,
+                                boolean=postings.is_boolean(text))
+    return n, list(uids)
+
+def _coalesced_search(text, page_no, page_size, boolean):
+    text = normalise_query(text)
+    # the search runs in the leading thread's session, so only threads
+    # that may read from the same kind of database can share it
+    read_only = bool(db.session.info.get('read_only'))
+    return searches.do((text, page_no, page_size, boolean, read_only),
+                       _search, text, page_no, page_size, boolean)
+
+def _search(text, page_no, page_size, boolean):
+    if boolean:
+        n, results = postings.profiles.search(text, page_no, page_size,
+                                              resolve=query_keywords)
+        return n, tuple(uid for uid, _ in results)
+    keywords = query_keywords(text)
     if not keywords:
-        return 0, []
-    else:
-        n, results = db.get_profiles_by_keywords(keywords, page_no, page_size)
-        profiles = tuple(zip(*results))
-        if profiles:
-            profiles = profiles[0]
-        return n, profiles
+        return 0, ()
+    n, results = db.search_profiles(keywords, page_no, page_size)
+    return n, tuple(uid for uid, _ in results)
+
+def query_keywords(text):
+    """Gets the keywords of a search query.
+
+    Short queries usually consist only of words we already know, so
+    they are matched against the vocabulary first; the (much slower)
+    NLTK pipeline is only used if none of the query is recognised.
+
+    Args:
+        text (str): The query.
+
+    Returns:
+        (Sequence[str]): The keywords of the query.
+
+    """
+    return vocabulary.find(text) or get_keywords(text)
 
 def update_authors_profiles(title, abstract, authors, date):
     """Updates the profiles of the authors of a new paper.
 
+    The paper's keywords are added to each author's profile with a
+    single ``INSERT ... ON CONFLICT DO UPDATE``, so concurrent papers
+    by the same author cannot overwrite each other's changes.
+
+    The keywords it contributes in its year of publication are also
+    recorded, and each author's weights are then computed again from
+    all of their contributions, see :func:`decayed_weight`. So they
+    are those :func:`age_profiles` and
+    :func:`oblong.rebuild.rebuild_profiles` would give.
+
     Args:
         title (str): The title of the new paper.
         authors: Data about the authors of the paper.
@@ -47,27 +256,305 @@ def update_authors_profiles(title, abstract, authors, date):
 
     """
     #date = datetime.date(int(date[:4]), int(date[5:7]), int(date[8:10]))
+    publication, profiles = store_paper(title, abstract, authors, date)
+
+    occurrences = cached_paper_occurrences(title, abstract)
+    year = int(date[:4])
+    weights = {word: n * occurrence_weight(year)
+               for word, n in occurrences.items()}
+    contributions = {(word, year): n for word, n in occurrences.items()}
+
+    if write_behind is not None:
+        for uid in sorted(set(profiles)):
+            db.add_publication(uid, publication)
+        db.session.commit()
+        write_behind.add(profiles, weights, contributions)
+        return
+
+    ids = db.keyword_ids(occurrences)
+    weights = {ids[word]: w for word, w in weights.items()}
+    contributions = {(ids[word], year): n
+                     for (word, year), n in contributions.items()}
+
+    # lock profiles in a consistent order, so papers that share authors
+    # can be submitted concurrently without deadlocking
+    for uid in sorted(set(profiles)):
+        db.lock_profile(uid)
+        db.add_keyword_weights(uid, weights)
+        db.add_publication(uid, publication)
+    db.add_contributions({(uid, k, year): n for uid in set(profiles)
+                          for (k, year), n in contributions.items()})
+    db.reweigh_profiles(decayed_weight(), 100, profiles)
+    db.session.commit()
+    db.profiles_changed(profiles)
+
+class WriteBehind:
+    """Buffers the keyword weights added to profiles, to write in bulk.
+
+    Every paper by a busy author otherwise updates the same rows of
+    ``profile_keyword_association``, each in its own transaction. Here
+    the weights each paper adds are summed in memory, and written at
+    once with a handful of statements when either ``max_deltas``
+    (profile, keyword) pairs are waiting or ``max_delay`` seconds have
+    passed, and when the process exits.
+
+    Each flush weighs its profiles again from all of their keyword
+    contributions, as :func:`update_authors_profiles` does, so they end
+    up as they would have been written one paper at a time. Until a
+    flush, the new weights can't be seen at all.
+
+    The keyword contributions of each paper, see
+    :func:`update_authors_profiles`, are buffered and written with
+    the weights.
+
+    Keywords are buffered by name, not id: until a flush, nothing in
+    the database uses them, so :func:`oblong.database.sweep_orphan_keywords`
+    or :func:`oblong.database.purge_keywords` may delete them. Each
+    flush looks them up again, creating any that are gone.
+
+    If a ``journal`` file is given, weights are appended to it, and
+    synced to disk, before :meth:`add` returns; any left over from a
+    process that died before flushing them are written by
+    :meth:`start`. Weights flushed just before a crash, but not yet
+    cleared from the journal, are written again.
+
+    Args:
+        max_deltas (int): The most (profile, keyword) pairs to buffer.
+        max_delay (float): The longest to buffer anything, in seconds.
+        journal (Optional[str]): The file to journal weights to.
+
+    """
+    def __init__(self, max_deltas=10000, max_delay=1., journal=None):
+        self.max_deltas = max_deltas
+        self.max_delay = max_delay
+        self.journal = journal
+        self._deltas = defaultdict(float)
+        self._contributions = defaultdict(int)
+        self._lock = threading.Lock()
+        self._flushing = threading.Lock()
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._file = None
+
+    def __len__(self):
+        return len(self._deltas)
+
+    def start(self):
+        """Replays the journal and starts flushing in the background."""
+        if self.journal is not None:
+            if os.path.exists(self.journal):
+                with open(self.journal, 'rb') as f:
+                    for line in f:
+                        self._buffer(*json.loads(line.decode('utf-8')))
+                log.info('replaying %d keyword weights from %s',
+                         len(self), self.journal)
+            self._file = open(self.journal, 'ab')
+            self.flush()
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name='write-behind')
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        """Flushes anything buffered and stops flushing."""
+        if self._thread is None:
+            return
+        self._stopped.set()
+        self._wake.set()
+        self._thread.join()
+        self._thread = None
+        atexit.unregister(self.stop)
+        self.flush()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def add(self, uids, weights, contributions=None):
+        """Adds to the keyword weights of some profiles.
+
+        Args:
+            uids (Iterable[int]): The ids of the profiles.
+            weights (Dict[str, float]): The amount to add to the weight
+                of each keyword, by keyword name.
+            contributions (Optional[Dict[Tuple[str, int], int]]): The
+                occurrences to add to each profile's contributions, by
+                keyword name and year.
+
+        """
+        uids = sorted(set(uids))
+        weights = sorted(weights.items())
+        contributions = sorted((k, year, n) for (k, year), n
+                               in (contributions or {}).items())
+        with self._lock:
+            if self._file is not None:
+                self._file.write(json.dumps([uids, weights, contributions])
+                                 .encode('utf-8') + b'\n')
+                self._file.flush()
+                os.fsync(self._file.fileno())
+            self._buffer(uids, weights, contributions)
+            full = len(self._deltas) >= self.max_deltas
+        if full:
+            self._wake.set()
+
+    def _buffer(self, uids, weights, contributions=()):
+        for uid in uids:
+            for k, w in weights:
+                self._deltas[uid, k] += w
+            for k, year, n in contributions:
+                self._contributions[uid, k, year] += n
+
+    def flush(self):
+        """Writes everything buffered to the database.
+
+        If the database rejects the weights of some profiles, say
+        because one has been deleted, they are split up by profile until
+        the ones at fault are found, which are logged and dropped; the
+        rest are written. If this fails otherwise, the weights not yet
+        written stay buffered, to be tried again.
+
+        """
+        with self._flushing:
+            with self._lock:
+                deltas, self._deltas = self._deltas, defaultdict(float)
+                contributions = self._contributions
+                self._contributions = defaultdict(int)
+                journalled = self._file.tell() if self._file else None
+            if not deltas:
+                return
+            done = set()
+            try:
+                self._write(sorted({uid for uid, _ in deltas}), deltas,
+                            contributions, done)
+            except Exception:
+                db.session.rollback()
+                with self._lock:
+                    for (uid, k), w in deltas.items():
+                        if uid not in done:
+                            self._deltas[uid, k] += w
+                    for (uid, k, year), n in contributions.items():
+                        if uid not in done:
+                            self._contributions[uid, k, year] += n
+                raise
+            finally:
+                if done:
+                    db.profiles_changed(done)
+            if journalled is not None:
+                self._truncate(journalled)
+
+    def _write(self, uids, deltas, contributions, done):
+        """Writes the buffered weights of some profiles.
+
+        Args:
+            uids (Sequence[int]): The profiles, in order of id.
+            deltas: As buffered, for these profiles and perhaps others.
+            contributions: Likewise.
+            done (Set[int]): The profiles written, or dropped, are
+                added to this.
+
+        """
+        members = set(uids)
+        try:
+            names = ({k for uid, k in deltas if uid in members}
+                     | {k for uid, k, _ in contributions if uid in members})
+            ids = db.keyword_ids(names)
+            db.lock_profiles(uids)
+            db.add_weight_deltas({(uid, ids[k]): w for (uid, k), w
+                                  in deltas.items() if uid in members})
+            db.add_contributions({(uid, ids[k], year): n
+                                  for (uid, k, year), n
+                                  in contributions.items() if uid in members})
+            db.reweigh_profiles(decayed_weight(), 100, uids)
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            if len(uids) == 1:
+                log.exception('dropping the keyword weights of profile %d',
+                              uids[0])
+                done.update(uids)
+                return
+            half = len(uids) // 2
+            self._write(uids[:half], deltas, contributions, done)
+            self._write(uids[half:], deltas, contributions, done)
+            return
+        done.update(uids)
+
+    def _truncate(self, flushed):
+        """Removes the first ``flushed`` bytes of the journal."""
+        with self._lock:
+            self._file.close()
+            with open(self.journal, 'rb') as f:
+                f.seek(flushed)
+                rest = f.read()
+            tmp = self.journal + '.tmp'
+            with open(tmp, 'wb') as f:
+                f.write(rest)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.journal)
+            self._file = open(self.journal, 'ab')
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wake.wait(self.max_delay)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                log.exception('failed to flush keyword weights')
+        db.session.remove()
+
+#: If set, :func:`update_authors_profiles` adds keyword weights through
+#: this rather than writing them itself.
+write_behind = None
+
+def enable_write_behind(**kwargs):
+    """Buffers the keyword weights of new papers, see :class:`WriteBehind`.
+
+    Args:
+        **kwargs: Passed to :class:`WriteBehind`.
+
+    Returns:
+        (WriteBehind): The buffer, already started.
+
+    """
+    global write_behind
+    disable_write_behind()
+    write_behind = WriteBehind(**kwargs)
+    write_behind.start()
+    return write_behind
+
+def disable_write_behind():
+    """Flushes and stops any write-behind buffer."""
+    global write_behind
+    if write_behind is not None:
+        write_behind.stop()
+        write_behind = None
+
+def store_paper(title, abstract, authors, date):
+    """Gets or creates a paper and the profiles of its authors.
+
+    Nothing is committed, and the authors' keywords are left alone.
+
+    Args:
+        title (str): The title of the paper.
+        abstract (Optional[str]): The abstract of the paper.
+        authors: Data about the authors of the paper.
+        date (str): The date of the paper in XML datetime format.
+
+    Returns:
+        (int, List[int]): The id of the paper and of each author's
+        profile.
+
+    """
     publication, _ = db.get_one_or_create(db.Publication, 
-            create_method_kwargs={ 'abstract': abstract, 'date': date },
-            title=title)
-
-    keywords = get_keywords(title)
-    if abstract:
-        keywords += get_keywords(abstract)
-    
-    #create lists of concepts from the ontology
-    keyword_classes = [onto.find_superclasses(w) for w in keywords]
-
-    #create a list of weightings of keywords
-    weightings = {}
-    for kw_class in keyword_classes:
-        dist = 0
-        for word in kw_class:
-            weightings[word] = weighting(word, keywords, date, dist)
-            dist += 1
-
-    keywords = [w for c in keyword_classes for w in c] #flatten keyword_classes
+            create_method_kwargs={ 'title': title
+                                 , 'abstract': abstract
+                                 , 'date': date
+                                 },
+            title_key=db.publication_title_key(title))
 
+    profiles = []
     for author in authors:
         profile, _ = db.get_one_or_create(db.Profile, 
                 create_method_kwargs={ 'title': author['name']['title']
@@ -79,29 +566,155 @@ def update_authors_profiles(title, abstract, authors, date):
                                      , 'building': author['building']
                                      , 'room': author['room']
                                      , 'website': author['website']
+                                     , 'firstname': author['name']['first']
+                                     , 'lastname': author['name']['last']
+                                     , 'faculty': author['faculty']
                                      },
-                firstname=author['name']['first'],
-                lastname=author['name']['last'],
-                faculty=author['faculty'])
-
-        profile_weightings = weightings.copy()
-        if profile.keywords:
-            for word in weightings:
-                weightings[word] /= len(profile.keywords)
-        
-        #update weightings
-        for word in keywords:
-            if word not in profile.keywords:
-                profile.keywords[word] = 0
-            profile.keywords[word] += profile_weightings[word]
-
-        # scale between 0 and 100
-        m = max(profile.keywords.values()) if profile.keywords else 1
-        for word in profile.keywords:
-            profile.keywords[word] *= 100 / m
-
-        profile.publications.append(publication)
-    db.session.commit()
+                identity_key=db.profile_identity_key(author['name']['first'],
+                                                     author['name']['last'],
+                                                     author['faculty']))
+        profiles.append(profile.id)
+    return publication.id, profiles
+
+def paper_occurrences(title, abstract, extracted=None):
+    """Counts the occurrences of each keyword of a paper.
+
+    This does not touch the database, so it is safe to call from
+    worker processes.
+
+    Args:
+        title (str): The title of the paper.
+        abstract (Optional[str]): The abstract of the paper.
+        extracted (Optional[Dict[str, Sequence[str]]]): See
+            :func:`paper_keywords`.
+
+    Returns:
+        (Dict[str, int]): The number of times each keyword occurs.
+
+    """
+    if extracted is None:
+        extracted = {}
+    occurrences = defaultdict(int)
+    for text in (title, abstract) if abstract else (title,):
+        if text not in extracted:
+            extracted[text] = get_keywords(text)
+        for word in extracted[text]:
+            occurrences[word] += 1
+    return dict(occurrences)
+
+def paper_keywords(title, abstract, date, extracted=None):
+    """Extracts the weighted keywords of a paper.
+
+    This does not touch the database, so it is safe to call from
+    worker processes.
+
+    Only the keywords found in the paper are returned. Their ancestors
+    in the ontology are not stored on profiles; searches reach them
+    through ``ontology_closure`` instead, see :func:`ontology_closure`.
+
+    Args:
+        title (str): The title of the paper.
+        abstract (Optional[str]): The abstract of the paper.
+        date (str): The date of the paper in XML datetime format.
+        extracted (Optional[Dict[str, Sequence[str]]]): The keywords
+            of texts that have already been extracted, by text, as
+            returned by :func:`cached_keywords`. The title and abstract
+            are only extracted if they aren't here, and are then added.
+
+    Returns:
+        (Dict[str, float]): The weight the paper adds to each of its
+        keywords, summed over each time the keyword occurs.
+
+    """
+    occurrences = paper_occurrences(title, abstract, extracted)
+    return {word: n * weighting(word, tuple(occurrences), date)
+            for word, n in occurrences.items()}
+
+def cached_paper_occurrences(title, abstract):
+    """Like :func:`paper_occurrences`, but uses the extraction cache.
+
+    Texts that aren't cached yet are added to it, in the current
+    transaction.
+
+    """
+    cached = cached_keywords([title, abstract])
+    extracted = dict(cached)
+    occurrences = paper_occurrences(title, abstract, extracted)
+    cache_keywords({t: k for t, k in extracted.items() if t not in cached})
+    return occurrences
+
+def extraction_key(text):
+    """The key of a text in the extraction cache.
+
+    Runs of whitespace don't change the keywords of a text, so they
+    don't change its key either.
+
+    """
+    text = ' '.join(text.split())
+    return hashlib.md5((PIPELINE_VERSION + text).encode('utf-8')).hexdigest()
+
+def cached_keywords(texts):
+    """Looks up the keywords of some texts in the extraction cache.
+
+    Args:
+        texts (Iterable[Optional[str]]): The texts. ``None`` is ignored.
+
+    Returns:
+        (Dict[str, Tuple[str]]): The keywords of each text that was
+        cached, by text.
+
+    """
+    keys = {extraction_key(t): t for t in texts if t is not None}
+    return {keys[key]: keywords
+            for key, keywords in db.get_extractions(keys).items()}
+
+def cache_keywords(extracted, bind=None):
+    """Adds the keywords of some texts to the extraction cache.
+
+    Args:
+        extracted (Dict[str, Sequence[str]]): The keywords of each
+            text, by text.
+        bind: See :func:`oblong.database.add_extractions`.
+
+    """
+    db.add_extractions({extraction_key(t): k for t, k in extracted.items()},
+                       PIPELINE_VERSION, bind)
+
+@lru_cache(maxsize=None)
+def ontology_closure():
+    """The rows of ``ontology_closure`` for the ACM ontology.
+
+    Each concept's ancestors get the fraction of its weight given by
+    :func:`distance_weighting`, relative to the concept itself.
+
+    Returns:
+        (List[dict]): The rows, see :class:`oblong.database.OntologyClosure`.
+
+    """
+    depths = {}
+    for concept, ancestor, depth in onto.closure():
+        # longer labels could never match a keyword's name
+        if len(concept) > 64:
+            continue
+        # concepts that share a label share their ancestors
+        ancestor = ancestor.lower()
+        if depths.get((concept, ancestor), depth) >= depth:
+            depths[concept, ancestor] = depth
+    return [{ 'concept': concept
+            , 'ancestor': ancestor
+            , 'depth': depth
+            , 'weight': distance_weighting(depth) / distance_weighting(0)
+            } for (concept, ancestor), depth in sorted(depths.items())]
+
+def load_ontology_closure(bind=None):
+    """Fills ``ontology_closure`` from the ACM ontology.
+
+    Args:
+        bind: The connection to use. Defaults to the session, which
+            the caller must commit.
+
+    """
+    db.replace_ontology_closure(ontology_closure(), bind)
 
 def add_user_keywords(words, uid):
     """Adds a list of user-provided keywords to a profile.
@@ -114,18 +727,145 @@ def add_user_keywords(words, uid):
         words (list[str]): the keywords to add
         uid (int): id of the user whose profile we want to update
     """
-    profile = db.Profile.get(uid)
-    for word in words:
-        profile.keywords[word] = 100.0
-
+    USER_WEIGHT = 100.0
+    ids = db.keyword_ids(words)
+    db.lock_profile(uid)
+    db.add_keyword_weights(uid, {i: USER_WEIGHT for i in ids.values()},
+                           replace=True)
     db.session.commit()
+    db.profiles_changed([uid])
 
 def remove_user_keywords(words, uid):
-    profile = db.Profile.get(uid)
-    for word in words:
-        if word in profile.keywords:
-            del profile.keywords[word]
+    db.lock_profile(uid)
+    db.remove_keywords(uid, words)
     db.session.commit()
+    db.profiles_changed([uid])
+
+#: What :func:`purge_keywords` or :func:`sweep_keywords` removed:
+#: the number of keywords and (profile, keyword) weights, the number of
+#: profiles that changed, and the time it took in seconds.
+PurgeReport = namedtuple('PurgeReport', 'keywords weights profiles seconds')
+
+def purge_keywords(names=(), pattern=None):
+    """Removes garbage keywords from every profile.
+
+    See :func:`oblong.database.purge_keywords`.
+
+    Args:
+        names (Iterable[str]): The keywords to remove.
+        pattern (Optional[str]): A ``LIKE`` pattern of more keywords to
+            remove.
+
+    Returns:
+        (PurgeReport): What was removed.
+
+    """
+    start = time.perf_counter()
+    deleted, uids, weights = db.purge_keywords(names, pattern)
+    db.session.commit()
+    terms_changed([('discard', (name,)) for name in deleted])
+    db.profiles_changed(uids)
+    report = PurgeReport(len(deleted), weights, len(uids),
+                         time.perf_counter() - start)
+    log.info('purged %d keywords and %d weights from %d profiles in %.3fs',
+             *report)
+    return report
+
+def sweep_keywords(batch_size=1000):
+    """Removes every keyword that no profile has.
+
+    Keywords are removed ``batch_size`` at a time, each batch in its
+    own transaction, so that rows are never locked for long. See
+    :func:`oblong.database.sweep_orphan_keywords`.
+
+    Returns:
+        (PurgeReport): What was removed.
+
+    """
+    start = time.perf_counter()
+    removed = 0
+    while True:
+        deleted = db.sweep_orphan_keywords(batch_size)
+        db.session.commit()
+        terms_changed([('discard', (name,)) for name in deleted])
+        removed += len(deleted)
+        if len(deleted) < batch_size:
+            break
+    report = PurgeReport(removed, 0, 0, time.perf_counter() - start)
+    if removed:
+        log.info('swept %d orphaned keywords in %.3fs', removed,
+                 report.seconds)
+    return report
+
+class KeywordSweeper:
+    """Periodically removes keywords that no profile has.
+
+    Keywords are left behind whenever the last profile with them
+    loses them, such as by :func:`remove_user_keywords` or a rebuild.
+    This runs :func:`sweep_keywords` every ``interval`` seconds in a
+    background thread.
+
+    Args:
+        interval (float): The number of seconds between sweeps.
+        batch_size (int): See :func:`sweep_keywords`.
+
+    """
+    def __init__(self, interval=3600., batch_size=1000):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.last = None
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Starts sweeping in the background."""
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name='keyword-sweeper')
+        self._thread.start()
+
+    def stop(self):
+        """Stops sweeping, waiting for any sweep in progress."""
+        if self._thread is None:
+            return
+        self._stopped.set()
+        self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.last = sweep_keywords(self.batch_size)
+            except Exception:
+                db.session.rollback()
+                log.exception('failed to sweep keywords')
+        db.session.remove()
+
+#: The running :class:`KeywordSweeper`, if any.
+keyword_sweeper = None
+
+def enable_keyword_sweeper(**kwargs):
+    """Starts sweeping orphaned keywords, see :class:`KeywordSweeper`.
+
+    Args:
+        **kwargs: Passed to :class:`KeywordSweeper`.
+
+    Returns:
+        (KeywordSweeper): The sweeper, already started.
+
+    """
+    global keyword_sweeper
+    disable_keyword_sweeper()
+    keyword_sweeper = KeywordSweeper(**kwargs)
+    keyword_sweeper.start()
+    return keyword_sweeper
+
+def disable_keyword_sweeper():
+    """Stops any keyword sweeper."""
+    global keyword_sweeper
+    if keyword_sweeper is not None:
+        keyword_sweeper.stop()
+        keyword_sweeper = None
 
 def get_keywords(text):
     """Gets the keywords from a text excerpt.
@@ -144,24 +884,7 @@ def get_keywords(text):
     # tag words as verb, noun etc
     tagged_words = pos_tag(tokens)
 
-    # retrieve list of boring words from file
-    stopwords_file = os.path.join(BASE_DIR, 'data', 'stopwords.txt')
-    with open(stopwords_file, 'r', encoding='utf-8') as f:
-        stopwords = [line.rstrip(linesep) for line in f]
-    
-    #We don't want keywords to contain anything in this list
-    forbidden = ['.',',',';',':','?','!','+',')','(','[',']','/','<','>','"','©','1','2','3','4','5','6','7','8','9','0']
-
-    # NLTK Chunking - detects noun phrases and phrases of form verb noun or adj noun
-    patterns = """NP: {<JJ>*<NN><NNS>}
-                      {<JJR><NNS>}
-                      {<JJ>*<NNS>}
-                      {<NN><NNS>} 
-                      {<JJ><NNS>}
-                      {<JJ>*<NN>*}
-                      {<NN>*}
-                      {<NNS>*}"""
-    chunker = RegexpParser(patterns)
+    chunker = RegexpParser(CHUNK_GRAMMAR)
     chunks = chunker.parse(tagged_words)
 
     #these are the phrases we want, as lists within a list
@@ -177,32 +900,133 @@ def get_keywords(text):
     for sublist in validphrases:
         lemmatizables.append(' '.join(sublist))
 
-    lemmatizer = WordNetLemmatizer()
     lems = [lemmatizer.lemmatize(x) for x in lemmatizables]
 
     #removing stopwords after lemmatizinga, then removing anything containing punctuation or a number
+    stopwords = _stopwords()
     lems = filter(lambda lem: lem not in stopwords, lems)
-    lems = filter(lambda lem: not any(char in lem for char in forbidden), lems)
+    lems = filter(lambda lem: not any(char in lem for char in FORBIDDEN), lems)
 
     return tuple(lems)
 
+@lru_cache(maxsize=None)
+def _stopwords():
+    """The boring words, read from :data:`STOPWORDS_FILE`."""
+    with open(STOPWORDS_FILE, 'r', encoding='utf-8') as f:
+        return frozenset(line.rstrip(linesep) for line in f)
+
+class LinearDecay:
+    """Weights a paper by its age, falling linearly to a floor.
+
+    Args:
+        start (float): The weighting of a paper from this year.
+        slope (float): How much the weighting falls each year.
+        cutoff (int): The age, in years, after which every paper is
+            given ``floor``.
+        floor (float): The lowest possible weighting.
+
+    """
+    def __init__(self, start=5., slope=.09, cutoff=50, floor=.5):
+        self.start = start
+        self.slope = slope
+        self.cutoff = cutoff
+        self.floor = floor
+
+    def __call__(self, age):
+        return self.start - self.slope * age if age <= self.cutoff \
+               else self.floor
+
+    def sql(self, age):
+        """The same weighting, of a SQL expression of the age."""
+        return case([(age <= self.cutoff, self.start - self.slope * age)],
+                    else_=self.floor)
+
+class ExponentialDecay:
+    """Weights a paper by its age, halving every ``half_life`` years.
+
+    Args:
+        half_life (float): The number of years to halve the weighting.
+        start (float): The weighting of a paper from this year.
+        floor (float): The lowest possible weighting.
+
+    """
+    def __init__(self, half_life, start=5., floor=.5):
+        self.half_life = half_life
+        self.start = start
+        self.floor = floor
+
+    def __call__(self, age):
+        return max(self.start * .5 ** (age / self.half_life), self.floor)
+
+    def sql(self, age):
+        """The same weighting, of a SQL expression of the age."""
+        return func.greatest(self.start * func.power(
+                .5, cast(age, Float) / self.half_life), self.floor)
+
+#: How the weighting of a paper falls with its age. Anything with the
+#: methods of :class:`LinearDecay` can be used. After changing this,
+#: run :func:`age_profiles` to reweigh the papers already stored.
+TIME_DECAY = LinearDecay()
+
+def current_year():
+    """The current year, in UTC."""
+    return gmtime()[0]
+
+def occurrence_weight(year):
+    """The weighting of each keyword of a paper published in ``year``."""
+    return TIME_DECAY(current_year() - year) + distance_weighting(0)
+
+def decayed_weight():
+    """The weight of one occurrence of a keyword, this year.
+
+    Returns:
+        (Callable[[ColumnElement], ColumnElement]): Gives the weight as
+        a SQL expression of the year of the paper, by
+        :data:`TIME_DECAY` of its age, as :func:`occurrence_weight`
+        does. See :func:`oblong.database.reweigh_profiles`.
+
+    """
+    year = current_year()
+    base = distance_weighting(0)
+    return lambda published: TIME_DECAY.sql(year - published) + base
+
+def age_profiles():
+    """Reweighs every profile's keywords for the current year.
+
+    Keyword weights depend on the age of the papers they came from, and
+    are only computed when the papers are added, so they slowly go out
+    of date. This brings them up to date, and applies any change to
+    :data:`TIME_DECAY`, with a single ``UPDATE`` from the recorded
+    contributions of each paper; nothing is extracted again, and the
+    in-memory indexes of every process are reloaded. It should be run
+    periodically, such as once a day. See
+    :func:`oblong.database.reweigh_profiles`.
+
+    Profiles, or papers, added before contributions were recorded must
+    be rebuilt once first, see :func:`oblong.rebuild.rebuild_profiles`.
+
+    Returns:
+        (int): The number of weights updated.
+
+    """
+    updated = db.reweigh_profiles(decayed_weight(), 100)
+    db.session.commit()
+    db.reset_indexes()
+    return updated
+
 def weighting(word, words, date, distance=0):
     """Weights the importance of a keyword.
 
-    The functions used currently are linear deprecation up to a time gap
-    of fifty years and ontology distance of ten layers.
+    The functions used currently are :data:`TIME_DECAY` of the age of
+    the paper and linear deprecation up to an ontology distance of ten
+    layers.
 
     Parameters:
         FUNC_D (Callable[[int], Number]): Function to produce a weighting
             given time diff in years.
-        CUTOFF_D (int): lowest time diff after which the lowest weighting
-            will be given.
-        BASE_D (Number): the lowest possible weighting (time diff).
         FUNC_DS (Callable[[int], Number]): Function to produce a weighting
-            given distance in levels of the ontology.
-        CUTOFF_DS (int): lowest distance after which the lowest weighting
-            will be given.
-        BASE_DS (Number): the lowest possible weighting (distance).
+            given distance in levels of the ontology, see
+            :func:`distance_weighting`.
 
     Args:
         word (str): The word to weight.
@@ -215,15 +1039,28 @@ def weighting(word, words, date, distance=0):
         the word is.
 
     """
-    CUTOFF_D = 50
-    BASE_D = .5
-    def FUNC_D(d): return -.09 * d + 5 if d <= CUTOFF_D else BASE_D
+    FUNC_D = TIME_DECAY
 
-    CUTOFF_DS = 10
-    BASE_DS = .5
-    def FUNC_DS(d): return -.45 * d + 5 if d <= CUTOFF_DS else BASE_DS
+    FUNC_DS = distance_weighting
 
     year = int(date[:4])
-    current_year = gmtime()[0]
-    time_diff = current_year - year
+    time_diff = current_year() - year
     return FUNC_D(time_diff) + FUNC_DS(distance)
+
+def distance_weighting(distance):
+    """Weights a concept by its distance from a keyword in the ontology.
+
+    The weighting falls linearly up to a distance of ten levels.
+
+    Parameters:
+        CUTOFF_DS (int): lowest distance after which the lowest weighting
+            will be given.
+        BASE_DS (Number): the lowest possible weighting (distance).
+
+    Args:
+        distance (int): The number of levels between them.
+
+    """
+    CUTOFF_DS = 10
+    BASE_DS = .5
+    return -.45 * distance + 5 if distance <= CUTOFF_DS else BASE_DS
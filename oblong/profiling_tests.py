@@ -1,5 +1,11 @@
+import os
+import tempfile
+import threading
+import time
 import unittest
-from . import profiling, database as db
+from unittest import mock
+from sqlalchemy import literal, select
+from . import postings, profiling, rebuild, database as db
 from .database_tests import DatabaseTestCase
 
 class GetKeywordsTests(unittest.TestCase):
@@ -39,8 +45,490 @@ class UpdateProfilesTestCase(DatabaseTestCase):
 
         self.assertEquals(self.john.keywords["porcupine"], 100)
 
+    def testOnlyLeafKeywordsStored(self):
+        authors = [self.profileToJSON(self.john)]
+        profiling.update_authors_profiles("graph theory", None, authors,
+                                          "2016-01-01")
+
+        self.assertEqual(list(self.john.keywords), ["graph theory"])
+        self.assertIsNone(db.Keyword.query
+                          .filter_by(name="Discrete mathematics")
+                          .one_or_none())
+
+class ExtractionCacheTestCase(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.john = db.Profile(title="Mr", firstname="John", lastname="Smith")
+        db.session.add(self.john)
+        db.session.commit()
+        self.authors = [UpdateProfilesTestCase.profileToJSON(self.john)]
+
+    def submit(self, title, abstract=None):
+        profiling.update_authors_profiles(title, abstract, self.authors,
+                                          "2016-01-01")
+
+    def testResubmissionSkipsExtraction(self):
+        self.submit("porcupine, fluctuations", "Of wild horses.")
+        self.assertEqual(db.KeywordExtraction.query.count(), 2)
+
+        with mock.patch.object(profiling, 'get_keywords') as get_keywords:
+            self.submit("porcupine,  fluctuations\n", "Of wild horses.")
+        get_keywords.assert_not_called()
+        self.assertEqual(self.john.keywords["porcupine"], 100)
+
+    def testNewTextExtracted(self):
+        self.submit("porcupine, fluctuations")
+        with mock.patch.object(profiling, 'get_keywords',
+                               wraps=profiling.get_keywords) as get_keywords:
+            self.submit("porcupine, fluctuations", "Of wild horses.")
+        get_keywords.assert_called_once_with("Of wild horses.")
+
+    def testPipelineVersion(self):
+        key = profiling.extraction_key("porcupine")
+        self.assertEqual(profiling.extraction_key(" porcupine\t"), key)
+        with mock.patch.object(profiling, 'PIPELINE_VERSION', 'changed'):
+            self.assertNotEqual(profiling.extraction_key("porcupine"), key)
+
+        with mock.patch.object(profiling, 'EXTRACTION_VERSION', 2):
+            self.assertNotEqual(profiling._pipeline_version(),
+                                profiling.PIPELINE_VERSION)
+        with mock.patch.object(profiling, 'CHUNK_GRAMMAR', 'NP: {<NN>}'):
+            self.assertNotEqual(profiling._pipeline_version(),
+                                profiling.PIPELINE_VERSION)
+
+class WriteBehindTestCase(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.john = db.Profile(title="Mr", firstname="John", lastname="Smith")
+        db.session.add(self.john)
+        db.session.commit()
+        self.authors = [UpdateProfilesTestCase.profileToJSON(self.john)]
+        self.tmp = tempfile.TemporaryDirectory()
+        self.journal = os.path.join(self.tmp.name, 'weights.journal')
+
+    def tearDown(self):
+        profiling.disable_write_behind()
+        self.tmp.cleanup()
+        super().tearDown()
+
+    def submit(self, title):
+        profiling.update_authors_profiles(title, None, self.authors,
+                                          "2016-01-01")
+
+    def keywords(self):
+        db.session.expire_all()
+        return dict(db.Profile.get(self.john.id).keywords)
+
+    def testBuffered(self):
+        buffer = profiling.enable_write_behind(max_delay=3600)
+        self.submit("porcupine, fluctuations")
+        self.submit("porcupine, gravitational waves")
+
+        self.assertEqual(self.keywords(), {})
+        self.assertEqual(len(db.Profile.get(self.john.id).publications), 2)
+        self.assertEqual(len(buffer), 3)
+
+        buffer.flush()
+        keywords = self.keywords()
+        self.assertEqual(set(keywords),
+                         {"porcupine", "fluctuation", "gravitational waves"})
+        self.assertEqual(keywords["porcupine"], 100)
+        self.assertEqual(len(buffer), 0)
+
+    def testFlushWhenFull(self):
+        profiling.enable_write_behind(max_deltas=1, max_delay=3600)
+        self.submit("porcupine, fluctuations")
+        for _ in range(50):
+            if self.keywords():
+                break
+            time.sleep(.1)
+        self.assertEqual(self.keywords()["porcupine"], 100)
+
+    def testFlushOnStop(self):
+        profiling.enable_write_behind(max_delay=3600)
+        self.submit("porcupine, fluctuations")
+        profiling.disable_write_behind()
+        self.assertEqual(self.keywords()["porcupine"], 100)
+
+    def testFailedFlushRetried(self):
+        buffer = profiling.enable_write_behind(max_delay=3600)
+        self.submit("porcupine, fluctuations")
+        with mock.patch.object(db, 'add_weight_deltas',
+                               side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                buffer.flush()
+        self.assertEqual(len(buffer), 2)
+        buffer.flush()
+        self.assertEqual(self.keywords()["porcupine"], 100)
+
+    def testSweptKeywords(self):
+        # nothing in the database uses the keywords until a flush
+        buffer = profiling.enable_write_behind(max_delay=3600)
+        self.submit("porcupine, fluctuations")
+        db.purge_keywords(["porcupine"])
+        db.sweep_orphan_keywords()
+        db.session.commit()
+        self.assertEqual(db.Keyword.query.count(), 0)
+        buffer.flush()
+        self.assertEqual(set(self.keywords()), {"porcupine", "fluctuation"})
+
+    def testDeletedProfileDropped(self):
+        jane = db.Profile(title="Ms", firstname="Jane", lastname="Doe")
+        db.session.add(jane)
+        db.session.commit()
+        self.authors.append(UpdateProfilesTestCase.profileToJSON(jane))
+        buffer = profiling.enable_write_behind(max_delay=3600)
+        self.submit("porcupine, fluctuations")
+        db.session.execute(db.profile_publication_association.delete()
+                          .where(db.profile_publication_association.c
+                                 .profile_id == jane.id))
+        db.session.delete(jane)
+        db.session.commit()
+        with self.assertLogs(profiling.log, 'ERROR'):
+            buffer.flush()
+        self.assertEqual(len(buffer), 0)
+        self.assertEqual(self.keywords()["porcupine"], 100)
+
+    def testJournal(self):
+        buffer = profiling.enable_write_behind(max_delay=3600,
+                                               journal=self.journal)
+        self.submit("porcupine, fluctuations")
+        self.assertGreater(os.path.getsize(self.journal), 0)
+        buffer.flush()
+        self.assertEqual(os.path.getsize(self.journal), 0)
+
+    def testJournalReplayed(self):
+        # left by a process that died before flushing
+        with open(self.journal, 'w') as f:
+            f.write('[[{0}], [["porcupine", 1.0], ["horse", 3.0]], '
+                    '[["porcupine", 2016, 1], ["horse", 2016, 3]]]\n'
+                    '[[{0}], [["porcupine", 3.0]], [["porcupine", 2016, 3]]]\n'
+                    .format(self.john.id))
+
+        profiling.enable_write_behind(max_delay=3600, journal=self.journal)
+
+        self.assertEqual(self.keywords(), {"porcupine": 100, "horse": 75})
+        self.assertEqual(os.path.getsize(self.journal), 0)
+
+class TimeDecayTestCase(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.john = db.Profile(title="Mr", firstname="John", lastname="Smith")
+        db.session.add(self.john)
+        db.session.commit()
+        authors = [UpdateProfilesTestCase.profileToJSON(self.john)]
+        profiling.update_authors_profiles("porcupine, fluctuations", None,
+                                          authors, "2016-01-01")
+        profiling.update_authors_profiles("porcupine, gravitational waves",
+                                          None, authors, "2015-01-01")
+
+    def tearDown(self):
+        profiling.TIME_DECAY = profiling.LinearDecay()
+        super().tearDown()
+
+    def keywords(self):
+        db.session.expire_all()
+        return dict(db.Profile.get(self.john.id).keywords)
+
+    def contributions(self):
+        q = (db.session.query(db.Keyword.name, db.KeywordContribution.year,
+                              db.KeywordContribution.occurrences)
+            .join(db.KeywordContribution,
+                  db.KeywordContribution.keyword_id == db.Keyword.id))
+        return {(name, year): n for name, year, n in q}
+
+    def assertAged(self, year):
+        with mock.patch.object(profiling, 'current_year', return_value=year):
+            profiling.age_profiles()
+            expected = rebuild._scaled({self.john.id: self.contributions()})
+        keywords = self.keywords()
+        self.assertEqual(set(keywords), set(expected[self.john.id]))
+        for word, weight in expected[self.john.id].items():
+            self.assertAlmostEqual(keywords[word], weight)
+        return keywords
+
+    def testIngestedAsRebuilt(self):
+        ingested = self.keywords()
+        rebuild.rebuild_profiles(workers=1)
+        rebuilt = self.keywords()
+        self.assertEqual(set(ingested), set(rebuilt))
+        for word, weight in rebuilt.items():
+            self.assertAlmostEqual(ingested[word], weight)
+
+    def testIngestedThenAgedAsRebuilt(self):
+        aged = self.assertAged(2030)
+        with mock.patch.object(profiling, 'current_year', return_value=2030):
+            rebuild.rebuild_profiles(workers=1)
+        rebuilt = self.keywords()
+        for word, weight in rebuilt.items():
+            self.assertAlmostEqual(aged[word], weight)
+
+    def testContributionsRecorded(self):
+        self.assertEqual(self.contributions(),
+                         { ("porcupine", 2016): 1
+                         , ("fluctuation", 2016): 1
+                         , ("porcupine", 2015): 1
+                         , ("gravitational waves", 2015): 1
+                         })
+
+    def testAgeProfiles(self):
+        keywords = self.assertAged(2017)
+        self.assertEqual(keywords["porcupine"], 100)
+        self.assertGreater(keywords["fluctuation"],
+                           keywords["gravitational waves"])
+        later = self.assertAged(2060)
+        self.assertNotEqual(later["fluctuation"], keywords["fluctuation"])
+
+    def testAgedProfilesSearched(self):
+        postings.profiles.reset()
+        self.addCleanup(postings.profiles.reset)
+        postings.profiles.search("fluctuation", 0, 10)
+        keywords = self.assertAged(2060)
+        self.assertEqual(postings.profiles.search("fluctuation", 0, 10),
+                         (1, [(self.john.id, keywords["fluctuation"])]))
+
+    def testConfigurableDecay(self):
+        profiling.TIME_DECAY = profiling.ExponentialDecay(half_life=2)
+        keywords = self.assertAged(2017)
+        self.assertGreater(keywords["fluctuation"],
+                           keywords["gravitational waves"])
+
+    def testDecayInSQL(self):
+        for decay in (profiling.LinearDecay(), profiling.ExponentialDecay(10)):
+            for age in (-1, 0, 7, 50, 51, 120):
+                self.assertAlmostEqual(
+                        db.session.execute(select([decay.sql(literal(age))]))
+                                  .scalar(),
+                        decay(age))
+
+    def testKeywordsChangedByHand(self):
+        profiling.add_user_keywords(["horse"], self.john.id)
+        profiling.remove_user_keywords(["fluctuation"], self.john.id)
+        profiling.age_profiles()
+        keywords = self.keywords()
+        self.assertEqual(keywords["horse"], 100)
+        self.assertNotIn("fluctuation", keywords)
+        self.assertNotIn(("fluctuation", 2016), self.contributions())
+
+class PurgeKeywordsTestCase(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.john = db.Profile(title="Mr", firstname="John", lastname="Smith")
+        self.jane = db.Profile(title="Ms", firstname="Jane", lastname="Doe")
+        db.session.add_all([self.john, self.jane])
+        db.session.commit()
+        ids = db.keyword_ids(["horse", "http www", "http ftp", "porcupine",
+                              "orphan"])
+        db.add_keyword_weights(self.john.id, {ids["horse"]: 100,
+                                              ids["http www"]: 10,
+                                              ids["porcupine"]: 50})
+        db.add_keyword_weights(self.jane.id, {ids["http ftp"]: 100,
+                                              ids["porcupine"]: 20})
+        db.session.commit()
+
+    def tearDown(self):
+        profiling.disable_keyword_sweeper()
+        super().tearDown()
+
+    def keywords(self):
+        db.session.expire_all()
+        return {p.lastname: dict(p.keywords) for p in db.Profile.query}
+
+    def testPurge(self):
+        report = profiling.purge_keywords(["porcupine", "unknown"],
+                                          pattern="http %")
+
+        self.assertEqual(report[:3], (3, 4, 2))
+        self.assertEqual(self.keywords(), {"Smith": {"horse": 100},
+                                           "Doe": {}})
+        self.assertEqual(sorted(k.name for k in db.Keyword.query),
+                         ["horse", "orphan"])
+
+    def testPurgeNothing(self):
+        self.assertEqual(profiling.purge_keywords()[:3], (0, 0, 0))
+        self.assertEqual(db.Keyword.query.count(), 5)
+
+    def testSweep(self):
+        profiling.remove_user_keywords(["http www"], self.john.id)
+
+        report = profiling.sweep_keywords(batch_size=1)
+
+        self.assertEqual(report.keywords, 2)
+        self.assertEqual(sorted(k.name for k in db.Keyword.query),
+                         ["horse", "http ftp", "porcupine"])
+
+    def testSweepSkipsKeywordsInUse(self):
+        # a paper that has looked up the keyword, but not yet added it
+        # to a profile
+        with db.engine.connect() as other:
+            with other.begin():
+                other.execute("SELECT id FROM keyword WHERE name = 'orphan' "
+                              "FOR KEY SHARE")
+                self.assertEqual(profiling.sweep_keywords().keywords, 0)
+        self.assertEqual(profiling.sweep_keywords().keywords, 1)
+
+    def testSweeper(self):
+        sweeper = profiling.enable_keyword_sweeper(interval=.05)
+        for _ in range(50):
+            if sweeper.last is not None:
+                break
+            time.sleep(.05)
+        self.assertEqual(sweeper.last.keywords, 1)
+        self.assertIsNone(db.Keyword.query.filter_by(name="orphan")
+                          .one_or_none())
+
+class OntologyClosureTests(unittest.TestCase):
+    def test_weights_fall_with_depth(self):
+        rows = [r for r in profiling.ontology_closure()
+                if r['concept'] == 'trees']
+        self.assertEqual( [(r['ancestor'], r['depth']) for r in
+                           sorted(rows, key=lambda r: r['depth'])]
+                        , [ ('graph theory', 1)
+                          , ('discrete mathematics', 2)
+                          , ('mathematics of computing', 3)
+                          ]
+                        )
+        weights = [r['weight'] for r in sorted(rows, key=lambda r: r['depth'])]
+        self.assertEqual(weights, sorted(weights, reverse=True))
+        self.assertLess(weights[0], 1)
+
         
 
 
          
         
+
+class ConcurrentUpdateTestCase(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.john = db.Profile(title="Mr", firstname="John", lastname="Smith")
+        db.session.add(self.john)
+        db.session.commit()
+
+    def testConcurrentPapers(self):
+        authors = [UpdateProfilesTestCase.profileToJSON(self.john)]
+        titles = ["porcupine, fluctuations", "porcupine, gravitational waves",
+                  "porcupine, wild horses", "porcupine, tame horses"]
+        expected = set()
+        for title in titles:
+            expected |= set(profiling.paper_keywords(title, None, "2016-01-01"))
+
+        errors = []
+        def submit(title):
+            try:
+                profiling.update_authors_profiles(title, None, authors,
+                                                  "2016-01-01")
+            except Exception as e:
+                errors.append(e)
+            finally:
+                db.session.remove()
+
+        threads = [threading.Thread(target=submit, args=(t,)) for t in titles]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(errors, [])
+        db.session.expire_all()
+        john = db.Profile.get(self.john.id)
+        self.assertEqual(set(john.keywords), expected)
+        self.assertEqual(john.keywords["porcupine"], 100)
+        self.assertEqual(len(john.publications), len(titles))
+
+class SingleFlightTests(unittest.TestCase):
+    def setUp(self):
+        self.flight = profiling.SingleFlight()
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.runs = 0
+
+    def slow(self, value):
+        self.runs += 1
+        self.started.set()
+        self.release.wait(5)
+        if isinstance(value, Exception):
+            raise value
+        return value
+
+    def concurrently(self, key, value, n=5):
+        results = []
+        def call():
+            try:
+                results.append(self.flight.do(key, self.slow, value))
+            except Exception as e:
+                results.append(e)
+        leader = threading.Thread(target=call)
+        leader.start()
+        self.started.wait(5)
+        followers = [threading.Thread(target=call) for _ in range(n - 1)]
+        for t in followers:
+            t.start()
+        # wait for the followers to join the leader's call
+        while self.flight.coalesced < n - 1:
+            time.sleep(.01)
+        self.release.set()
+        for t in [leader] + followers:
+            t.join()
+        return results
+
+    def test_coalesced(self):
+        self.assertEqual(self.concurrently('q', 42), [42] * 5)
+        self.assertEqual(self.runs, 1)
+        self.assertEqual((self.flight.calls, self.flight.coalesced), (5, 4))
+
+    def test_error_shared(self):
+        error = ValueError('bad query')
+        self.assertEqual(self.concurrently('q', error), [error] * 5)
+        self.assertEqual(self.runs, 1)
+
+    def test_private_error_repeated(self):
+        self.flight.private = lambda e: isinstance(e, TimeoutError)
+        error = TimeoutError('out of time')
+        self.assertEqual(self.concurrently('q', error), [error] * 5)
+        self.assertEqual(self.runs, 5)
+        self.assertEqual(self.flight.coalesced, 4)
+
+    def test_not_cached(self):
+        self.release.set()
+        self.assertEqual(self.flight.do('q', self.slow, 1), 1)
+        self.assertEqual(self.flight.do('q', self.slow, 2), 2)
+        self.assertEqual(self.runs, 2)
+        self.assertEqual(self.flight.coalesced, 0)
+
+class CoalescedSearchTestCase(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.john = db.Profile(title="Mr", firstname="John", lastname="Smith")
+        self.john.keywords['horse'] = 1.
+        db.session.add(self.john)
+        db.session.commit()
+
+    def testSearches(self):
+        self.assertEqual( profiling.fulfill_query_ids('horse', 0, 25)
+                        , (1, [self.john.id])
+                        )
+        self.assertEqual( profiling.fulfill_query('horse', 0, 25)
+                        , (1, (self.john,))
+                        )
+        self.assertEqual(profiling.fulfill_query('unicorn', 0, 25), (0, ()))
+
+    def testQueriesNormalised(self):
+        with mock.patch.object(profiling.searches, 'do',
+                               wraps=profiling.searches.do) as do:
+            profiling.fulfill_query_ids(' horse\t', 0, 25)
+            profiling.fulfill_query_ids('horse', 0, 25)
+            profiling.fulfill_query_ids('horse', 1, 25)
+        keys = [call[0][0] for call in do.call_args_list]
+        self.assertEqual(keys[0], keys[1])
+        self.assertNotEqual(keys[1], keys[2])
+
+    def testRoutingKept(self):
+        with mock.patch.object(profiling.searches, 'do',
+                               wraps=profiling.searches.do) as do:
+            profiling.fulfill_query_ids('horse', 0, 25)
+            db.use_replica()
+            profiling.fulfill_query_ids('horse', 0, 25)
+        keys = [call[0][0] for call in do.call_args_list]
+        self.assertNotEqual(keys[0], keys[1])
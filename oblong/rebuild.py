@@ -0,0 +1,298 @@
+"""Recomputes every profile from the publications in the database.
+
+Profiles are built up one paper at a time as papers are submitted, so
+changing how keywords are extracted or weighted (the stopword list,
+the chunk grammar, :func:`oblong.profiling.weighting`, the ontology)
+leaves every stored profile out of date. :func:`rebuild_profiles`
+reprocesses every publication and replaces the keywords of each of
+its authors.
+
+Publications are streamed from a server-side cursor in batches, and
+the keywords of each batch are extracted by a pool of worker
+processes, unless they are in the extraction cache already. Stale
+extractions, from before the pipeline last changed, are removed from
+the cache first. The occurrences of each profile's keywords in each
+year are accumulated in memory, and only weighed and written back,
+with a handful of bulk statements, once every publication has been
+processed. They are written too, as the profile's keyword
+contributions, see :func:`oblong.profiling.age_profiles`. Meanwhile, progress is periodically
+saved to a checkpoint file, so an interrupted rebuild can resume.
+
+Papers can still be submitted while a rebuild runs. Before writing, the
+rebuilt profiles are locked, as submitting a paper locks its authors,
+and the papers submitted since the publications were read are added
+in; a paper submitted after that waits for the rebuild to commit, and
+then adds to its weights.
+
+Keywords that were added to a profile by hand, rather than extracted
+from its publications, are not preserved. Profiles without any
+publications are left as they are.
+
+"""
+from collections import defaultdict, namedtuple
+from itertools import islice
+import logging
+import multiprocessing
+import os
+import pickle
+import time
+
+from sqlalchemy import func
+
+from . import database as db
+from . import profiling
+
+log = logging.getLogger(__name__)
+
+#: The outcome of a rebuild. ``added``, ``removed`` and ``changed``
+#: count the (profile, keyword) weights that differ from those stored.
+Report = namedtuple('Report', [ 'publications', 'profiles'
+                              , 'added', 'removed', 'changed'
+                              ])
+
+class Checkpoint:
+    """Saves the progress of a rebuild to a file.
+
+    Args:
+        path (Optional[str]): Where to keep the checkpoint. If this is
+            ``None``, progress is not saved.
+
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        """Loads the saved progress, if there is any.
+
+        Returns:
+            (int, Dict[int, Dict[Tuple[str, int], int]]): The id of the
+            last publication processed and the occurrences of each
+            profile's keywords accumulated so far, by keyword and year.
+
+        """
+        if self.path is None or not os.path.exists(self.path):
+            return 0, {}
+        with open(self.path, 'rb') as f:
+            state = pickle.load(f)
+        return state['last_id'], state['weights']
+
+    def save(self, last_id, weights):
+        if self.path is None:
+            return
+        tmp = self.path + '.tmp'
+        with open(tmp, 'wb') as f:
+            pickle.dump({'last_id': last_id, 'weights': weights}, f,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+
+    def clear(self):
+        if self.path is not None and os.path.exists(self.path):
+            os.remove(self.path)
+
+def _weigh(row, extracted):
+    """Extracts the keyword contributions of one publication.
+
+    Returns:
+        The authors of the publication, its year, the occurrences of its
+        keywords, and the keywords of its title and abstract, as in
+        :func:`oblong.profiling.paper_occurrences`.
+
+    """
+    _, title, abstract, date, authors = row
+    if date is None:
+        return authors, None, {}, extracted
+    occurrences = profiling.paper_occurrences(title, abstract, extracted)
+    return authors, date.year, occurrences, extracted
+
+def _extract(pool, batch, cache=True):
+    """Weighs a batch of publications, using the extraction cache.
+
+    Only texts that aren't cached are extracted by the workers, and
+    they are then added to the cache, if ``cache`` is true.
+
+    """
+    cached = profiling.cached_keywords(text for row in batch
+                                       for text in row[1:3])
+    tasks = [(row, {t: cached[t] for t in row[1:3] if t in cached})
+             for row in batch]
+    results = pool.starmap(_weigh, tasks)
+    if cache:
+        new = {t: k for _, _, _, extracted in results
+               for t, k in extracted.items() if t not in cached}
+        # the publications are streamed through the session, which can't
+        # commit until they have all been read
+        profiling.cache_keywords(new, bind=db.engine)
+    return [result[:3] for result in results]
+
+def _publications(after):
+    """Streams publications and their authors, in order of id."""
+    assoc = db.profile_publication_association
+    q = (db.session.query(db.Publication.id, db.Publication.title,
+                          db.Publication.abstract, db.Publication.date,
+                          func.array_agg(assoc.c.profile_id))
+        .join(assoc, assoc.c.publication_id == db.Publication.id)
+        .filter(db.Publication.id > after)
+        .group_by(db.Publication.id)
+        .order_by(db.Publication.id)
+        .execution_options(stream_results=True)
+        )
+    return iter(q.yield_per(1000))
+
+def _add(contributions, weighed, uids=None):
+    """Adds the occurrences of weighed publications to their authors.
+
+    Args:
+        contributions: The occurrences of each profile's keywords, by
+            keyword and year, as accumulated so far.
+        weighed: The results of :func:`_extract`.
+        uids (Optional[Set[int]]): Only these authors, if given.
+
+    """
+    for authors, year, occurrences in weighed:
+        for uid in authors:
+            if uids is not None and uid not in uids:
+                continue
+            for word, n in occurrences.items():
+                contributions[uid][word, year] += n
+
+def _chunks(iterable, size):
+    iterator = iter(iterable)
+    chunk = list(islice(iterator, size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(iterator, size))
+
+def _storable(contributions):
+    """Drops the contributions of keywords too long to store."""
+    max_length = db.Keyword.name.type.length
+    return {uid: {(k, year): n for (k, year), n in keywords.items()
+                  if len(k) <= max_length}
+            for uid, keywords in contributions.items()}
+
+def _scaled(contributions):
+    """Weighs each profile's contributions and scales them to 100."""
+    weight = {}
+    scaled = {}
+    for uid, keywords in contributions.items():
+        weights = defaultdict(float)
+        for (k, year), n in keywords.items():
+            if year not in weight:
+                weight[year] = profiling.occurrence_weight(year)
+            weights[k] += n * weight[year]
+        m = max(weights.values(), default=0) or 1
+        scaled[uid] = {k: w * 100 / m for k, w in weights.items()}
+    return scaled
+
+def _stored(uids):
+    """Loads the stored weights of some profiles."""
+    assoc = db.ProfileKeywordAssociation
+    stored = defaultdict(dict)
+    for chunk in _chunks(uids, 1000):
+        q = (db.session.query(assoc.left_id, db.Keyword.name, assoc.weight)
+            .join(db.Keyword, db.Keyword.id == assoc.right_id)
+            .filter(assoc.left_id.in_(chunk))
+            )
+        for uid, name, weight in q:
+            stored[uid][name] = weight
+    return stored
+
+def _diff(weights):
+    """Counts the weights that a rebuild would add, remove or change."""
+    stored = _stored(list(weights))
+    added = removed = changed = 0
+    for uid, new in weights.items():
+        old = stored.get(uid, {})
+        added += len(new.keys() - old.keys())
+        removed += len(old.keys() - new.keys())
+        changed += sum(1 for k in new.keys() & old.keys()
+                       if abs(new[k] - old[k]) > 1e-9)
+    return added, removed, changed
+
+def _write(weights, contributions):
+    """Replaces the keywords of the rebuilt profiles."""
+    table = db.ProfileKeywordAssociation.__table__
+    ids = db.keyword_ids(k for keywords in weights.values() for k in keywords)
+    for chunk in _chunks(weights, 1000):
+        db.session.execute(table.delete().where(table.c.left_id.in_(chunk)))
+    rows = ({'left_id': uid, 'right_id': ids[k], 'weight': w}
+            for uid, keywords in weights.items() for k, w in keywords.items())
+    for chunk in _chunks(rows, 1000):
+        db.session.execute(table.insert().values(chunk))
+    db.replace_contributions({uid: {(ids[k], year): n
+                                    for (k, year), n in keywords.items()}
+                              for uid, keywords in contributions.items()})
+    db.stale_summaries(weights)
+    db.session.commit()
+
+def rebuild_profiles(workers=None, batch_size=500, checkpoint=None,
+                     checkpoint_interval=60, dry_run=False):
+    """Recomputes the keywords of every author from their publications.
+
+    Args:
+        workers (Optional[int]): The number of worker processes used to
+            extract keywords. Defaults to the number of CPUs.
+        batch_size (int): The number of publications handed to the
+            workers at once.
+        checkpoint (Optional[str]): A file to save progress to. If it
+            already exists, the rebuild resumes from it. It is removed
+            once the rebuild is complete.
+        checkpoint_interval (float): The minimum number of seconds
+            between checkpoints.
+        dry_run (bool): If true, nothing is written to the database and
+            the report only says how much would change.
+
+    Returns:
+        (Report): What was, or would have been, changed.
+
+    """
+    if not dry_run:
+        pruned = db.prune_extractions(profiling.PIPELINE_VERSION)
+        db.session.commit()
+        if pruned:
+            log.info('Removed %d stale cached extractions', pruned)
+    checkpoint = Checkpoint(checkpoint)
+    last_id, contributions = checkpoint.load()
+    if last_id:
+        log.info('Resuming after publication %d', last_id)
+    contributions = defaultdict(lambda: defaultdict(int),
+                                {uid: defaultdict(int, kw)
+                                 for uid, kw in contributions.items()})
+
+    count = 0
+    start = saved = time.time()
+    with multiprocessing.Pool(workers) as pool:
+        for batch in _chunks(_publications(last_id), batch_size):
+            _add(contributions, _extract(pool, batch, cache=not dry_run))
+            count += len(batch)
+            last_id = batch[-1][0]
+            if time.time() - saved >= checkpoint_interval:
+                checkpoint.save(last_id, {uid: dict(kw) for uid, kw
+                                          in contributions.items()})
+                saved = time.time()
+            log.info('Processed %d publications (%.1f/s)', count,
+                     count / (time.time() - start))
+        if not dry_run:
+            # keywords before profiles, in the order submitting a paper
+            # locks them, so the two can't deadlock
+            db.keyword_ids(k for keywords in _storable(contributions).values()
+                           for k, _ in keywords)
+            rebuilt = set(contributions)
+            db.lock_profiles(rebuilt)
+            # only the rebuilt profiles; any others already have the
+            # weights of their new papers, and are left as they are
+            for batch in _chunks(_publications(last_id), batch_size):
+                _add(contributions, _extract(pool, batch), rebuilt)
+                count += len(batch)
+
+    contributions = _storable(contributions)
+    weights = _scaled(contributions)
+    added, removed, changed = _diff(weights)
+    report = Report(count, len(weights), added, removed, changed)
+    if not dry_run:
+        _write(weights, contributions)
+        db.profiles_changed(weights)
+    checkpoint.clear()
+    db.session.remove()
+    return report
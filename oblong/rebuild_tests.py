@@ -0,0 +1,130 @@
+import os
+import tempfile
+import threading
+from unittest import mock
+from . import rebuild, profiling, database as db
+from .database_tests import DatabaseTestCase
+
+class RebuildTestCase(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.author = { 'name': { 'title': 'Mr'
+                                , 'first': 'John'
+                                , 'last': 'Smith'
+                                , 'initials': None
+                                , 'alias': None
+                                }
+                      , 'email': None
+                      , 'faculty': 'Natural Sciences'
+                      , 'department': None
+                      , 'campus': None
+                      , 'building': None
+                      , 'room': None
+                      , 'website': None
+                      }
+        profiling.update_authors_profiles("porcupine, fluctuations", None,
+                                          [self.author], "2016-01-01")
+        profiling.update_authors_profiles("porcupine, gravitational waves",
+                                          None, [self.author], "2015-01-01")
+        self.john = db.Profile.query.one()
+        self.expected = rebuild._scaled(self.recompute())
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+        super().tearDown()
+
+    def recompute(self):
+        contributions = {}
+        for pub in db.Publication.query.order_by(db.Publication.id):
+            _, year, occurrences, _ = rebuild._weigh((pub.id, pub.title,
+                pub.abstract, pub.date, [self.john.id]), {})
+            for word, n in occurrences.items():
+                key = word, year
+                contributions[key] = contributions.get(key, 0) + n
+        return {self.john.id: contributions}
+
+    def stored(self):
+        db.session.expire_all()
+        return dict(db.Profile.get(self.john.id).keywords)
+
+    def testRebuild(self):
+        self.john.keywords['porcupine'] = 1.
+        self.john.keywords['stale'] = 1.
+        db.session.commit()
+
+        report = rebuild.rebuild_profiles(workers=1)
+
+        self.assertEqual(report.publications, 2)
+        self.assertEqual(report.profiles, 1)
+        self.assertEqual(report.removed, 1)
+        self.assertEqual(self.stored(), self.expected[self.john.id])
+        self.assertEqual(self.stored()['porcupine'], 100)
+        self.assertEqual(db.KeywordContribution.query.count(), 4)
+
+    def testPaperSubmittedDuring(self):
+        extract = rebuild._extract
+        submitted = []
+        def submit():
+            profiling.update_authors_profiles("porcupine, unicorns", None,
+                                              [self.author], "2016-01-01")
+            db.session.remove()
+        def extract_then_submit(pool, batch, cache=True):
+            # from another session, once the publications have been read
+            if not submitted:
+                submitted.append(threading.Thread(target=submit))
+                submitted[0].start()
+                submitted[0].join()
+            return extract(pool, batch, cache)
+
+        with mock.patch.object(rebuild, '_extract', extract_then_submit):
+            report = rebuild.rebuild_profiles(workers=1)
+
+        self.assertEqual(report.publications, 3)
+        self.assertEqual( self.stored()
+                        , rebuild._scaled(self.recompute())[self.john.id]
+                        )
+
+    def testDryRun(self):
+        rebuild.rebuild_profiles(workers=1)
+        self.john = db.Profile.query.one()
+        self.john.keywords['porcupine'] = 1.
+        self.john.keywords['stale'] = 1.
+        db.session.commit()
+        before = self.stored()
+
+        report = rebuild.rebuild_profiles(workers=1, dry_run=True)
+
+        self.assertEqual(report.added, 0)
+        self.assertEqual(report.removed, 1)
+        self.assertEqual(report.changed, 1)
+        self.assertEqual(self.stored(), before)
+
+    def testResume(self):
+        path = os.path.join(self.tmp.name, 'rebuild.ckpt')
+        first = db.Publication.query.order_by(db.Publication.id).first()
+        _, year, occurrences, _ = rebuild._weigh((first.id, first.title,
+            first.abstract, first.date, [self.john.id]), {})
+        rebuild.Checkpoint(path).save(first.id, {self.john.id: {
+                (word, year): n for word, n in occurrences.items()}})
+
+        report = rebuild.rebuild_profiles(workers=1, checkpoint=path)
+
+        self.assertEqual(report.publications, 1)
+        self.assertEqual(self.stored(), self.expected[self.john.id])
+        self.assertFalse(os.path.exists(path))
+
+    def testExtractionCache(self):
+        db.session.execute(db.KeywordExtraction.__table__.insert().values(
+                key='stale', version='old', keywords=['stale']))
+        db.session.commit()
+        rebuild.rebuild_profiles(workers=1)
+        self.assertIsNone(db.KeywordExtraction.query.get('stale'))
+
+        # the workers are forked with the patch, so would fail if they
+        # extracted anything
+        with mock.patch.object(profiling, 'get_keywords',
+                               side_effect=AssertionError):
+            report = rebuild.rebuild_profiles(workers=1)
+        self.assertEqual(report.publications, 2)
+        self.assertEqual(self.stored(), self.expected[self.john.id])
@@ -0,0 +1,141 @@
+"""Builds and encodes the JSON bodies of API responses.
+
+Every endpoint that lists people or publications builds the same
+entries for them, and each entry links to a profile or publication.
+Routing each link through :func:`flask.url_for` costs more than
+building the rest of the entry, so :class:`Links` routes each endpoint
+once, to a template, and formats the template for each link. Bodies
+are encoded with ``orjson`` if it is installed, and the standard
+library otherwise; either way :func:`dumps` returns bytes.
+
+Examples:
+    >>> from flask import Flask
+    >>> app = Flask(__name__)
+    >>> app.add_url_rule('/api/people/<int:uid>', 'profile')
+    >>> links = Links(app.url_map)
+    >>> links.profile(3)
+    '/api/people/3'
+    >>> dumps({'link': links.profile(3)})
+    b'{"link":"/api/people/3"}'
+
+"""
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def dumps(obj):
+    """Encodes a response body as JSON.
+
+    Returns:
+        (bytes): The UTF-8 encoded JSON.
+
+    """
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+#: Stands in for a link's argument while its template is built.
+_PLACEHOLDER = 918273645
+
+class Links:
+    """Builds links to profiles and publications.
+
+    Args:
+        url_map (werkzeug.routing.Map): The app's routes, which must
+            include the ``profile`` and ``publication`` endpoints by
+            the time a link is first built. Links are relative to the
+            root of the server.
+
+    """
+    def __init__(self, url_map):
+        self.url_map = url_map
+        self._templates = {}
+
+    def template(self, endpoint, argument):
+        """The template of the links to an endpoint with one argument.
+
+        Returns:
+            (Callable[[int], str]): Formats the link for an argument.
+
+        """
+        key = (endpoint, argument)
+        if key not in self._templates:
+            url = (self.url_map.bind('')
+                  .build(endpoint, {argument: _PLACEHOLDER}))
+            template = (url.replace('{', '{{').replace('}', '}}')
+                       .replace(str(_PLACEHOLDER), '{}'))
+            self._templates[key] = template.format
+        return self._templates[key]
+
+    def profile(self, uid):
+        """The link to a profile."""
+        return self.template('profile', 'uid')(uid)
+
+    def publication(self, uid):
+        """The link to a publication."""
+        return self.template('publication', 'uid')(uid)
+
+def summary(profile, links):
+    """The summary of a person shown in lists of people.
+
+    Args:
+        profile (oblong.database.SummaryRow): The person's summary,
+            from :func:`oblong.database.read_summaries`.
+        links (Links): Builds the link to the profile.
+
+    """
+    return { 'name': profile.name
+           , 'email': profile.email
+           , 'faculty': profile.faculty
+           , 'department': profile.department
+           , 'keywords': profile.top_keywords
+           , 'link': links.profile(profile.id)
+           }
+
+def summaries(profiles, links):
+    """Summarises several people, see :func:`summary`."""
+    return [summary(profile, links) for profile in profiles]
+
+def weighted_profiles(profiles, links):
+    """The people with a keyword, and their weights for it.
+
+    Args:
+        profiles (List[Tuple[oblong.database.ProfileRow, float]]): From
+            :func:`oblong.database.read_profiles_by_keyword`.
+        links (Links): Builds the links to the profiles.
+
+    """
+    return [{ 'name': profile.name
+            , 'email': profile.email
+            , 'faculty': profile.faculty
+            , 'department': profile.department
+            , 'weight': weight
+            , 'link': links.profile(profile.id)
+            } for profile, weight in profiles]
+
+def publication_links(publications, links):
+    """The titles of some publications and links to them."""
+    return [{ 'title': pub.title
+            , 'link': links.publication(pub.id)
+            } for pub in publications]
+
+def publication_summaries(publications, authors, links):
+    """The publications shown in lists of publications.
+
+    Args:
+        publications (List[oblong.database.PublicationRow]): The
+            publications.
+        authors (Dict[int, List[int]]): The authors of each, from
+            :func:`oblong.database.read_authors`.
+        links (Links): Builds the links to the publications and their
+            authors.
+
+    """
+    return [{ 'title': pub.title
+            , 'date': str(pub.date)
+            , 'authors': [links.profile(a) for a in authors.get(pub.id, ())]
+            , 'link': links.publication(pub.id)
+            } for pub in publications]
@@ -0,0 +1,53 @@
+import json
+import unittest
+from unittest import mock
+
+from flask import url_for
+from . import serializers, server, database as db
+
+class LinksTests(unittest.TestCase):
+    def test_same_as_url_for(self):
+        with server.app.test_request_context():
+            for uid in (1, 42, serializers._PLACEHOLDER):
+                self.assertEqual( server.links.profile(uid)
+                                , url_for('profile', uid=uid)
+                                )
+                self.assertEqual( server.links.publication(uid)
+                                , url_for('publication', uid=uid)
+                                )
+
+class DumpsTests(unittest.TestCase):
+    body = { 'count': 2
+           , 'this_page': [{ 'name': {'first': 'Zoë', 'alias': None}
+                           , 'keywords': ['horse', 'cart']
+                           , 'weight': 1.25
+                           }]
+           }
+
+    def test_round_trip(self):
+        data = serializers.dumps(self.body)
+        self.assertIsInstance(data, bytes)
+        self.assertEqual(json.loads(data.decode('utf-8')), self.body)
+
+    def test_without_orjson(self):
+        with mock.patch.object(serializers, 'orjson', None):
+            data = serializers.dumps(self.body)
+        self.assertEqual(json.loads(data.decode('utf-8')), self.body)
+
+class SummaryTests(unittest.TestCase):
+    def test_summary(self):
+        profile = db.SummaryRow(3, 'Dr', 'Jane', 'Doe', 'J', None,
+                                'jane@ic.ac.uk', 'Engineering', 'Computing',
+                                ['horse', 'cart'])
+        self.assertEqual( serializers.summary(profile, server.links)
+                        , { 'name': { 'title': 'Dr', 'first': 'Jane'
+                                    , 'last': 'Doe', 'initials': 'J'
+                                    , 'alias': None
+                                    }
+                          , 'email': 'jane@ic.ac.uk'
+                          , 'faculty': 'Engineering'
+                          , 'department': 'Computing'
+                          , 'keywords': ['horse', 'cart']
+                          , 'link': '/api/people/3'
+                          }
+                        )
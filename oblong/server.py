@@ -1,14 +1,19 @@
 """Webserver to allow queries to user profiles."""
 from collections import defaultdict
 from itertools import repeat
-import json
 import os
+import time
 
 from flask import Flask, abort, request, url_for
 from flask_cors import CORS
 
+from . import admission
+from . import compression
 from . import database as db
+from . import postings
 from . import profiling
+from . import serializers
+from . import similarity
 
 OKAY = 200
 CREATED = 201
@@ -19,7 +24,7 @@ def error_message(code, message):
     response = { 'error_code': code
                , 'message': message
                }
-    return json.dumps(response), code
+    return serializers.dumps(response), code
 
 def obsolete(new_api, method='GET'):
     def decorator(f):
@@ -41,16 +46,58 @@ app = Flask(__name__)
 # Add CORS headers to all responses/ requests
 cors = CORS(app, resources={r"/api/*": {"origins": "*"}})
 
+# Compress large responses for clients that accept it
+compression.init_app(app)
 
-def top_keywords(profile):
-    # take up to five of the highest-ranked keywords
-    app.logger.info("Sorting keywords for profile {}".format(profile.id))
-    keywords = sorted(tuple(profile.keywords.items()),
-                      key=lambda p: p[1], reverse=True)[:5]
-    if keywords:
-        return tuple(zip(*keywords))[0]
-    else:
-        return ()
+# Bound how many expensive requests run at once, see oblong.admission
+admission.init_app(app)
+
+#: Seconds after a client's own write during which its reads are sent
+#: to the primary rather than a (possibly lagging) replica.
+app.config.setdefault('READ_YOUR_WRITES', 10)
+READ_YOUR_WRITES_COOKIE = 'oblong_wrote_at'
+
+#: (endpoint, method) pairs that never write, so can use a replica.
+READ_ONLY = { ('profiles', 'GET')
+            , ('profile', 'GET')
+            , ('similar_profiles', 'GET')
+            , ('find_person', 'GET')
+            , ('keyword', 'GET')
+            , ('publications', 'GET')
+            , ('publication', 'GET')
+            , ('queries', 'POST')
+            }
+
+@app.before_request
+def route_reads():
+    """Sends read-only requests to a replica.
+
+    Clients that have written recently are kept on the primary, so
+    they see their own writes.
+
+    """
+    if (request.endpoint, request.method) not in READ_ONLY:
+        return
+    try:
+        wrote_at = float(request.cookies.get(READ_YOUR_WRITES_COOKIE, 0))
+    except ValueError:
+        wrote_at = 0
+    if time.time() - wrote_at >= app.config['READ_YOUR_WRITES']:
+        db.use_replica()
+
+def wrote(response):
+    """Marks a response as coming from a write, see ``route_reads``."""
+    response.set_cookie(READ_YOUR_WRITES_COOKIE, str(time.time()),
+                        max_age=app.config['READ_YOUR_WRITES'])
+    return response
+
+
+#: Builds the links in response bodies, see :mod:`oblong.serializers`.
+links = serializers.Links(app.url_map)
+
+def summaries(profiles):
+    """Summarises people, from :func:`oblong.database.read_summaries`."""
+    return serializers.summaries(profiles, links)
 
 
 # ------------ PROFILE API ROUTES -----------------
@@ -76,6 +123,7 @@ def _query(uid): pass
 
 
 @app.route('/api/queries', methods=['POST'])
+@admission.limited('search')
 def queries():
     """Submits a query.
     
@@ -90,23 +138,19 @@ def queries():
     except ValueError:
         return error_message(BAD_REQUEST, 'page and page_size must be uint')
 
-    count, profiles = profiling.fulfill_query(
-            request.get_data().decode('utf-8'),
-            page_no=page,
-            page_size=size
-            )
-    
-    response = [{ 'name': profile.name
-                , 'email': profile.email
-                , 'faculty': profile.faculty
-                , 'department': profile.department
-                , 'keywords': top_keywords(profile)
-                , 'link': url_for('profile', uid=profile.id)
-                } for profile in profiles]
+    try:
+        count, uids = profiling.fulfill_query_ids(
+                request.get_data().decode('utf-8'),
+                page_no=page,
+                page_size=size
+                )
+    except postings.QueryError as e:
+        return error_message(BAD_REQUEST, str(e))
 
-    return json.dumps(response)
+    return serializers.dumps(summaries(db.read_summaries(uids)))
 
 @app.route('/api/people')
+@admission.limited('search', when=lambda: 'query' in request.args)
 def profiles():
     try:
         query = request.args.get('query', '')
@@ -115,12 +159,18 @@ def profiles():
     except ValueError:
         return error_message(BAD_REQUEST, 'page and page_size must be uint')
 
-    count, profiles = (profiling.fulfill_query(query, page, size)
-                       if query else 
-                       (db.Profile.count(), db.Profile.get_page(page, size)))
+    if query:
+        try:
+            count, uids = profiling.fulfill_query_ids(query, page, size)
+        except postings.QueryError as e:
+            return error_message(BAD_REQUEST, str(e))
+        profiles = db.read_summaries(uids)
+    else:
+        count = db.Profile.count()
+        profiles = db.read_summary_page(page, size)
 
     if not count:
-        return json.dumps({"count": count})
+        return serializers.dumps({"count": count})
     else:
         result = { 'count': count }
         if page > 0:
@@ -129,20 +179,14 @@ def profiles():
                 kwargs['query'] = query
             result['previous_page'] = url_for('profiles', **kwargs)
         if (page + 1) * size < count:
-            kwargs = {'page': page - 1, 'page_size': size}
+            kwargs = {'page': page + 1, 'page_size': size}
             if query:
                 kwargs['query'] = query
             result['next_page'] = url_for('profiles', **kwargs)
 
-        result['this_page'] = [{ 'name': profile.name
-                               , 'email': profile.email
-                               , 'faculty': profile.faculty
-                               , 'department': profile.department
-                               , 'keywords': top_keywords(profile)
-                               , 'link': url_for('profile', uid=profile.id)
-                               } for profile in profiles]
+        result['this_page'] = summaries(profiles)
 
-        return json.dumps(result)
+        return serializers.dumps(result)
 
 #TODO: Implement Put for submitting a user edited profile
 @app.route('/api/people/<int:uid>', methods=['GET', 'PUT'])
@@ -170,24 +214,69 @@ def profile(uid):
     elif request.method == 'PUT':
         return put_profile(uid)
 
+def optional_uint(name):
+    """Reads an optional non-negative integer parameter of the request.
+
+    Raises:
+        ValueError: If the parameter is not a non-negative integer.
+
+    """
+    value = request.args.get(name)
+    if value is None:
+        return None
+    value = int(value)
+    if value < 0:
+        raise ValueError(name)
+    return value
+
+#: The fields of a full profile, see ``get_profile``.
+PROFILE_FIELDS = ( 'name', 'email', 'faculty', 'department', 'campus'
+                 , 'building', 'room', 'website', 'keywords', 'publications'
+                 )
+
 def get_profile(uid):
-    profile = db.Profile.get(uid)
+    """Retrieves a full profile.
+
+    The optional ``fields`` parameter is a comma-separated list of the
+    fields to return, all of them by default; keywords and publications
+    are not read from the database unless they are asked for. The
+    optional ``keywords_limit`` and ``publications_limit`` parameters
+    cap the number of each returned, taking the heaviest keywords and
+    the oldest publications.
+
+    """
+    try:
+        fields = request.args.get('fields')
+        fields = fields.split(',') if fields else PROFILE_FIELDS
+        keywords_limit = optional_uint('keywords_limit')
+        publications_limit = optional_uint('publications_limit')
+    except ValueError:
+        return error_message(BAD_REQUEST,
+                'keywords_limit and publications_limit must be uint')
+    unknown = [f for f in fields if f not in PROFILE_FIELDS]
+    if unknown:
+        return error_message(BAD_REQUEST,
+                'unknown fields: {}'.format(', '.join(unknown)))
+
+    profile = db.read_profile(uid)
     if not profile:
         abort(NOT_FOUND)
     else:
         result = {}
-        for attribute in ['name', 'email', 'faculty', 'department', 'campus',
-                'building', 'room', 'website']:
-            result[attribute] = getattr(profile, attribute)
+        for attribute in fields:
+            if attribute not in ('keywords', 'publications'):
+                result[attribute] = getattr(profile, attribute)
 
-        result['keywords'] = dict(profile.keywords)
-        #result['keywords'] = dict(top_keywords(profile))
+        if 'keywords' in fields:
+            keywords = db.read_keywords([uid], keywords_limit)
+            result['keywords'] = dict(keywords.get(uid, ()))
 
-        result['publications'] = [{ 'title': pub.title
-                                  , 'link': url_for('publication', uid=pub.id) 
-                                  } for pub in profile.publications]
+        if 'publications' in fields:
+            publications = db.read_publications_of(uid, publications_limit)
+            result['publications'] = serializers.publication_links(
+                    publications, links)
 
-        return json.dumps(result)
+        return serializers.dumps(result)
 
 def put_profile(uid):
     if request.is_json:
@@ -197,39 +286,70 @@ def put_profile(uid):
         if 'remove_keyords' in submission:
             profiling.remove_user_keywords(submission['remove_keywords'],uid)
         response = { 'success': True }
-        return json.dumps(response), CREATED
+        return wrote(app.make_response((serializers.dumps(response), CREATED)))
     else:
         return error_message(BAD_REQUEST, 'JSON, please.')
 
+@app.route('/api/people/<int:uid>/similar')
+def similar_profiles(uid):
+    """Lists the people whose keywords are most like this person's.
+
+    The optional ``limit`` parameter caps the number of people
+    returned, ten by default.
+
+    """
+    try:
+        limit = int(request.args.get('limit', DEFAULT_PAGE_SIZE))
+    except ValueError:
+        return error_message(BAD_REQUEST, 'limit must be uint')
+
+    if not db.read_profile(uid):
+        abort(NOT_FOUND)
+
+    scores = dict(similarity.profiles.similar(uid, limit))
+    profiles = db.read_summaries(sorted(scores, key=lambda u: (-scores[u], u)))
+    result = summaries(profiles)
+    for person, profile in zip(result, profiles):
+        person['similarity'] = scores[profile.id]
+    return serializers.dumps(result)
+
 @app.route('/api/people/find')
 def find_person():
     try:
         profiles = db.Profile.find(**{k: v for k, v in request.args.items()})
-        return json.dumps([url_for('profile', uid=p.id) for p in profiles])
+        return serializers.dumps([links.profile(p.id) for p in profiles])
     except AttributeError as e:
         return error_message(BAD_REQUEST, e.args[0])
 
 @app.route('/api/keywords/<keyword>')
 def keyword(keyword):
-    """returns a list of profiles with this keyword
+    """returns a list of profiles with this keyword, most relevant first
+
+    The optional ``limit`` and ``page`` parameters page through the
+    profiles ``limit`` at a time; ``limit`` defaults to
+    :data:`oblong.database.KEYWORD_PAGE_SIZE`.
     """
-    keyword = db.Keyword.find(name=keyword)
-    if not keyword:
+    try:
+        limit = optional_uint('limit')
+        page = optional_uint('page') or 0
+        if limit == 0:
+            raise ValueError('limit')
+    except ValueError:
+        return error_message(BAD_REQUEST, 'page and limit must be uint')
+    if limit is None:
+        limit = db.KEYWORD_PAGE_SIZE
+
+    profiles = db.read_profiles_by_keyword(keyword, page, limit)
+    if profiles is None:
         abort(NOT_FOUND)
     else:
-        assert len(keyword) == 1
-        keyword = keyword[0]
-        result = { 'name': keyword.name
-                 , 'profiles': [{ 'name': profile.name
-                                , 'email': profile.name
-                                , 'faculty': profile.faculty
-                                , 'department': profile.department
-                                , 'link': url_for('profile', uid=profile.id)
-                                } for profile in keyword.profiles]
+        result = { 'name': keyword
+                 , 'profiles': serializers.weighted_profiles(profiles, links)
                  }
-        return json.dumps(result)
+        return serializers.dumps(result)
 
 @app.route('/api/publications', methods=['GET', 'POST'])
+@admission.limited('ingest', when=lambda: request.method == 'POST')
 def publications():
     """
         GET: a paginated list of all publications.
@@ -245,7 +365,7 @@ def publications():
 
         count = db.Publication.count()
         if not count:
-            return json.dumps({"count": count})
+            return serializers.dumps({"count": count})
         else:
             result = { 'count': count }
             if page > 0:
@@ -255,15 +375,12 @@ def publications():
                 result['next_page'] = url_for('publications', page=page + 1,
                                               page_size=size)
 
-            pubs = db.Publication.get_page(page, size)
-            result['this_page'] = [{ 'title': pub.title
-                                   , 'date': str(pub.date)
-                                   , 'authors': [url_for('profile', uid=a.id)
-                                                 for a in pub.authors]
-                                   , 'link': url_for('publication', uid=pub.id)
-                                   } for pub in pubs]
+            pubs = db.read_publication_page(page, size)
+            authors = db.read_authors([pub.id for pub in pubs])
+            result['this_page'] = serializers.publication_summaries(
+                    pubs, authors, links)
 
-            return json.dumps(result)
+            return serializers.dumps(result)
 
     elif request.method == 'POST':
         if request.is_json:
@@ -274,48 +391,78 @@ def publications():
                     paper['authors'], 
                     paper['date']) 
             response = { 'success': True }
-            return json.dumps(response), CREATED
+            return wrote(app.make_response((serializers.dumps(response), CREATED)))
         else:
             return error_message(BAD_REQUEST, 'JSON, please.')
 
 @app.route('/api/publications/<int:uid>')
 def publication(uid):
-    pub = db.Publication.get(uid)
+    pub = db.read_publication(uid)
     if not pub:
         abort(NOT_FOUND)
     else:
+        authors = db.read_summaries(db.read_authors([uid]).get(uid, []))
         result = { 'title': pub.title
                  , 'abstract': pub.abstract
                  , 'date': str(pub.date)
-                 , 'authors': [{ 'name': author.name
-                               , 'email': author.email
-                               , 'faculty': author.faculty
-                               , 'department': author.department
-                               , 'keywords': top_keywords(author)
-                               , 'link': url_for('profile', uid=author.id)
-                               } for author in pub.authors]
+                 , 'authors': summaries(authors)
                  }
-        return json.dumps(result)
+        return serializers.dumps(result)
 
-#TODO: Change this to delete Garbage keywords
 @app.route('/api/keywords', methods=['DELETE'])
-def delete_keywords(uid):
+def delete_keywords():
     """
        DELETE: accepts a list of user garbage keywords to be removed 
-               from all profiles
-               
-               The body contains a jwt (authentication token), and a list of
-               keywords.
+               from all profiles, or an object with a list of
+               ``keywords``.
+
+               Responds with the number of keywords, weights and
+               profiles affected, and the seconds it took.
+
+               Keywords matching a pattern can only be removed with
+               ``oblong purge-keywords --pattern``: a pattern such as
+               ``%`` would remove every keyword.
     """
     if request.is_json:
         submission = request.get_json()
-        for word in submission:
-            db.session.delete(db.Keyword.find(name=word))
-        response = { 'success': True }
-        return json.dumps(response), CREATED
+        if isinstance(submission, dict):
+            if 'pattern' in submission:
+                return error_message(BAD_REQUEST,
+                                     'Patterns can only be purged with '
+                                     'oblong purge-keywords.')
+            words = submission.get('keywords', [])
+        else:
+            words = submission
+        if not isinstance(words, list) \
+                or not all(isinstance(w, str) for w in words):
+            return error_message(BAD_REQUEST,
+                                 'Keywords must be a list of strings.')
+        report = profiling.purge_keywords(words)
+        response = { 'success': True
+                   , 'keywords': report.keywords
+                   , 'weights': report.weights
+                   , 'profiles': report.profiles
+                   , 'seconds': report.seconds
+                   }
+        return wrote(app.make_response((serializers.dumps(response), OKAY)))
     else:
         return error_message(BAD_REQUEST, 'JSON, please.')
 
+@app.route('/api/stats')
+def stats():
+    """Counters for monitoring.
+
+    Gives the requests admitted, rejected and timed out by each
+    limiter of :mod:`oblong.admission`, and the searches made and
+    coalesced by :data:`oblong.profiling.searches`.
+    """
+    result = { 'admission': admission.stats()
+             , 'searches': { 'calls': profiling.searches.calls
+                           , 'coalesced': profiling.searches.coalesced
+                           }
+             }
+    return serializers.dumps(result)
+
 
 @app.teardown_appcontext
 def shutdown_session(exception=None):
@@ -1,9 +1,14 @@
+import gzip
 import json
+import threading
+import time
 import unittest
+import urllib.parse
+from unittest import mock
 
 from flask import url_for
-from . import server, database as db
-from .database_tests import DatabaseTestCase
+from . import admission, compression, server, database as db
+from .database_tests import DatabaseTestCase, Postgresql
 
 class DefunctEndpointTestCase(DatabaseTestCase):
     def setUp(self):
@@ -149,7 +154,41 @@ class QueryTestCase(ServerTestCase):
         
         self.assertEqual(data, {'count': 0})
 
+class BooleanQueryTestCase(ServerTestCase):
+    def query(self, query):
+        response = self.app.get('/api/people', query_string={'query': query})
+        data = json.loads(response.data.decode('utf-8'))
+        return [p['link'] for p in data.get('this_page', [])]
+
+    def test_operators(self):
+        john, jane, mary = ('/api/people/{}'.format(p.id)
+                            for p in (self.john, self.jane, self.mary))
+        self.assertEqual(self.query('argumentation AND machine learning'),
+                         [john])
+        self.assertEqual(self.query('argumentation OR machine learning'),
+                         [john, mary, jane])
+        self.assertEqual(self.query('machine learning NOT argumentation'),
+                         [mary])
+
+    def test_post(self):
+        response = self.app.post('/api/queries',
+                data='machine learning NOT argumentation')
+        data = json.loads(response.data.decode('utf-8'))
+        self.assertEqual([p['link'] for p in data],
+                         ['/api/people/{}'.format(self.mary.id)])
+
+    def test_malformed(self):
+        response = self.app.get('/api/people?query=argumentation%20AND')
+        self.assertEqual(response.status_code, 400)
+        response = self.app.post('/api/queries', data='(machine OR learning')
+        self.assertEqual(response.status_code, 400)
+
 class PublicationSubmitTestCase(ServerTestCase):
+    @staticmethod
+    def keywords(profile):
+        # the request commits with Core statements, so reload from the db
+        return dict(db.Profile.get(profile.id).keywords)
+
     def test_known_author(self):
         pub_data = { 'title': 'Paper2'
                    , 'abstract': 'A paper about wild horses.'
@@ -174,9 +213,9 @@ class PublicationSubmitTestCase(ServerTestCase):
         self.app.post('/api/publications', data=json.dumps(pub_data),
                 content_type='application/json')
         
-        self.assertIn('wild horses', self.john.keywords)
-        self.assertNotIn('wild horses', self.jane.keywords)
-        self.assertNotIn('wild horses', self.mary.keywords)
+        self.assertIn('wild horses', self.keywords(self.john))
+        self.assertNotIn('wild horses', self.keywords(self.jane))
+        self.assertNotIn('wild horses', self.keywords(self.mary))
         self.assertEqual(db.Profile.query.count(), 3)
         
     def test_new_author(self):
@@ -203,9 +242,9 @@ class PublicationSubmitTestCase(ServerTestCase):
         self.app.post('/api/publications', data=json.dumps(pub_data),
                 content_type='application/json')
         
-        self.assertNotIn('wild horses', self.john.keywords)
-        self.assertNotIn('wild horses', self.jane.keywords)
-        self.assertNotIn('wild horses', self.mary.keywords)
+        self.assertNotIn('wild horses', self.keywords(self.john))
+        self.assertNotIn('wild horses', self.keywords(self.jane))
+        self.assertNotIn('wild horses', self.keywords(self.mary))
         self.assertEqual(db.Profile.query.count(), 4)
 
         clara = db.Profile.query.all()[3]
@@ -308,3 +347,303 @@ class PeopleTestCase(ServerTestCase):
                 ]
             }
         )
+
+    def testPeoplePages(self):
+        response = self.app.get('/api/people?page=1&page_size=1')
+        data = json.loads(response.data.decode('utf-8'))
+
+        self.assertEqual([p['link'] for p in data['this_page']],
+                         ['/api/people/2'])
+        for link, page in (('previous_page', '0'), ('next_page', '2')):
+            url = urllib.parse.urlsplit(data[link])
+            self.assertEqual(url.path, '/api/people')
+            self.assertEqual(urllib.parse.parse_qs(url.query),
+                             {'page': [page], 'page_size': ['1']})
+
+class FieldsTestCase(ServerTestCase):
+    def get(self, url):
+        response = self.app.get(url)
+        return response.status_code, json.loads(response.data.decode('utf-8'))
+
+    def testFields(self):
+        status, data = self.get('/api/people/1?fields=email,keywords')
+        self.assertEqual(status, 200)
+        self.assertEqual(data, { 'email': 'john.smith@ic.ac.uk'
+                               , 'keywords': { 'argumentation': 1.
+                                             , 'machine learning': 4.
+                                             }
+                               })
+
+    def testUnrequestedNotRead(self):
+        with mock.patch.object(db, 'read_publications_of') as read:
+            status, data = self.get('/api/people/1?fields=name')
+        self.assertEqual(status, 200)
+        self.assertEqual(list(data), ['name'])
+        read.assert_not_called()
+
+    def testLimits(self):
+        status, data = self.get('/api/people/1?keywords_limit=1'
+                                '&publications_limit=1')
+        self.assertEqual(data['keywords'], {'machine learning': 4.})
+        self.assertEqual( data['publications']
+                        , [{'title': 'Paper0', 'link': '/api/publications/1'}]
+                        )
+
+    def testBadRequests(self):
+        for query in ('fields=name,horse', 'keywords_limit=-1',
+                      'publications_limit=many'):
+            with self.subTest(query=query):
+                status, data = self.get('/api/people/1?' + query)
+                self.assertEqual(status, 400)
+                self.assertEqual(data['error_code'], 400)
+
+class CompressionTestCase(ServerTestCase):
+    def setUp(self):
+        super().setUp()
+        server.app.config['COMPRESS_MIN_SIZE'] = 100
+        self.addCleanup(server.app.config.__setitem__, 'COMPRESS_MIN_SIZE',
+                        1024)
+
+    def testGzip(self):
+        plain = self.app.get('/api/people/1')
+        response = self.app.get('/api/people/1',
+                                headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response.headers['Vary'])
+        self.assertEqual(gzip.decompress(response.data), plain.data)
+
+    @unittest.skipIf(compression.brotli is None, 'brotli is not installed')
+    def testBrotliPreferred(self):
+        response = self.app.get('/api/people/1',
+                                headers={'Accept-Encoding': 'gzip, br'})
+        self.assertEqual(response.headers['Content-Encoding'], 'br')
+
+    def testNegotiation(self):
+        for accept in ('identity', 'gzip;q=0', ''):
+            with self.subTest(accept=accept):
+                response = self.app.get('/api/people/1',
+                                        headers={'Accept-Encoding': accept})
+                self.assertNotIn('Content-Encoding', response.headers)
+
+    def testSmallResponses(self):
+        response = self.app.get('/api/people/1?fields=email',
+                                headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertIn('Accept-Encoding', response.headers['Vary'])
+
+class LimiterTests(unittest.TestCase):
+    def testQueueBounded(self):
+        limiter = admission.Limiter(concurrency=1, queue=0)
+        self.assertTrue(limiter.acquire())
+        self.assertFalse(limiter.acquire())
+        limiter.release()
+        self.assertTrue(limiter.acquire())
+        self.assertEqual( limiter.stats()
+                        , { 'running': 1, 'waiting': 0, 'admitted': 2
+                          , 'rejected': 1, 'timed_out': 0
+                          }
+                        )
+
+    def testQueueTimeout(self):
+        limiter = admission.Limiter(concurrency=1, queue=1, queue_timeout=.01)
+        self.assertTrue(limiter.acquire())
+        self.assertFalse(limiter.acquire())
+        self.assertEqual(limiter.rejected, 1)
+
+    def testWaitsForTurn(self):
+        limiter = admission.Limiter(concurrency=1, queue=1, queue_timeout=5)
+        self.assertTrue(limiter.acquire())
+        results = []
+        waiter = threading.Thread(target=lambda:
+                                  results.append(limiter.acquire()))
+        waiter.start()
+        while not limiter.waiting:
+            time.sleep(.01)
+        limiter.release()
+        waiter.join()
+        self.assertEqual(results, [True])
+        self.assertEqual(limiter.running, 1)
+
+class AdmissionTestCase(ServerTestCase):
+    def setUp(self):
+        super().setUp()
+        patch = mock.patch.dict(admission._limiters, clear=True)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def limit(self, name, **kwargs):
+        limits = server.app.config['ADMISSION_LIMITS']
+        patch = mock.patch.dict(limits, {name: kwargs})
+        patch.start()
+        self.addCleanup(patch.stop)
+        return admission.limiter(name, server.app)
+
+    def testRejectedWhenFull(self):
+        limiter = self.limit('search', concurrency=1, queue=0, retry_after=3)
+        limiter.acquire()
+        response = self.app.get('/api/people?query=argumentation')
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers['Retry-After'], '3')
+        self.assertEqual(json.loads(response.data.decode('utf-8'))['error_code'],
+                         503)
+        # cheap requests to the same view aren't limited
+        self.assertEqual(self.app.get('/api/people').status_code, 200)
+        limiter.release()
+        response = self.app.get('/api/people?query=argumentation')
+        self.assertEqual(response.status_code, 200)
+
+    def testStatementTimeout(self):
+        self.limit('search', deadline=.1)
+        with mock.patch.object(server.profiling, 'fulfill_query_ids',
+                               lambda *args: db.session.execute(
+                                       'SELECT pg_sleep(5)')):
+            response = self.app.get('/api/people?query=argumentation')
+        self.assertEqual(response.status_code, 503)
+        self.assertIn('Retry-After', response.headers)
+
+        stats = json.loads(self.app.get('/api/stats').data.decode('utf-8'))
+        self.assertEqual( stats['admission']['search']
+                        , { 'running': 0, 'waiting': 0, 'admitted': 1
+                          , 'rejected': 0, 'timed_out': 1
+                          }
+                        )
+
+    def testDeadlineReset(self):
+        self.limit('search', deadline=.1)
+        self.app.get('/api/people?query=argumentation')
+        time.sleep(.2)
+        self.assertEqual(self.app.get('/api/people/1').status_code, 200)
+
+class KeywordTestCase(ServerTestCase):
+    def testKeyword(self):
+        response = self.app.get('/api/keywords/machine%20learning')
+        data = json.loads(response.data.decode('utf-8'))
+
+        self.assertEqual(data['name'], 'machine learning')
+        self.assertEqual([p['link'] for p in data['profiles']],
+                         ['/api/people/1', '/api/people/3'])
+        self.assertEqual([p['weight'] for p in data['profiles']], [4., 3.])
+        self.assertEqual(data['profiles'][0]['email'], 'john.smith@ic.ac.uk')
+
+    def testLimit(self):
+        response = self.app.get('/api/keywords/machine%20learning?limit=1&page=1')
+        data = json.loads(response.data.decode('utf-8'))
+
+        self.assertEqual([p['link'] for p in data['profiles']],
+                         ['/api/people/3'])
+
+    def testNegativePaging(self):
+        for query in ('page=-1', 'limit=-5', 'limit=0'):
+            response = self.app.get('/api/keywords/machine%20learning?'
+                                    + query)
+            self.assertEqual(response.status_code, 400, query)
+            self.assertEqual(json.loads(response.data.decode('utf-8')),
+                             {'error_code': 400,
+                              'message': 'page and limit must be uint'})
+
+    def testMissingKeyword(self):
+        response = self.app.get('/api/keywords/horse')
+        self.assertEqual(response.status_code, 404)
+
+    def testDeleteKeywords(self):
+        response = self.app.delete('/api/keywords',
+                                   data=json.dumps(['machine learning']),
+                                   content_type='application/json')
+        data = json.loads(response.data.decode('utf-8'))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((data['keywords'], data['weights'], data['profiles']),
+                         (1, 2, 2))
+        self.assertIsNone(db.Keyword.query.filter_by(name='machine learning')
+                          .one_or_none())
+        response = self.app.get('/api/keywords/machine%20learning')
+        self.assertEqual(json.loads(response.data.decode('utf-8'))['profiles'],
+                         [])
+
+    def testDeletePatternRefused(self):
+        response = self.app.delete('/api/keywords',
+                                   data=json.dumps({'pattern': '%ation'}),
+                                   content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(db.Keyword.query.count(), 2)
+
+    def testDeleteBadRequest(self):
+        response = self.app.delete('/api/keywords',
+                                   data=json.dumps({'keywords': 'horse'}),
+                                   content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+class SimilarTestCase(ServerTestCase):
+    def testSimilar(self):
+        response = self.app.get('/api/people/2/similar')
+        data = json.loads(response.data.decode('utf-8'))
+
+        self.assertEqual([p['link'] for p in data], ['/api/people/1'])
+        self.assertAlmostEqual(data[0]['similarity'], 1 / 17 ** .5)
+
+    def testMissingPerson(self):
+        response = self.app.get('/api/people/42/similar')
+        self.assertEqual(response.status_code, 404)
+
+class ReplicaTestCase(DatabaseTestCase):
+    def setUp(self):
+        self.postgresql = Postgresql()
+        self.replica = Postgresql()
+        db.init(self.postgresql.url(), [self.replica.url()])
+        replica = db.replicas.engines[0]
+        db.Base.metadata.create_all(bind=replica)
+
+        # the replica is deliberately out of step with the primary
+        db.session.add(db.Profile(title='Mr', firstname='John',
+                                  lastname='Smith'))
+        db.session.commit()
+        db.session.remove()
+        replica_session = db.sessionmaker(bind=replica)()
+        replica_session.add(db.Profile(title='Ms', firstname='Rita',
+                                       lastname='Replica'))
+        replica_session.commit()
+        replica_session.close()
+
+        self.app = server.app.test_client()
+
+    def tearDown(self):
+        super().tearDown()
+        self.replica.stop()
+
+    def people(self):
+        response = self.app.get('/api/people')
+        data = json.loads(response.data.decode('utf-8'))
+        return [p['name']['first'] for p in data['this_page']]
+
+    def testReadsUseReplica(self):
+        self.assertEqual(self.people(), ['Rita'])
+
+    def testReadYourWrites(self):
+        response = self.app.put('/api/people/1', data=json.dumps({}),
+                                content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(self.people(), ['John'])
+
+    def testStatementsUsePrimary(self):
+        table = db.Profile.__table__
+        db.use_replica()
+        db.session.execute(table.insert().values(
+                title='Ms', firstname='Pat', lastname='Primary'))
+        db.session.execute(db.text("UPDATE profile SET title = 'Dr' "
+                                   "WHERE firstname = 'John'"))
+        locked = db.session.execute(db.select([table.c.firstname])
+                                    .with_for_update()).fetchall()
+        read = db.session.execute(db.select([table.c.firstname])).fetchall()
+        db.session.commit()
+        db.session.remove()
+
+        self.assertEqual(sorted(name for name, in locked), ['John', 'Pat'])
+        self.assertEqual(read, [('Rita',)])
+        self.assertEqual(sorted((p.title, p.firstname)
+                                for p in db.Profile.query),
+                         [('Dr', 'John'), ('Ms', 'Pat')])
+
+    def testReplicaDown(self):
+        db.replicas.check_interval = 0
+        self.replica.stop()
+        self.assertEqual(self.people(), ['John'])
@@ -0,0 +1,240 @@
+"""An index for finding profiles similar to a given profile.
+
+Each profile is a sparse vector of keyword weights, taken from
+``profile_keyword_association``, and two profiles are similar if the
+cosine of the angle between their vectors is large. Comparing one
+profile against every other is too slow to do per request, so the
+index uses random-projection locality sensitive hashing: each profile
+is summarised by a signature of ``bands * rows`` bits, bit ``i`` being
+the sign of the vector's projection onto the ``i``-th random
+hyperplane. Two vectors agree on a bit with probability
+``1 - angle / pi``, so similar profiles are likely to agree on every
+bit of at least one band. Profiles sharing a band are the candidates,
+and only those are ranked by their exact cosine similarity.
+
+With the default 32 bands of 8 rows, ``benchmarks/similarity.py``
+measures a recall@10 of 0.885 against exact cosine similarity on its
+synthetic corpus of 5000 profiles. Each query scores about 14% of the
+profiles and takes around 5 ms, against 24 ms for exhaustive search.
+
+The index lives in memory and is loaded from the database the first
+time it is used. After that it is updated through
+:data:`oblong.database.profile_listeners`, one profile at a time,
+including those changed by other processes while an
+:class:`oblong.database.ChangeListener` is running.
+
+"""
+from array import array
+from collections import defaultdict
+import hashlib
+import math
+import threading
+
+from . import database as db
+
+class SimilarityIndex:
+    """Approximate nearest neighbours of sparse keyword vectors.
+
+    Args:
+        bands (int): The number of bands in each signature. More bands
+            find more candidates, improving recall at the expense of
+            speed.
+        rows (int): The number of bits in each band. More rows make
+            candidates more likely to be truly similar.
+        seed (int): Seeds the random hyperplanes.
+        exact_below (int): While the index holds no more than this many
+            profiles, every profile is a candidate, so the results are
+            exact.
+
+    """
+    def __init__(self, bands=32, rows=8, seed=0, exact_below=500):
+        self.bands = bands
+        self.rows = rows
+        self.seed = seed
+        self.exact_below = exact_below
+        self._planes = {}
+        self._vectors = {}
+        self._norms = {}
+        self._signatures = {}
+        self._buckets = [defaultdict(set) for _ in range(bands)]
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._vectors)
+
+    def __contains__(self, uid):
+        return uid in self._vectors
+
+    def _plane(self, dim):
+        """The components of every hyperplane along one dimension."""
+        plane = self._planes.get(dim)
+        if plane is None:
+            nbits = self.bands * self.rows
+            # not blake2b, which needs Python 3.6
+            digest = hashlib.sha512('{}:{}'.format(self.seed, dim)
+                                    .encode()).digest()
+            bits = int.from_bytes(digest[:(nbits + 7) // 8], 'little')
+            plane = self._planes[dim] = array('d', (1. if bits >> i & 1 else -1.
+                                                    for i in range(nbits)))
+        return plane
+
+    def signature(self, vector):
+        """Computes the band keys of a vector.
+
+        Args:
+            vector (Dict[Hashable, float]): A sparse vector.
+
+        Returns:
+            (Tuple[int]): One key per band.
+
+        """
+        sums = [0.] * (self.bands * self.rows)
+        for dim, weight in vector.items():
+            sums = [s + weight * c for s, c in zip(sums, self._plane(dim))]
+        keys = []
+        for band in range(self.bands):
+            key = 0
+            for s in sums[band * self.rows:(band + 1) * self.rows]:
+                key = key << 1 | (s > 0)
+            keys.append(key)
+        return tuple(keys)
+
+    def update(self, uid, vector):
+        """Adds a vector to the index, replacing any previous one.
+
+        Args:
+            uid (int): The id of the profile.
+            vector (Dict[Hashable, float]): Its keyword weights.
+
+        """
+        vector = {k: w for k, w in vector.items() if w}
+        if not vector:
+            self.remove(uid)
+            return
+        signature = self.signature(vector)
+        with self._lock:
+            self.remove(uid)
+            self._vectors[uid] = vector
+            self._norms[uid] = math.sqrt(sum(w * w for w in vector.values()))
+            self._signatures[uid] = signature
+            for buckets, key in zip(self._buckets, signature):
+                buckets[key].add(uid)
+
+    def remove(self, uid):
+        """Removes a profile from the index, if it is present."""
+        with self._lock:
+            signature = self._signatures.pop(uid, None)
+            if signature is None:
+                return
+            del self._vectors[uid]
+            del self._norms[uid]
+            for buckets, key in zip(self._buckets, signature):
+                bucket = buckets[key]
+                bucket.discard(uid)
+                if not bucket:
+                    del buckets[key]
+
+    def candidates(self, uid):
+        """The profiles that share at least one band with a profile."""
+        with self._lock:
+            if len(self._vectors) <= self.exact_below:
+                return set(self._vectors) - {uid}
+            found = set()
+            for buckets, key in zip(self._buckets, self._signatures[uid]):
+                found |= buckets[key]
+            found.discard(uid)
+            return found
+
+    def cosine(self, a, b):
+        """The exact cosine similarity of two indexed profiles."""
+        u, v = self._vectors[a], self._vectors[b]
+        if len(u) > len(v):
+            u, v = v, u
+        dot = sum(w * v[k] for k, w in u.items() if k in v)
+        return dot / (self._norms[a] * self._norms[b])
+
+    def similar(self, uid, n=10):
+        """Finds the profiles most similar to a profile.
+
+        Args:
+            uid (int): The id of the profile.
+            n (int): The maximum number of profiles to return.
+
+        Returns:
+            (List[Tuple[int, float]]): Ids of similar profiles and their
+            cosine similarity to ``uid``, most similar first. Empty if
+            ``uid`` is not in the index.
+
+        """
+        with self._lock:
+            if uid not in self._vectors:
+                return []
+            scored = [(self.cosine(uid, c), c) for c in self.candidates(uid)]
+        scored.sort(key=lambda p: (-p[0], p[1]))
+        return [(c, s) for s, c in scored[:n] if s > 0]
+
+class ProfileSimilarity:
+    """A :class:`SimilarityIndex` over the profiles in the database.
+
+    The index is built the first time it is queried after
+    :func:`oblong.database.init`, and refreshed for individual
+    profiles whenever :func:`oblong.database.profiles_changed` is
+    called.
+
+    """
+    def __init__(self, **kwargs):
+        self._kwargs = kwargs
+        self._index = None
+        self._engine = None
+        self._lock = threading.Lock()
+
+    def _vectors(self, uids=None):
+        assoc = db.ProfileKeywordAssociation
+        q = db.session.query(assoc.left_id, assoc.right_id, assoc.weight)
+        if uids is not None:
+            q = q.filter(assoc.left_id.in_(uids))
+        vectors = defaultdict(dict)
+        for uid, kid, weight in q:
+            vectors[uid][kid] = weight
+        return vectors
+
+    @property
+    def index(self):
+        if self._index is None or self._engine is not db.engine:
+            with self._lock:
+                if self._index is None or self._engine is not db.engine:
+                    index = SimilarityIndex(**self._kwargs)
+                    for uid, vector in self._vectors().items():
+                        index.update(uid, vector)
+                    self._engine = db.engine
+                    self._index = index
+        return self._index
+
+    def reset(self):
+        """Forgets the index, so it is reloaded on next use."""
+        with self._lock:
+            self._index = None
+            self._engine = None
+
+    def refresh(self, uids):
+        """Reloads the vectors of some profiles from the database.
+
+        Args:
+            uids (Iterable[int]): The ids of the profiles to reload.
+
+        """
+        uids = list(uids)
+        if self._index is None or self._engine is not db.engine or not uids:
+            return
+        vectors = self._vectors(uids)
+        for uid in uids:
+            self._index.update(uid, vectors.get(uid, {}))
+
+    def similar(self, uid, n=10):
+        """See :meth:`SimilarityIndex.similar`."""
+        return self.index.similar(uid, n)
+
+#: The similarity index of the current database.
+profiles = ProfileSimilarity()
+db.profile_listeners.append(profiles.refresh)
+db.reset_listeners.append(profiles.reset)
@@ -0,0 +1,62 @@
+import unittest
+from . import similarity, database as db
+from .database_tests import DatabaseTestCase
+
+class SimilarityIndexTestCase(unittest.TestCase):
+    def setUp(self):
+        self.index = similarity.SimilarityIndex()
+        self.index.update(1, {'horse': 10., 'cart': 5.})
+        self.index.update(2, {'horse': 9., 'cart': 6., 'hay': 1.})
+        self.index.update(3, {'compilers': 10., 'types': 3.})
+
+    def testSimilar(self):
+        self.assertEqual([uid for uid, _ in self.index.similar(1)], [2])
+        self.assertEqual(self.index.similar(3), [])
+
+    def testExactScores(self):
+        (uid, score), = self.index.similar(1)
+        self.assertAlmostEqual(score, self.index.cosine(1, 2))
+        self.assertAlmostEqual(score, 0.9881, places=4)
+
+    def testSignatureIsDeterministic(self):
+        other = similarity.SimilarityIndex()
+        vector = {'horse': 10., 'cart': 5.}
+        self.assertEqual(self.index.signature(vector), other.signature(vector))
+
+    def testUpdate(self):
+        self.index.update(3, {'horse': 1., 'cart': .5})
+        self.assertEqual([uid for uid, _ in self.index.similar(3)], [1, 2])
+
+    def testApproximate(self):
+        index = similarity.SimilarityIndex(exact_below=0)
+        index.update(1, {'horse': 10., 'cart': 5.})
+        index.update(2, {'horse': 9., 'cart': 6., 'hay': 1.})
+        index.update(3, {'compilers': 10., 'types': 3.})
+        self.assertEqual(index.candidates(1), {2})
+        self.assertEqual([uid for uid, _ in index.similar(1)], [2])
+
+    def testRemove(self):
+        self.index.remove(2)
+        self.assertNotIn(2, self.index)
+        self.assertEqual(self.index.similar(1), [])
+        self.assertEqual(self.index.similar(2), [])
+
+class ProfileSimilarityTestCase(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.john = db.Profile(title="Mr", firstname="John", lastname="Smith")
+        self.jane = db.Profile(title="Ms", firstname="Jane", lastname="Doe")
+        for p in (self.john, self.jane):
+            db.session.add(p)
+        self.john.keywords["horse"] = 10.
+        self.jane.keywords["compilers"] = 10.
+        db.session.commit()
+
+    def testRefresh(self):
+        self.assertEqual(similarity.profiles.similar(self.john.id), [])
+        self.jane.keywords["horse"] = 10.
+        db.session.commit()
+        db.profiles_changed([self.jane.id])
+        self.assertEqual( [uid for uid, _ in similarity.profiles.similar(self.john.id)]
+                        , [self.jane.id]
+                        )
@@ -0,0 +1,388 @@
+"""Fast extraction of known terms from short search queries.
+
+Most searches are two or three words long, and running them through
+the NLTK pipeline in :func:`oblong.profiling.get_keywords` costs far
+more than the database lookup that follows. Instead, queries are
+first matched against the vocabulary we already know about: every
+:class:`oblong.database.Keyword` name and ontology concept, plus the
+profile fields that :func:`oblong.database.get_profiles_by_keywords`
+searches. The vocabulary is held in an Aho-Corasick automaton so that a query is
+scanned in a single pass, whatever the size of the vocabulary.
+
+Examples:
+    >>> a = Automaton()
+    >>> a.add('machine learning')
+    >>> a.add('medicine')
+    >>> a.find('Machine learning in medicine')
+    ['machine learning', 'medicine']
+    >>> a.discard('medicine')
+    >>> a.find('Machine learning in medicine')
+    ['machine learning']
+
+"""
+from collections import Counter, deque
+import threading
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session, object_session
+
+from . import database as db
+
+class Automaton:
+    """An Aho-Corasick automaton over a mutable set of terms.
+
+    Terms can be added and removed at any time. Adding a term extends
+    the trie in place; the failure links are recomputed lazily, the
+    next time the automaton is searched. Removing a term only clears
+    its output, so the trie (and its failure links) stay valid.
+
+    Matches are case-insensitive and only count if they start and end
+    on a word boundary, so 'art' is not found in 'cart'.
+
+    """
+    def __init__(self, terms=()):
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [None]
+        self._counts = Counter()
+        self._dirty = False
+        self._lock = threading.RLock()
+        for term in terms:
+            self.add(term)
+
+    def __contains__(self, term):
+        return self._counts[self._normalise(term)] > 0
+
+    def __len__(self):
+        return sum(1 for c in self._counts.values() if c > 0)
+
+    @staticmethod
+    def _normalise(term):
+        return ' '.join(term.lower().split())
+
+    def add(self, term):
+        """Adds a term to the automaton.
+
+        Terms are reference counted, so a term added twice must be
+        discarded twice before it stops matching.
+
+        Args:
+            term (str): The term to add.
+
+        """
+        term = self._normalise(term)
+        if not term:
+            return
+        with self._lock:
+            self._counts[term] += 1
+            if self._counts[term] > 1:
+                return
+            node = 0
+            for char in term:
+                nxt = self._goto[node].get(char)
+                if nxt is None:
+                    nxt = len(self._goto)
+                    self._goto[node][char] = nxt
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append(None)
+                    self._dirty = True
+                node = nxt
+            self._out[node] = term
+
+    def discard(self, term):
+        """Removes a term from the automaton, if it is present.
+
+        Args:
+            term (str): The term to remove.
+
+        """
+        term = self._normalise(term)
+        with self._lock:
+            if self._counts[term] <= 0:
+                return
+            self._counts[term] -= 1
+            if self._counts[term]:
+                return
+            del self._counts[term]
+            node = 0
+            for char in term:
+                node = self._goto[node][char]
+            self._out[node] = None
+
+    def _build(self):
+        """Recomputes failure links breadth-first."""
+        queue = deque()
+        for child in self._goto[0].values():
+            self._fail[child] = 0
+            queue.append(child)
+        while queue:
+            node = queue.popleft()
+            for char, child in self._goto[node].items():
+                queue.append(child)
+                fail = self._fail[node]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[child] = self._goto[fail].get(char, 0)
+        self._dirty = False
+
+    def find(self, text):
+        """Finds the terms that occur in a piece of text.
+
+        Where matches overlap, the leftmost longest match wins, so
+        'machine learning' is returned rather than 'learning'.
+
+        Args:
+            text (str): The text to search.
+
+        Returns:
+            (List[str]): The terms found, in order of appearance.
+
+        """
+        text = self._normalise(text)
+        with self._lock:
+            if self._dirty:
+                self._build()
+            matches = []
+            node = 0
+            for end, char in enumerate(text, 1):
+                while node and char not in self._goto[node]:
+                    node = self._fail[node]
+                node = self._goto[node].get(char, 0)
+                hit = node
+                while hit:
+                    term = self._out[hit]
+                    if term is not None:
+                        start = end - len(term)
+                        if _boundary(text, start, end):
+                            matches.append((start, end, term))
+                    hit = self._fail[hit]
+
+        # keep the leftmost longest of any overlapping matches
+        matches.sort(key=lambda m: (m[0], m[0] - m[1]))
+        result, last_end = [], 0
+        for start, end, term in matches:
+            if start >= last_end:
+                result.append(term)
+                last_end = end
+        return result
+
+def _boundary(text, start, end):
+    before = text[start - 1] if start > 0 else ' '
+    after = text[end] if end < len(text) else ' '
+    return not before.isalnum() and not after.isalnum()
+
+def profile_terms(profile):
+    """The searchable terms of a profile.
+
+    These mirror the columns searched by
+    :func:`oblong.database.get_profiles_by_keywords`.
+
+    Args:
+        profile: Anything with ``firstname``, ``lastname``,
+            ``department``, ``campus`` and ``faculty`` attributes.
+
+    Returns:
+        (List[str]): The non-empty terms.
+
+    """
+    terms = [ profile.firstname
+            , profile.lastname
+            , profile.department
+            , profile.campus
+            , profile.faculty
+            ]
+    if profile.firstname and profile.lastname:
+        terms.append(profile.firstname + ' ' + profile.lastname)
+    return [t for t in terms if t]
+
+class Vocabulary:
+    """The set of known terms, loaded lazily from the database.
+
+    The vocabulary is loaded in full the first time it is searched
+    after :func:`oblong.database.init`, then kept up to date by
+    listening for keywords and profiles being inserted, updated or
+    deleted through the ORM, and for keywords created by
+    :func:`oblong.database.keyword_ids`. Those changes are held by the session
+    that flushed them until it commits, and dropped if it rolls back,
+    so other threads never match terms that aren't in the database.
+    Code that changes keywords with Core statements should call
+    :func:`terms_changed` itself, once it has committed.
+
+    """
+    def __init__(self):
+        self._automaton = None
+        self._engine = None
+        self._profiles = {}
+        self._lock = threading.Lock()
+
+    def reset(self):
+        """Forgets the vocabulary, so it is reloaded on next use."""
+        with self._lock:
+            self._automaton = None
+            self._engine = None
+            self._profiles = {}
+
+    def _load(self):
+        # on a connection of its own, so as not to see the uncommitted
+        # changes of whichever session searches first
+        automaton = Automaton()
+        profiles = {}
+        with db.engine.connect() as connection:
+            for name, in connection.execute(db.select([db.Keyword.name])):
+                automaton.add(name)
+            for name, in connection.execute(
+                    db.select([db.OntologyClosure.ancestor]).distinct()):
+                automaton.add(name)
+            for profile in connection.execute(db.select(
+                    [ db.Profile.id, db.Profile.firstname
+                    , db.Profile.lastname, db.Profile.department
+                    , db.Profile.campus, db.Profile.faculty
+                    ])):
+                profiles[profile.id] = profile_terms(profile)
+                for term in profiles[profile.id]:
+                    automaton.add(term)
+        self._profiles = profiles
+        return automaton
+
+    @property
+    def automaton(self):
+        if self._automaton is None or self._engine is not db.engine:
+            with self._lock:
+                if self._automaton is None or self._engine is not db.engine:
+                    self._engine = db.engine
+                    self._automaton = self._load()
+        return self._automaton
+
+    def add(self, term):
+        if self._automaton is not None:
+            self._automaton.add(term)
+
+    def discard(self, term):
+        if self._automaton is not None:
+            self._automaton.discard(term)
+
+    def update_profile(self, uid, terms):
+        """Replaces the terms contributed by a profile.
+
+        Args:
+            uid (int): The profile's id.
+            terms (List[str]): Its terms, from :func:`profile_terms`.
+
+        """
+        if self._automaton is None:
+            return
+        for term in self._profiles.pop(uid, ()):
+            self._automaton.discard(term)
+        for term in terms:
+            self._automaton.add(term)
+        self._profiles[uid] = terms
+
+    def remove_profile(self, uid):
+        if self._automaton is None:
+            return
+        for term in self._profiles.pop(uid, ()):
+            self._automaton.discard(term)
+
+    def find(self, text):
+        """Finds the known terms in a piece of text.
+
+        Args:
+            text (str): The text to search, typically a search query.
+
+        Returns:
+            (Tuple[str]): The known terms in the text, in order of
+            appearance and without duplicates.
+
+        """
+        found = self.automaton.find(text)
+        return tuple(sorted(set(found), key=found.index))
+
+#: The vocabulary of the current database.
+vocabulary = Vocabulary()
+
+#: The methods of :class:`Vocabulary` that change it.
+CHANGES = {'add', 'discard', 'update_profile', 'remove_profile'}
+
+def terms_changed(changes):
+    """Applies committed changes to the vocabulary.
+
+    They are published to other processes too, see
+    :func:`oblong.database.publish_changes`.
+
+    Args:
+        changes (List[Tuple[str, Sequence]]): The name of each method
+            of :data:`vocabulary` to call, with its arguments.
+
+    """
+    _apply(changes)
+    db.publish_changes('vocabulary', changes)
+
+def _apply(changes):
+    for method, args in changes:
+        if method in CHANGES:
+            getattr(vocabulary, method)(*args)
+
+db.change_listeners['vocabulary'].append(_apply)
+db.reset_listeners.append(vocabulary.reset)
+
+def _defer(s, method, *args):
+    """Holds a change to the vocabulary until a session commits.
+
+    Each change is kept with the transaction it was made in, so that
+    rolling back a savepoint drops just the changes made since.
+
+    """
+    s.info.setdefault('vocabulary', []).append((s.transaction, method, args))
+
+def _keywords_created(s, names):
+    for name in names:
+        _defer(s, 'add', name)
+
+db.keyword_listeners.append(_keywords_created)
+
+def _within(transaction, ancestor):
+    while transaction is not None:
+        if transaction is ancestor:
+            return True
+        transaction = transaction.parent
+    return False
+
+@event.listens_for(db.Keyword, 'after_insert')
+def _keyword_inserted(mapper, connection, target):
+    _defer(object_session(target), 'add', target.name)
+
+@event.listens_for(db.Keyword, 'after_delete')
+def _keyword_deleted(mapper, connection, target):
+    _defer(object_session(target), 'discard', target.name)
+
+@event.listens_for(db.Profile, 'after_insert')
+@event.listens_for(db.Profile, 'after_update')
+def _profile_changed(mapper, connection, target):
+    _defer(object_session(target), 'update_profile', target.id,
+           profile_terms(target))
+
+@event.listens_for(db.Profile, 'after_delete')
+def _profile_deleted(mapper, connection, target):
+    _defer(object_session(target), 'remove_profile', target.id)
+
+@event.listens_for(Session, 'after_commit')
+def _apply_changes(s):
+    if s.transaction.nested:
+        # releasing a savepoint, which SQLAlchemy also reports
+        return
+    changes = s.info.pop('vocabulary', ())
+    if changes:
+        terms_changed([(method, args) for _, method, args in changes])
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _drop_changes(s, previous_transaction):
+    if 'vocabulary' in s.info:
+        s.info['vocabulary'] = [c for c in s.info['vocabulary']
+                                if not _within(c[0], previous_transaction)]
+
+@event.listens_for(Session, 'after_transaction_end')
+def _forget_changes(s, transaction):
+    # a session closed without committing or rolling back
+    if transaction.parent is None:
+        s.info.pop('vocabulary', None)
@@ -0,0 +1,151 @@
+import time
+import unittest
+from unittest import mock
+from . import vocabulary, profiling, database as db
+from .database_tests import DatabaseTestCase
+
+class AutomatonTestCase(unittest.TestCase):
+    def setUp(self):
+        self.automaton = vocabulary.Automaton(['machine learning', 'learning',
+                                               'medicine', 'art'])
+
+    def testFind(self):
+        self.assertEqual( self.automaton.find('Machine  Learning for medicine')
+                        , ['machine learning', 'medicine']
+                        )
+
+    def testWordBoundaries(self):
+        self.assertEqual(self.automaton.find('cart'), [])
+        self.assertEqual(self.automaton.find('art, cart'), ['art'])
+
+    def testOverlapping(self):
+        self.assertEqual(self.automaton.find('deep learning'), ['learning'])
+
+    def testIncrementalAdd(self):
+        self.assertEqual(self.automaton.find('artificial intelligence'), [])
+        self.automaton.add('artificial intelligence')
+        self.assertEqual( self.automaton.find('artificial intelligence')
+                        , ['artificial intelligence']
+                        )
+
+    def testDiscard(self):
+        self.automaton.add('medicine')
+        self.automaton.discard('medicine')
+        self.assertIn('medicine', self.automaton)
+        self.automaton.discard('medicine')
+        self.assertNotIn('medicine', self.automaton)
+        self.assertEqual(self.automaton.find('medicine'), [])
+        self.assertEqual(self.automaton.find('learning'), ['learning'])
+
+class VocabularyTestCase(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.mary = db.Profile(title="Mrs", firstname="Mary", lastname="Peng",
+                department="DoC")
+        self.mary.keywords["machine learning"] = 2.
+        self.mary.keywords["horse riding"] = 1.
+        db.session.add(self.mary)
+        db.session.commit()
+
+    def testLoad(self):
+        self.assertEqual( vocabulary.vocabulary.find('mary machine learning')
+                        , ('mary', 'machine learning')
+                        )
+        self.assertEqual( vocabulary.vocabulary.find('Mary Peng at DoC')
+                        , ('mary peng', 'doc')
+                        )
+
+    def testKeywordsAdded(self):
+        self.assertEqual(vocabulary.vocabulary.find('horse'), ())
+        self.mary.keywords["horse"] = 1.
+        db.session.commit()
+        self.assertEqual(vocabulary.vocabulary.find('horse'), ('horse',))
+
+    def testKeywordsDeleted(self):
+        self.assertEqual( vocabulary.vocabulary.find('horse riding')
+                        , ('horse riding',)
+                        )
+        db.session.delete(db.Keyword.find(name='horse riding')[0])
+        db.session.commit()
+        self.assertEqual(vocabulary.vocabulary.find('horse riding'), ())
+
+    def testOntologyConcepts(self):
+        self.assertEqual( vocabulary.vocabulary.find('graph theory')
+                        , ('graph theory',)
+                        )
+
+    def testProfileRenamed(self):
+        self.assertEqual(vocabulary.vocabulary.find('mary'), ('mary',))
+        self.mary.firstname = 'Maria'
+        db.session.commit()
+        self.assertEqual(vocabulary.vocabulary.find('mary'), ())
+        self.assertEqual(vocabulary.vocabulary.find('maria'), ('maria',))
+
+    def testChangesWaitForCommit(self):
+        self.mary.keywords["horse"] = 1.
+        db.session.flush()
+        self.assertEqual(vocabulary.vocabulary.find('horse'), ())
+        db.session.commit()
+        self.assertEqual(vocabulary.vocabulary.find('horse'), ('horse',))
+
+    def testRolledBackChangesDropped(self):
+        self.mary.keywords["horse"] = 1.
+        self.mary.firstname = 'Maria'
+        db.session.flush()
+        db.session.rollback()
+        db.session.commit()
+        self.assertEqual(vocabulary.vocabulary.find('horse'), ())
+        self.assertEqual(vocabulary.vocabulary.find('maria'), ())
+        self.assertEqual(vocabulary.vocabulary.find('mary'), ('mary',))
+
+    def testSavepointRolledBack(self):
+        self.mary.keywords["horse"] = 1.
+        db.session.flush()
+        with self.assertRaises(RuntimeError):
+            with db.session.begin_nested():
+                self.mary.keywords["pony"] = 1.
+                db.session.flush()
+                raise RuntimeError
+        db.session.commit()
+        self.assertEqual(vocabulary.vocabulary.find('horse pony'),
+                         ('horse',))
+
+    def testSubmittedKeywords(self):
+        self.assertEqual(vocabulary.vocabulary.find('zebrafish'), ())
+        profiling.update_authors_profiles(
+                'Zebrafish genetics', None,
+                [{ 'name': { 'title': 'Mrs', 'first': 'Mary', 'last': 'Peng'
+                           , 'initials': None, 'alias': None
+                           }
+                 , 'email': None, 'faculty': None, 'department': 'DoC'
+                 , 'campus': None, 'building': None, 'room': None
+                 , 'website': None
+                 }],
+                '2016-01-01')
+        self.assertIn('zebrafish genetics',
+                      [k.name for k in db.Keyword.query])
+        self.assertEqual(
+                vocabulary.vocabulary.find('zebrafish genetics'),
+                ('zebrafish genetics',))
+
+    def testCreatedKeywordsRolledBack(self):
+        self.assertEqual(vocabulary.vocabulary.find('unicorn'), ())
+        db.keyword_ids(['unicorn'])
+        db.session.rollback()
+        db.keyword_ids(['pegasus'])
+        db.session.commit()
+        self.assertEqual(vocabulary.vocabulary.find('unicorn pegasus'),
+                         ('pegasus',))
+
+    def testOtherProcessChanges(self):
+        listener = db.enable_change_listener(timeout=.1)
+        self.addCleanup(db.disable_change_listener)
+        self.assertTrue(listener.connected.wait(10))
+        self.assertEqual(vocabulary.vocabulary.find('zebra'), ())
+        with mock.patch.object(db, '_origin', return_value='other'):
+            db.publish_changes('vocabulary', [('add', ['zebra'])])
+        for _ in range(100):
+            if vocabulary.vocabulary.find('zebra'):
+                break
+            time.sleep(.1)
+        self.assertEqual(vocabulary.vocabulary.find('zebra'), ('zebra',))
@@ -22,4 +22,14 @@ setup( name='oblong'
                 '@fix-windows-support#egg=testing.postgresql')
              ]
      , setup_requires = ['nose']
+     , extras_require={ 'brotli': ['brotli']
+                      , 'orjson': ['orjson']
+                      # the async server needs Python 3.7, see oblong.asgi
+                      , 'asgi': [ 'sqlalchemy>=1.4; python_version >= "3.7"'
+                                , 'asyncpg; python_version >= "3.7"'
+                                , 'starlette; python_version >= "3.7"'
+                                , 'uvicorn; python_version >= "3.7"'
+                                ]
+                      }
+     , entry_points={ 'console_scripts': ['oblong = oblong.cli:main'] }
      )